@@ -12,7 +12,10 @@
 # -----------------------------------------------------------------------------
 
 import sys ; sys.path.insert(0, "Sources")
-from distutils.core import setup
+try:
+	from setuptools import setup
+except ImportError:
+	from distutils.core import setup
 import paml.engine
 
 SUMMARY     = "A Pythonic transpiler for HTML/XML"
@@ -39,7 +42,9 @@ setup(
     url          = "http://www.github.com/sebastien/paml",
     package_dir  = { "": "Sources" },
     packages     = ["paml"],
-    scripts      = ["Scripts/paml", "Scripts/paml-web"]
+    scripts      = ["Scripts/paml", "Scripts/paml-web"],
+    # NOTE: Retro is only needed by `paml-web` (see `paml.web`)
+    extras_require = { "web": ["retro>=2.9.0"] }
 )
 
 # EOF
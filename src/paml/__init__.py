@@ -1,3 +1,18 @@
-import paml.engine
-toHTML = process = paml.engine.parse
+# NOTE: The engine is only imported when used, so that importing `paml` (or
+# one of its other modules) stays cheap.
+def toHTML( text, path=None, format="html" ):
+	import paml.engine
+	return paml.engine.parse(text, path, format)
+process = toHTML
+
+# The submodules that are imported on first access, so that `paml.engine`
+# works after a plain `import paml`, as it did when the engine was imported
+# eagerly.
+SUBMODULES = ("engine", "web", "aio", "importer", "benchmark")
+
+def __getattr__( name ):
+	if name in SUBMODULES:
+		import importlib
+		return importlib.import_module("paml." + name)
+	raise AttributeError("module 'paml' has no attribute '{0}'".format(name))
 # EOF
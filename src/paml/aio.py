@@ -0,0 +1,367 @@
+#!/usr/bin/env python
+# encoding: utf8
+# -----------------------------------------------------------------------------
+# Project           :   PAML
+# -----------------------------------------------------------------------------
+# License           :   Lesser GNU Public License
+# -----------------------------------------------------------------------------
+# Creation date     :   19-Oct-2026
+# Last mod.         :   19-Oct-2026
+# -----------------------------------------------------------------------------
+
+# An asyncio-based API to render PAML and run the `paml.web` processors.
+# Processor commands are run with `asyncio.create_subprocess_exec` instead
+# of blocking a thread, and the embedded blocks of a PAML document (Sugar,
+# TypeScript, CoffeeScript, PCSS) are compiled concurrently.
+#
+# >	html = await paml.aio.render(text, path)
+#
+# The module also provides `Application`, an ASGI application that serves
+# files the same way `paml-web` does, for instance with
+# `uvicorn paml.aio:application`.
+
+import os, shlex, time, asyncio, functools, mimetypes
+from   paml import engine, web
+
+LOCKS = {}
+# The `asyncio.Lock` that serializes the incremental parses of each path
+DOCUMENT_LOCKS = {}
+# The background revalidations started by `revalidated`
+REVALIDATIONS = set()
+
+# -----------------------------------------------------------------------------
+#
+# COMMANDS
+#
+# -----------------------------------------------------------------------------
+
+async def runSteps( steps ):
+	"""Runs the given processor steps (see `paml.web.runSteps`), running the
+	commands with `runCommand` and returning the processor's result."""
+	try:
+		command = next(steps)
+		while True:
+			try:
+				result = await runCommand(*command)
+			except Exception as e:
+				# The steps get a chance to clean up their temp files
+				command = steps.throw(e)
+			else:
+				command = steps.send(result)
+	except StopIteration as e:
+		return e.value
+
+async def runCommand( command, cwd=None ):
+	"""Runs the given command, given as a list of arguments that are joined
+	as a single shell line (like `paml.web._runCommand`), and returns
+	`(data, error, returncode)`. The command is not run through a shell,
+	but `~` and `$VARIABLE` are expanded in its arguments like the shell
+	would (see `splitCommand`)."""
+	name = web._getCommandName(command)
+	web.METRICS.increment("paml_subprocess_in_flight", 1, command=name)
+	t = time.time()
+	try:
+		p = await asyncio.create_subprocess_exec(
+			*splitCommand(command),
+			stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+			cwd=cwd
+		)
+		data, error = await p.communicate()
+	finally:
+		web.METRICS.increment("paml_subprocess_in_flight", -1, command=name)
+		web.METRICS.observe("paml_subprocess_duration_seconds", time.time() - t, command=name)
+		web.METRICS.increment("paml_subprocess_runs_total", command=name)
+	if p.returncode != 0:
+		web.METRICS.increment("paml_subprocess_failures_total", command=name)
+	return data, error, p.returncode
+
+def splitCommand( command ):
+	"""Splits the given command into arguments like a shell would, expanding
+	a leading `~` and `$VARIABLE`s in each of them. Unlike a shell, the
+	variables are also expanded within single quotes."""
+	return [os.path.expanduser(os.path.expandvars(_)) for _ in shlex.split(" ".join(command))]
+
+def locked( f ):
+	"""Ensures that the wrapped coroutine function is not executed
+	concurrently, like `paml.web.locked`."""
+	async def wrapper(*a, **kwa):
+		name = f.__name__
+		if name not in LOCKS: LOCKS[name] = asyncio.Lock()
+		lock = LOCKS[name]
+		web.METRICS.increment("paml_lock_waiting", 1, lock=name)
+		t = time.time()
+		async with lock:
+			web.METRICS.increment("paml_lock_waiting", -1, lock=name)
+			web.METRICS.observe("paml_lock_wait_seconds", time.time() - t, lock=name)
+			return await f(*a, **kwa)
+	functools.update_wrapper(wrapper, f)
+	return wrapper
+
+def revalidated( processor ):
+	"""Serves the outdated results of the wrapped coroutine function while
+	they are recompiled in a background task, like `paml.web.revalidated`,
+	with which it shares the `STALE_CACHE`."""
+	async def wrapper( text, path, request=None, cache=True, **options ):
+		key, signature = web._getRevalidationKey(processor, path, request, options) if web.STALE_WHILE_REVALIDATE and cache else (None, None)
+		if not key:
+			return await processor(text, path, request, cache, **options)
+		result = web._getStale(processor, key, signature)
+		if result is None:
+			try:
+				result = await processor(text, path, request, False, **options)
+			except Exception as e:
+				web._setStaleFailure(key, signature, e)
+				raise e
+			return web.STALE_CACHE.set(key, result, signature)
+		if web._startRevalidation(key, signature):
+			task = asyncio.ensure_future(revalidate(key, signature, processor, text, path, request, options))
+			REVALIDATIONS.add(task)
+			task.add_done_callback(REVALIDATIONS.discard)
+		return result
+	functools.update_wrapper(wrapper, processor)
+	return wrapper
+
+async def revalidate( key, signature, processor, text, path, request, options ):
+	result = error = None
+	try:
+		if isinstance(path, str) and os.path.isfile(path):
+			with open(path, "rt") as f:
+				text = f.read()
+		result = await processor(text, path, request, False, **options)
+	except Exception as e:
+		error = e
+	finally:
+		web._endRevalidation(key, signature, path, result, error)
+
+# -----------------------------------------------------------------------------
+#
+# PROCESSORS
+#
+# -----------------------------------------------------------------------------
+
+@revalidated
+@locked
+async def processSugar( text, path, request=None, cache=True, includeSource=False, version="" ):
+	return await runSteps(web._processSugarSteps(text, path, request, cache, includeSource, version))
+
+async def processCoffeeScript( text, path, request=None, cache=True ):
+	return await runSteps(web._processCoffeeScriptSteps(text, path, request, cache))
+
+async def processBabelJS( text, path, cache=True ):
+	return await runSteps(web._processBabelJSSteps(text, path, cache))
+
+@revalidated
+async def processTypeScript( text, path, request=None, cache=True ):
+	return await runSteps(web._processTypeScriptSteps(text, path, request, cache))
+
+async def processPandoc( text, path, request=None, cache=True ):
+	return await runSteps(web._processPandocSteps(text, path, request, cache))
+
+@revalidated
+async def processPCSS( text, path, request=None, cache=True ):
+	return await runSteps(web._processPCSSSteps(text, path, request, cache))
+
+async def processPAML( text, path, request=None ):
+	"""Renders the given PAML file like `paml.web.processPAML`, compiling
+	its embedded blocks concurrently. The document is parsed and formatted
+	in the loop's default executor, so that it does not block the loop."""
+	format, type = web.getPAMLFormat(path)
+	pool   = web.getEngine(format)
+	parser = pool.acquireParser()
+	loop   = asyncio.get_running_loop()
+	try:
+		if web.INCREMENTAL and path:
+			if path not in DOCUMENT_LOCKS: DOCUMENT_LOCKS[path] = asyncio.Lock()
+			async with DOCUMENT_LOCKS[path]:
+				tree = await loop.run_in_executor(None, parseIncremental, parser, text, path)
+		else:
+			tree = await loop.run_in_executor(None, parser.parseStringTree, text, path)
+		return await formatTree(tree, parser._formatter), type
+	finally:
+		pool.releaseParser(parser)
+
+def parseIncremental( parser, text, path ):
+	"""Parses the given text with the `engine.IncrementalDocument` of the
+	given path. The document's lock is still taken, as it is shared with
+	`paml.web`."""
+	document, lock = web.getIncrementalDocument(path)
+	with lock:
+		return document.parse(parser, text)
+
+# The processors that have an asynchronous implementation, the others
+# are run in the loop's default executor.
+PROCESSORS = {
+	"paml"     : processPAML,
+	"sjs"      : processSugar,
+	"js6"      : processBabelJS,
+	"es6.js"   : processBabelJS,
+	"coffee"   : processCoffeeScript,
+	"ts"       : processTypeScript,
+	"pcss"     : processPCSS,
+	"md"       : processPandoc,
+}
+
+async def process( text, path ):
+	"""Processes the given text from the given path (or list of paths)
+	through the processor that `paml-web` would use for it, returning
+	`(content, content type)`, or `None` when there is no processor."""
+	first = path[0] if isinstance(path, list) or isinstance(path, tuple) else path
+	processors = web.getProcessors()
+	matches    = sorted(_ for _ in processors if first.endswith(_))
+	if not matches:
+		return None
+	name = matches[-1]
+	web.METRICS.increment("paml_processor_in_flight", 1, processor=name)
+	t = time.time()
+	try:
+		if name in PROCESSORS:
+			return await PROCESSORS[name](text, path)
+		else:
+			loop = asyncio.get_running_loop()
+			# NOTE: The processors returned by `getProcessors` already
+			# record their metrics.
+			return await loop.run_in_executor(None, functools.partial(getattr(processors[name], "__wrapped__", processors[name]), text, path))
+	except Exception as e:
+		web.METRICS.increment("paml_processor_errors_total", processor=name)
+		raise e
+	finally:
+		web.METRICS.increment("paml_processor_in_flight", -1, processor=name)
+		web.METRICS.increment("paml_processor_requests_total", processor=name)
+		web.METRICS.observe("paml_processor_duration_seconds", time.time() - t, processor=name)
+
+# -----------------------------------------------------------------------------
+#
+# RENDERING
+#
+# -----------------------------------------------------------------------------
+
+async def render( text, path=None, format="html", parser=None ):
+	"""Parses and formats the given PAML text, like `engine.parse`, except
+	that the embedded blocks are compiled concurrently, without blocking
+	the event loop. When given, the `parser` is used with its formatter,
+	and it should not be used by another render at the same time."""
+	parser = parser or engine.Parser(formatter=engine.formatter(format))
+	tree   = await asyncio.get_running_loop().run_in_executor(None, parser.parseStringTree, text, path)
+	return await formatTree(tree, parser._formatter)
+
+async def formatTree( tree, formatter ):
+	"""Compiles the embedded blocks of the given tree concurrently and then
+	formats it with the given formatter, in the loop's default executor."""
+	await precompile(tree, formatter)
+	try:
+		return await asyncio.get_running_loop().run_in_executor(None, formatter.format, tree)
+	finally:
+		if getattr(formatter, "precompiled", None):
+			formatter.precompiled.clear()
+
+async def precompile( tree, formatter ):
+	"""Compiles the embedded blocks of the given tree concurrently, storing
+	the results in the formatter's `precompiled` map so that they are used
+	instead of being compiled again while formatting. This only applies to
+	formatters that process embedded blocks like the `HTMLFormatter`."""
+	if not isinstance(formatter, engine.HTMLFormatter): return
+	if type(formatter)._formatContent is not engine.HTMLFormatter._formatContent: return
+	elements = []
+	jobs     = []
+	for element in getEmbeddedElements(tree):
+		job = getEmbeddedJob(element, formatter)
+		if job:
+			elements.append(element)
+			jobs.append(job)
+	for element, result in zip(elements, await asyncio.gather(*jobs)):
+		formatter.precompiled[id(element)] = result[0]
+
+def getEmbeddedElements( tree ):
+	"""Yields the elements of the given tree that have a mode."""
+	stack = [tree]
+	while stack:
+		node = stack.pop()
+		if isinstance(node, engine.Element):
+			if node.mode:
+				yield node
+			else:
+				stack.extend(reversed(node.content))
+
+def getEmbeddedJob( element, formatter ):
+	"""Returns a coroutine that compiles the content of the given embedded
+	element, as `HTMLFormatter._formatElement` would, or `None` when its
+	mode doesn't involve a compiler."""
+	mode   = element.mode.split("+")[0]
+	source = u"".join(element.contentAsLines())
+	if mode.startswith("sugar"):
+		return processSugar(source, "", cache=formatter.useProcessCache, includeSource=element.mode.endswith("+source"), version=mode[len("sugar"):])
+	elif mode in ("coffeescript", "coffee"):
+		return processCoffeeScript(source, "", cache=False)
+	elif mode in ("typescript", "ts"):
+		return processTypeScript(source, "", cache=False)
+	elif mode in ("pythoniccss", "pcss"):
+		return processPCSS(source, ".")
+	else:
+		return None
+
+# -----------------------------------------------------------------------------
+#
+# ASGI APPLICATION
+#
+# -----------------------------------------------------------------------------
+
+class Application:
+	"""An ASGI application that serves the files of the given root the same
+	way `paml-web` does: paths are resolved with `paml.web.resolveLocalPath`
+	and files with a processor are processed with `process`. Metrics are
+	served at `/_paml/metrics`."""
+
+	def __init__( self, root="." ):
+		self.root = os.path.abspath(root)
+
+	async def __call__( self, scope, receive, send ):
+		if scope["type"] == "lifespan":
+			while True:
+				message = await receive()
+				if message["type"] == "lifespan.startup":
+					await send({"type":"lifespan.startup.complete"})
+				elif message["type"] == "lifespan.shutdown":
+					await send({"type":"lifespan.shutdown.complete"})
+					return
+		elif scope["type"] == "http":
+			status, content_type, body = await self.respond(scope["path"])
+			await send({
+				"type"    : "http.response.start",
+				"status"  : status,
+				"headers" : [(b"content-type", engine.ensure_bytes(content_type))],
+			})
+			await send({
+				"type"    : "http.response.body",
+				"body"    : body if scope["method"] != "HEAD" else b"",
+			})
+
+	async def respond( self, path ):
+		"""Returns `(status, content type, body)` for the given URL path."""
+		if path == "/_paml/metrics":
+			return 200, "text/plain; version=0.0.4; charset=utf-8", engine.ensure_bytes(web.METRICS.asPrometheus())
+		resolved = web.resolveLocalPath(self.root, path.lstrip("/") or ".")
+		paths    = resolved if isinstance(resolved, list) else [resolved]
+		for p in paths:
+			if not (os.path.abspath(p) + os.sep).startswith(self.root + os.sep):
+				return 403, "text/plain", b"Forbidden"
+			if not os.path.isfile(p):
+				return 404, "text/plain", engine.ensure_bytes("File not found: {0}".format(path))
+		try:
+			if isinstance(resolved, list):
+				result = await process(None, resolved)
+			else:
+				# NOTE: We read the file the same way `LocalFiles` does
+				with open(resolved, "rt") as f:
+					result = await process(f.read(), resolved)
+		except Exception as e:
+			return 500, "text/plain", engine.ensure_bytes(str(e))
+		if result:
+			content, content_type = result
+			return 200, content_type or "text/plain", engine.ensure_bytes(content)
+		with open(resolved, "rb") as f:
+			return 200, mimetypes.guess_type(resolved)[0] or "application/octet-stream", f.read()
+
+# An application serving the current directory
+application = Application()
+
+# EOF - vim: tw=80 ts=4 sw=4 noet
@@ -0,0 +1,488 @@
+#!/usr/bin/env python
+# encoding: utf8
+# -----------------------------------------------------------------------------
+# Project           :   PAML
+# -----------------------------------------------------------------------------
+# License           :   Lesser GNU Public License
+# -----------------------------------------------------------------------------
+# Creation date     :   19-Oct-2026
+# Last mod.         :   19-Oct-2026
+# -----------------------------------------------------------------------------
+
+# Benchmarks the PAML engine over a set of PAML files (typically the
+# `tests/*.paml` fixtures) and over generated corpora that scale the number
+# of lines, the nesting depth, the density of inline elements and the number
+# of attributes. Each corpus is timed for parsing, formatting in each of the
+# supported formats and end-to-end `engine.parse`.
+#
+# Run it with `python -m paml.benchmark tests/*.paml`. Results can be saved
+# as a baseline with `--save FILE` and later compared with `--compare FILE`,
+# in which case the command fails when a phase is slower (or allocates more)
+# than the baseline by more than the given `--threshold`.
+#
+# With `--depth-scaling`, documents nested up to 10k levels deep are
+# formatted to check that formatting time grows linearly with the depth.
+#
+# With `--import-time`, the time it takes to import `paml` and `paml.engine`
+# in a fresh interpreter is measured instead, using `python -X importtime`.
+
+import os, sys, time, json, argparse, subprocess, tracemalloc
+from paml import engine
+
+FORMATS = ("html", "xhtml", "xml", "js")
+PHASES  = ("parse",) + tuple("format:" + _ for _ in FORMATS) + ("end-to-end",)
+
+# The version of the results format, baselines with another version can't
+# be compared.
+BASELINE_VERSION = 1
+
+# The nesting depths formatted by `--depth-scaling`, and the formats
+# (which must not be limited by the recursion limit)
+SCALING_DEPTHS  = (10, 100, 1000, 10000)
+SCALING_FORMATS = ("html", "xhtml", "xml")
+# The maximum ratio between the time per level at the deepest depth and
+# at the reference depth
+SCALING_RATIO   = 4.0
+
+# The modules whose import time is measured by `--import-time`
+IMPORT_MODULES = ("paml", "paml.engine")
+
+# The generated corpora, as `(name, options)` where the options are
+# given to `generate`. The number of lines is multiplied by the `scale`.
+CORPORA = (
+	("lines-1k",       dict(lines=1000)),
+	("lines-5k",       dict(lines=5000)),
+	("lines-20k",      dict(lines=20000)),
+	("depth-4",        dict(lines=5000, depth=4)),
+	("depth-16",       dict(lines=5000, depth=16)),
+	("depth-64",       dict(lines=5000, depth=64)),
+	("inlines-0",      dict(lines=5000, inlines=0)),
+	("inlines-8",      dict(lines=5000, inlines=8)),
+	("inlines-32",     dict(lines=5000, inlines=32)),
+	("attributes-0",   dict(lines=5000, attributes=0)),
+	("attributes-16",  dict(lines=5000, attributes=16)),
+	("attributes-64",  dict(lines=5000, attributes=64)),
+	("attributes-128", dict(lines=2000, attributes=128)),
+	("values-4k",      dict(lines=2000, attributes=4, valueSize=4096)),
+	("values-16k",     dict(lines=500,  attributes=1, valueSize=16384)),
+)
+
+# -----------------------------------------------------------------------------
+#
+# CORPORA
+#
+# -----------------------------------------------------------------------------
+
+class Corpus:
+	"""A named PAML source text, optionally bound to a path (which is used
+	to resolve includes)."""
+
+	def __init__( self, name, text, path=None, error=None ):
+		self.name  = name
+		self.text  = text
+		self.path  = path
+		self.error = error
+		self.lines = text.count("\n") + 1
+		self.size  = len(engine.ensure_bytes(text))
+
+def generate( lines=1000, depth=3, inlines=1, attributes=1, valueSize=0 ):
+	"""Generates a PAML document of about the given number of `lines`, made
+	of blocks of elements nested `depth` levels deep, each with the given
+	number of `attributes`, and containing a line of text with the given
+	number of `inlines` elements. Everything is wrapped in a single `body`
+	element, so that the document can be formatted as JavaScript.
+
+	When `valueSize` is given, the attribute values are padded to that
+	many characters with SVG-like path data."""
+	value  = "value-{0}"
+	if valueSize:
+		value += (" L" + " ".join("{0} {0}".format(_ % 100) for _ in range(int(valueSize / 6) + 1)))[:valueSize]
+	attrs  = "(" + ",".join(("data-a{0}=" + value).format(_) for _ in range(attributes)) + ")" if attributes else ""
+	text   = " ".join(["Lorem ipsum"] + ["<a(href=/page/{0}):link {0}> dolor sit".format(_) for _ in range(inlines)])
+	result = ["<body"]
+	while len(result) < lines:
+		for level in range(depth):
+			result.append("\t" * (level + 1) + "<div.level-{0}{1}".format(level, attrs))
+		result.append("\t" * (depth + 1) + text)
+	return "\n".join(result[:lines]) + "\n"
+
+def getFixtures( paths ):
+	"""Returns the corpora for the PAML files at the given paths."""
+	res = []
+	for path in paths:
+		try:
+			res.append(Corpus(os.path.basename(path), engine.read_file(path)[0], path))
+		except UnicodeDecodeError as e:
+			res.append(Corpus(os.path.basename(path), "", path, error="{0}: {1}".format(e.__class__.__name__, e)))
+	return res
+
+def getCorpora( scale=1.0 ):
+	"""Returns the generated corpora defined in `CORPORA`, with their number
+	of lines multiplied by the given `scale`."""
+	res = []
+	for name, options in CORPORA:
+		options = dict(options)
+		options["lines"] = max(1, int(options["lines"] * scale))
+		res.append(Corpus(name, generate(**options)))
+	return res
+
+# -----------------------------------------------------------------------------
+#
+# MEASURES
+#
+# -----------------------------------------------------------------------------
+
+def measure( function, repeat=3, setup=None ):
+	"""Returns the best time (in seconds) of `repeat` calls to the given
+	function. When given, `setup` is called (untimed) before each call and
+	its result is passed to the function."""
+	best = None
+	for _ in range(repeat):
+		args = (setup(),) if setup else ()
+		t    = time.perf_counter()
+		function(*args)
+		t    = time.perf_counter() - t
+		best = t if best is None else min(best, t)
+	return best
+
+def allocations( function, setup=None ):
+	"""Returns `(blocks, peak)` for a single call to the given function,
+	where `blocks` is the number of memory blocks allocated by the call that
+	are still alive once it returns (including its result), and `peak` is
+	the peak traced memory in bytes during the call."""
+	args    = (setup(),) if setup else ()
+	started = tracemalloc.is_tracing()
+	if not started: tracemalloc.start()
+	try:
+		tracemalloc.clear_traces()
+		result = function(*args)
+		_, peak = tracemalloc.get_traced_memory()
+		blocks  = sum(_.count for _ in tracemalloc.take_snapshot().statistics("filename"))
+		del result
+	finally:
+		if not started: tracemalloc.stop()
+	return (blocks, peak)
+
+def getPhases( corpus, formats=FORMATS ):
+	"""Returns a list of `(name, function, setup)` for each phase of the
+	processing of the given corpus. Formatters update the tree they format,
+	so they're given a fresh copy of the parsed tree."""
+	parse  = lambda: engine.Parser().parseStringTree(corpus.text, corpus.path)
+	tree   = parse()
+	phases = [("parse", parse, None)]
+	for name in formats:
+		phases.append((
+			"format:" + name,
+			lambda _, name=name: engine.formatter(name).format(_),
+			tree.clone,
+		))
+	phases.append((
+		"end-to-end",
+		lambda: engine.parse(corpus.text, corpus.path),
+		None,
+	))
+	return phases
+
+def benchmark( corpus, repeat=3, formats=FORMATS, memory=False ):
+	"""Benchmarks the given corpus, returning a dictionary with the corpus
+	`name`, `lines` and `bytes`, as well as the time of each phase in
+	`phases`. Phases that fail are set to `None`, with their error given in
+	`errors`, and when parsing fails, the corpus is reported with an
+	`error` instead. When `memory` is set, the `(blocks, peak)` allocations
+	of each phase are given in `allocations`."""
+	result = dict(name=corpus.name, lines=corpus.lines, bytes=corpus.size, phases={})
+	if memory: result["allocations"] = {}
+	if corpus.error:
+		result["error"] = corpus.error
+		return result
+	try:
+		phases = getPhases(corpus, formats)
+	except Exception as e:
+		result["error"] = "{0}: {1}".format(e.__class__.__name__, e)
+		return result
+	for name, function, setup in phases:
+		try:
+			result["phases"][name] = measure(function, repeat, setup)
+			if memory:
+				result["allocations"][name] = allocations(function, setup)
+		except Exception as e:
+			result["phases"][name] = None
+			result.setdefault("errors", {})[name] = "{0}: {1}".format(e.__class__.__name__, e)
+	return result
+
+# -----------------------------------------------------------------------------
+#
+# REPORTING
+#
+# -----------------------------------------------------------------------------
+
+def throughput( result, phase="end-to-end" ):
+	"""Returns the `(lines/s, MB/s)` throughput of the given phase of the
+	given result, or `(None, None)`."""
+	t = result["phases"].get(phase)
+	if not t: return (None, None)
+	return (result["lines"] / t, result["bytes"] / t / 1000000.0)
+
+def report( results, formats=FORMATS ):
+	"""Returns a text table summarizing the given results. Times are given
+	in milliseconds and throughputs are given for the end-to-end phase."""
+	phases  = ["parse"] + ["format:" + _ for _ in formats] + ["end-to-end"]
+	headers = ["corpus", "lines", "KB"] + [_.split(":")[-1] for _ in phases] + ["lines/s", "MB/s"]
+	rows    = []
+	for result in results:
+		row = [result["name"], str(result["lines"]), "{0:0.1f}".format(result["bytes"] / 1000.0)]
+		if "error" in result:
+			# NOTE: The error is not aligned, so it's added to the last
+			# column and doesn't widen the others.
+			row.append("skipped ({0})".format(" ".join(result["error"].split())[:60]))
+		else:
+			for phase in phases:
+				t = result["phases"].get(phase)
+				row.append("-" if t is None else "{0:0.2f}".format(t * 1000))
+			lps, mbps = throughput(result)
+			row.append("-" if lps  is None else "{0:0.0f}".format(lps))
+			row.append("-" if mbps is None else "{0:0.2f}".format(mbps))
+		rows.append(row)
+	widths = [max(len(_[i]) for _ in [headers] + [r for r in rows if len(r) == len(headers)]) for i in range(len(headers))]
+	lines  = []
+	for row in [headers] + rows:
+		lines.append("  ".join(
+			(_.ljust(widths[i]) if i == 0 else _.rjust(widths[i])) if len(row) == len(widths) or i < len(row) - 1 else _
+			for i, _ in enumerate(row)
+		).rstrip())
+	return "\n".join(lines) + "\n"
+
+# -----------------------------------------------------------------------------
+#
+# DEPTH SCALING
+#
+# -----------------------------------------------------------------------------
+
+def nested( depth ):
+	"""Returns a document made of `depth` nested `div` elements. The tree
+	is built directly, as the PAML source of such a document would be
+	quadratic in size because of the indentation."""
+	document = engine.Element("document")
+	element  = document
+	for i in range(depth):
+		child = engine.Element("div", [["data-level", str(i)]])
+		element.append(child)
+		element = child
+	element.append(engine.Text("Lorem ipsum"))
+	return document
+
+def depthScaling( depths=SCALING_DEPTHS, repeat=3, formats=SCALING_FORMATS, reference=1000, ratio=SCALING_RATIO ):
+	"""Formats nested documents of the given depths in the given formats,
+	returning `(results, failures)`. The results are `{name, depth,
+	phases}` dicts (like `benchmark`) or have an `error`, and the failures
+	list the `(depth, format, reason)` for which formatting failed or was
+	more than `ratio` times slower per level than at the `reference`
+	depth."""
+	results  = []
+	failures = []
+	for depth in depths:
+		document = nested(depth)
+		result   = dict(name="depth-{0}".format(depth), depth=depth, phases={})
+		for format in formats:
+			try:
+				result["phases"]["format:" + format] = measure(lambda: engine.formatter(format).format(document), repeat)
+			except Exception as e:
+				result["error"] = "{0}: {1}".format(e.__class__.__name__, e)
+				failures.append((depth, format, result["error"]))
+				break
+		results.append(result)
+	base = dict((_["depth"], _) for _ in results if "error" not in _).get(reference)
+	for result in results:
+		if not base or "error" in result or result["depth"] <= reference: continue
+		for phase, t in result["phases"].items():
+			r = (t / result["depth"]) / (base["phases"][phase] / reference)
+			if r > ratio:
+				failures.append((result["depth"], phase.split(":")[-1], "{0:0.1f}x slower per level than at depth {1}".format(r, reference)))
+	return results, failures
+
+def reportScaling( results, failures, formats=SCALING_FORMATS ):
+	"""Returns a text table with the time (in milliseconds) and time per
+	level (in microseconds) for each depth and format, followed by the
+	failures."""
+	lines = ["{0:>8s}  ".format("depth") + "  ".join("{0:>10s}  {1:>8s}".format(_, "us/level") for _ in formats)]
+	for result in results:
+		if "error" in result:
+			lines.append("{0:>8d}  failed ({1})".format(result["depth"], " ".join(result["error"].split())[:60]))
+			continue
+		lines.append("{0:>8d}  ".format(result["depth"]) + "  ".join(
+			"{0:>10.2f}  {1:>8.2f}".format(t * 1000, t * 1000000 / result["depth"]) for t in (result["phases"]["format:" + _] for _ in formats)
+		))
+	for depth, format, reason in failures:
+		lines.append("FAILED: {0} at depth {1}: {2}".format(format, depth, reason))
+	return "\n".join(lines) + "\n"
+
+# -----------------------------------------------------------------------------
+#
+# IMPORT TIME
+#
+# -----------------------------------------------------------------------------
+
+def importTime( module="paml.engine", repeat=5 ):
+	"""Imports the given module in a fresh interpreter with `python -X
+	importtime` and returns the best of `repeat` runs as a dict with the
+	`total` time (in seconds) and the `imports`, as `(name, self,
+	cumulative)` sorted by decreasing self time."""
+	env  = dict(os.environ)
+	# NOTE: We make sure the fresh interpreter imports this `paml`
+	root = os.path.dirname(os.path.dirname(os.path.abspath(engine.__file__)))
+	env["PYTHONPATH"] = os.pathsep.join(_ for _ in (root, env.get("PYTHONPATH")) if _)
+	best = None
+	for i in range(repeat):
+		p = subprocess.run(
+			[sys.executable, "-X", "importtime", "-c", "import " + module],
+			env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True
+		)
+		if p.returncode != 0:
+			raise Exception("Could not import {0}: {1}".format(module, p.stderr.strip().split("\n")[-1]))
+		imports = []
+		for line in p.stderr.split("\n"):
+			if not line.startswith("import time:") or "[us]" in line: continue
+			own, cumulative, name = line[len("import time:"):].split("|", 2)
+			imports.append((name.strip(), int(own) / 1000000.0, int(cumulative) / 1000000.0))
+		total = [_[2] for _ in imports if _[0] == module][-1]
+		if best is None or total < best["total"]:
+			best = dict(module=module, total=total, imports=sorted(imports, key=lambda _:-_[1]))
+	return best
+
+def reportImportTime( results, top=10 ):
+	"""Returns a text summary of the given `importTime` results, listing
+	the `top` imports by self time for each module."""
+	lines = []
+	for result in results:
+		lines.append("{0}: {1:0.2f}ms".format(result["module"], result["total"] * 1000))
+		for name, own, cumulative in result["imports"][:top]:
+			lines.append("  {0:>8.2f}ms  {1:>8.2f}ms  {2}".format(own * 1000, cumulative * 1000, name))
+	return "\n".join(lines) + "\n"
+
+# -----------------------------------------------------------------------------
+#
+# BASELINES
+#
+# -----------------------------------------------------------------------------
+
+def save( path, results ):
+	"""Saves the given results as a baseline at the given path."""
+	with open(path, "wt") as f:
+		json.dump(dict(version=BASELINE_VERSION, results=results), f, indent=1, sort_keys=True)
+
+def load( path ):
+	"""Loads the results of the baseline at the given path."""
+	with open(path, "rt") as f:
+		data = json.load(f)
+	if not isinstance(data, dict) or data.get("version") != BASELINE_VERSION:
+		raise Exception("Unsupported baseline format: {0}".format(path))
+	return data["results"]
+
+def delta( current, previous ):
+	"""Returns the relative change from `previous` to `current`, or `None`
+	when it can't be computed."""
+	if current is None or not previous: return None
+	return (current - previous) / float(previous)
+
+def compare( results, baseline, threshold=0.25, memoryThreshold=0.25, minimum=0.001 ):
+	"""Compares the given results with the given baseline results, returning
+	`(report, regressions)` where `regressions` is the list of
+	`(corpus, phase, measure, delta)` that exceed their threshold. Timings
+	below `minimum` seconds in the baseline are too noisy and are reported
+	but never considered as regressions. Corpora and phases missing from
+	either side are ignored."""
+	previous    = dict((_["name"], _) for _ in baseline if "error" not in _)
+	regressions = []
+	totals      = {}
+	lines       = []
+	for result in results:
+		base = previous.get(result["name"])
+		if not base or "error" in result: continue
+		for phase in PHASES:
+			t, b = result["phases"].get(phase), base["phases"].get(phase)
+			if t is None or b is None: continue
+			total = totals.setdefault(phase, [0.0, 0.0])
+			total[0] += t
+			total[1] += b
+			d = delta(t, b)
+			if d is not None and d > threshold and b >= minimum:
+				regressions.append((result["name"], phase, "time", d))
+			m, n = (result.get("allocations") or {}).get(phase), (base.get("allocations") or {}).get(phase)
+			if m and n:
+				for i, measure in enumerate(("blocks", "peak")):
+					d = delta(m[i], n[i])
+					if d is not None and d > memoryThreshold:
+						regressions.append((result["name"], phase, measure, d))
+	lines.append("{0:<12s}  {1:>10s}  {2:>10s}  {3:>8s}".format("phase", "baseline", "current", "delta"))
+	for phase in PHASES:
+		if phase not in totals: continue
+		t, b = totals[phase]
+		d    = delta(t, b)
+		lines.append("{0:<12s}  {1:>8.2f}ms  {2:>8.2f}ms  {3:>8s}".format(
+			phase.split(":")[-1], b * 1000, t * 1000,
+			"-" if d is None else "{0:+0.1%}".format(d)
+		))
+	if regressions:
+		lines.append("")
+		lines.append("{0} regression(s) above {1:0.0%} (time) / {2:0.0%} (memory):".format(len(regressions), threshold, memoryThreshold))
+		for name, phase, measure, d in regressions:
+			lines.append("  {0} {1} {2} {3:+0.1%}".format(name, phase, measure, d))
+	return ("\n".join(lines) + "\n", regressions)
+
+# -----------------------------------------------------------------------------
+#
+# COMMAND-LINE INTERFACE
+#
+# -----------------------------------------------------------------------------
+
+def run( arguments ):
+	"""Runs the benchmark with the given command-line arguments, returning
+	`(output, status)` where the status is non-zero when a comparison with
+	a baseline found regressions."""
+	p = argparse.ArgumentParser(description="Benchmarks the PAML engine")
+	p.add_argument("files", type=str, nargs="*", help="PAML files to benchmark, typically tests/*.paml")
+	p.add_argument("-n", "--repeat", type=int,   default=3,   help="Number of runs per phase, the best is kept")
+	p.add_argument("-s", "--scale",  type=float, default=1.0, help="Scales the number of lines of generated corpora")
+	p.add_argument("-f", "--format", dest="formats", action="append", choices=FORMATS, help="Formats to benchmark (all by default)")
+	p.add_argument("--no-generated", dest="generated", action="store_false", help="Skips the generated corpora")
+	p.add_argument("-m", "--memory", action="store_true", help="Measures allocations with tracemalloc")
+	p.add_argument("--json", action="store_true", help="Outputs the results as JSON")
+	p.add_argument("--save", type=str, help="Saves the results as a baseline JSON file")
+	p.add_argument("--compare", type=str, help="Compares the results with the given baseline JSON file, failing on regressions")
+	p.add_argument("-t", "--threshold", type=float, default=0.25, help="Maximum relative slowdown of a phase (default 0.25)")
+	p.add_argument("--memory-threshold", type=float, default=0.25, help="Maximum relative increase in allocations (default 0.25)")
+	p.add_argument("--min-time", type=float, default=0.001, help="Baseline timings below this (in seconds) are not gated")
+	p.add_argument("-i", "--import-time", action="store_true", help="Measures the import time of the paml modules instead")
+	p.add_argument("--depth-scaling", action="store_true", help="Checks that formatting scales linearly with the nesting depth instead")
+	args    = p.parse_args(arguments)
+	if args.depth_scaling:
+		results, failures = depthScaling(repeat=args.repeat)
+		return (json.dumps(results, indent=1) + "\n" if args.json else reportScaling(results, failures), 1 if failures else 0)
+	if args.import_time:
+		results = [importTime(_, args.repeat) for _ in IMPORT_MODULES]
+		return (json.dumps(results, indent=1) + "\n" if args.json else reportImportTime(results), 0)
+	formats = tuple(args.formats or FORMATS)
+	corpora = getFixtures(args.files) + (getCorpora(args.scale) if args.generated else [])
+	results = [benchmark(_, args.repeat, formats, args.memory) for _ in corpora]
+	status  = 0
+	output  = json.dumps(results, indent=1) + "\n" if args.json else report(results, formats)
+	if args.save:
+		save(args.save, results)
+	if args.compare:
+		text, regressions = compare(results, load(args.compare), args.threshold, args.memory_threshold, args.min_time)
+		output += "\n" + text
+		status  = 1 if regressions else 0
+	return (output, status)
+
+# -----------------------------------------------------------------------------
+#
+# MAIN
+#
+# -----------------------------------------------------------------------------
+
+if __name__ == "__main__":
+	output, status = run(sys.argv[1:])
+	sys.stdout.write(output)
+	sys.exit(status)
+
+# EOF - vim: tw=80 ts=4 sw=4 noet
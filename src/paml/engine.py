@@ -10,25 +10,49 @@
 # Last mod.         :   08-Dec-2016
 # -----------------------------------------------------------------------------
 
-import os, sys, re, string, json, time, glob, tempfile, argparse, types, xml.dom
+# NOTE: The modules that are only needed by some code paths (`json`,
+# `glob`, `tempfile`, `argparse`, `xml.dom`, `reporter`, `deparse`) are
+# imported where they are used, as `paml` is typically invoked many times
+# by build scripts and the imports are a large share of its startup time.
+import os, sys, re, string, time, types, codecs, threading, collections
 from functools import reduce
 IS_PYTHON3 = sys.version_info[0] > 2
-
-try:
-	import reporter
-	logging = reporter.bind("paml")
-except:
-	import logging
-
-try:
-	# We try to use `deparse` if it's available
-	import deparse
-except:
-	deparse = None
+LOGGER     = None
+
+DEFAULT_ENCODING  = "utf8"
+FALLBACK_ENCODING = "latin-1"
+# The size of the chunks in which streamed files are read
+STREAM_CHUNK      = 64 * 1024
+# NOTE: The UTF-32 marks must come first as `BOM_UTF32_LE` starts with
+# `BOM_UTF16_LE`.
+BOMS = (
+	(codecs.BOM_UTF32_LE, "utf-32"),
+	(codecs.BOM_UTF32_BE, "utf-32"),
+	(codecs.BOM_UTF8,     "utf-8-sig"),
+	(codecs.BOM_UTF16_LE, "utf-16"),
+	(codecs.BOM_UTF16_BE, "utf-16"),
+)
+RE_NON_ASCII = re.compile(b"[\x80-\xff]")
+RE_DECLARED_ENCODING = re.compile(
+	b"[ \t\f]*(?:<\\?xml[^>]*encoding=[\"']([-_.A-Za-z0-9]+)[\"']|#.*?coding[:=][ \t]*([-_.A-Za-z0-9]+))"
+)
 
 __version__    = "0.8.4"
 PAMELA_VERSION = __version__
 
+def getLogger():
+	"""Returns the logger, bound with `reporter` when it is available
+	and using `logging` otherwise."""
+	global LOGGER
+	if LOGGER is None:
+		try:
+			import reporter
+			LOGGER = reporter.bind("paml")
+		except:
+			import logging
+			LOGGER = logging
+	return LOGGER
+
 # TODO: Add an option to start a sugar compilation server and directly query
 # it, maybe using ZMQ.
 
@@ -44,6 +68,170 @@ def ensure_bytes( t, encoding="utf8" ):
 	else:
 		return t
 
+def detect_encoding( data ):
+	"""Returns the encoding declared by the given data (`bytes` or any
+	buffer, like an `mmap`), looking first for a byte order mark and then
+	for an `<?xml encoding=...?>` processing instruction or a
+	`# -*- coding: ... -*-` comment on the first two lines. Returns `None`
+	when no (known) encoding is declared."""
+	head = bytes(data[:4])
+	for bom, encoding in BOMS:
+		if head.startswith(bom):
+			return encoding
+	for line in bytes(data[:1024]).split(b"\n")[:2]:
+		match = RE_DECLARED_ENCODING.match(line)
+		if match:
+			try:
+				return codecs.lookup(ensure_unicode(match.group(1) or match.group(2), "ascii")).name
+			except LookupError:
+				pass
+	return None
+
+def decode_buffer( data, encoding=None, path=None ):
+	"""Decodes the given data (`bytes` or any buffer, like an `mmap`) in
+	one go and returns `(text, encoding)`. The encoding is the given one,
+	or the one declared by the data (see `detect_encoding`), and otherwise
+	defaults to UTF-8. Undeclared data that is not valid UTF-8 is decoded
+	as `FALLBACK_ENCODING`, unless it is mostly UTF-8, in which case the
+	few invalid sequences are replaced, with a warning giving the `path`
+	and the byte offset of the first one."""
+	encoding = encoding or detect_encoding(data)
+	if encoding:
+		return str(data, encoding), encoding
+	try:
+		return str(data, DEFAULT_ENCODING), DEFAULT_ENCODING
+	except UnicodeDecodeError as e:
+		offset = e.start
+	if is_mostly_utf8(data):
+		text = str(data, DEFAULT_ENCODING, "replace")
+		getLogger().warning("{0}: invalid {1} sequence at byte {2}, replaced".format(path or "<buffer>", DEFAULT_ENCODING, offset))
+		return text, DEFAULT_ENCODING
+	else:
+		return str(data, FALLBACK_ENCODING), FALLBACK_ENCODING
+
+def is_mostly_utf8( data ):
+	"""Tells if the given data, which is not valid UTF-8, has at least ten
+	valid non-ASCII UTF-8 characters per invalid sequence."""
+	text     = str(data, DEFAULT_ENCODING, "replace")
+	invalid  = text.count(u"\ufffd")
+	non_ascii = len(text) - len(text.encode("ascii", "ignore")) - invalid
+	return non_ascii >= 10 * invalid
+
+def read_file( path, useMmap=False ):
+	"""Reads and decodes the whole file at the given path with
+	`decode_buffer`, returning `(text, encoding)`. With `useMmap`, the file
+	is memory-mapped and decoded straight from the mapping, which avoids
+	an intermediate copy of its bytes."""
+	with open(path, "rb") as f:
+		if useMmap:
+			import mmap
+			try:
+				data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+			except ValueError:
+				# NOTE: Empty files cannot be mapped
+				return u"", DEFAULT_ENCODING
+			try:
+				return decode_buffer(data, path=path)
+			finally:
+				data.close()
+		else:
+			return decode_buffer(f.read(), path=path)
+
+def iter_lines( text ):
+	"""Yields the lines of the given text, each with its trailing `\\n`
+	(except for the last one), splitting like `readlines()` does on a
+	binary file, so that `\\r\\n` endings are preserved."""
+	start  = 0
+	end    = len(text)
+	find   = text.find
+	while start < end:
+		eol = find("\n", start) + 1
+		if not eol:
+			yield text[start:]
+			return
+		yield text[start:eol]
+		start = eol
+
+def guess_chunk_encoding( chunk ):
+	"""Returns the encoding of the given chunk of undeclared data, which is
+	UTF-8 when it is valid or mostly UTF-8 (see `is_mostly_utf8`), and
+	`FALLBACK_ENCODING` otherwise. The chunk may end with an incomplete
+	UTF-8 sequence."""
+	try:
+		codecs.getincrementaldecoder(DEFAULT_ENCODING)().decode(chunk)
+		return DEFAULT_ENCODING
+	except UnicodeDecodeError:
+		return DEFAULT_ENCODING if is_mostly_utf8(chunk) else FALLBACK_ENCODING
+
+def iter_file_lines( stream, path=None, chunkSize=STREAM_CHUNK ):
+	"""Yields the lines of the given binary stream like `iter_lines`, but
+	reads and decodes the stream incrementally, one chunk at a time. A
+	declared encoding is detected from the first chunk (see
+	`detect_encoding`). Otherwise, as ASCII is decoded the same way in
+	UTF-8 and `FALLBACK_ENCODING`, the encoding is only chosen at the first
+	chunk with a non-ASCII byte, like `decode_buffer` does for a whole
+	buffer. Invalid sequences are replaced, with a warning giving their
+	byte offset."""
+	# NOTE: The first chunk must hold what `detect_encoding` looks at
+	chunk    = stream.read(max(chunkSize, 1024))
+	encoding = detect_encoding(chunk)
+	decoder  = codecs.getincrementaldecoder(encoding)() if encoding else None
+	offset   = 0
+	pending  = []
+	while True:
+		final = not chunk
+		if decoder is None and not chunk.isascii():
+			# NOTE: We guess the encoding from at least 1024 bytes after the
+			# first non-ASCII one, as `decode_buffer` would from the file.
+			start = RE_NON_ASCII.search(chunk).start()
+			while len(chunk) - start < 1024:
+				more = stream.read(chunkSize)
+				if not more: break
+				chunk += more
+			encoding = guess_chunk_encoding(chunk[start:])
+			decoder  = codecs.getincrementaldecoder(encoding)()
+		if decoder is None:
+			text = chunk.decode("ascii")
+		else:
+			state = decoder.getstate()
+			try:
+				text = decoder.decode(chunk, final)
+			except UnicodeDecodeError as e:
+				# NOTE: The decoder input starts with the bytes it had buffered
+				getLogger().warning("{0}: invalid {1} sequence at byte {2}, replaced".format(path or "<stream>", encoding, offset + e.start - len(state[0])))
+				decoder.setstate(state)
+				decoder.errors = "replace"
+				text = decoder.decode(chunk, final)
+				decoder.errors = "strict"
+		offset += len(chunk)
+		start   = 0
+		eol     = text.find("\n") + 1
+		while eol:
+			if pending:
+				pending.append(text[start:eol])
+				yield u"".join(pending)
+				pending = []
+			else:
+				yield text[start:eol]
+			start = eol
+			eol   = text.find("\n", start) + 1
+		if start < len(text):
+			pending.append(text[start:])
+		if final:
+			break
+		chunk = stream.read(chunkSize)
+	if pending:
+		yield u"".join(pending)
+
+def file_signature( path ):
+	"""Returns an `(mtime, size)` couple used to detect changes to the file
+	at the given path, or `None` if the file does not exist."""
+	try:
+		stat = os.stat(path)
+	except OSError:
+		return None
+	return (stat.st_mtime, stat.st_size)
+
 def flatten(l, result=None):
 	result = result or []
 	[result.extend(flatten(_)) if isinstance(_,list) or isinstance(_,tuple) else result.append(_) for _ in l]
@@ -88,6 +276,17 @@ RE_EMPTY       = re.compile("^\s*$")
 RE_DECLARATION = re.compile("^@(%s):?" % (SYMBOL_NAME))
 RE_ELEMENT     = re.compile("^%s" % (SYMBOL_ELEMENT))
 RE_INLINE      = re.compile("%s" % (SYMBOL_ELEMENT))
+# An inline element along with its text content, up to the closing `>`. This
+# is `SYMBOL_ELEMENT` with named groups, so that the parts of the element
+# are known without parsing it again (see `Parser._parseInlineElement`).
+RE_CONTENT     = re.compile("(?P<element><(?P<head>%s(%s)?|%s)(?P<attributes>%s)?(?P<hints>%s)?(?P<embed>%s)?\:?)(?P<text>[^>]*)(?P<closing>>)?" % (
+	SYMBOL_NAME,
+	SYMBOL_ID_CLS,
+	SYMBOL_ID_CLS,
+	SYMBOL_ATTRS,
+	SYMBOL_HINTS,
+	SYMBOL_CONTENT
+))
 RE_MACRO       = re.compile("^(\s)*(@\w+(:\w+)?)\s*\(([^\)]+)\)\s*$")
 RE_INCLUDE     = re.compile("^(\s)*%include (.+)$")
 RE_USE         = re.compile("^(\s)*%use\s+#([A-Za-z0-9_\-]+)(\.\w+)?(\s+(\d+)x(\d+))?$")
@@ -97,6 +296,8 @@ RE_LEADING_TAB = re.compile("\t*")
 RE_LEADING_SPC = re.compile("[ ]*")
 RE_SPACE       = re.compile("[\s\n]")
 RE_XML_COMMENT = re.compile("^(\s)*\<\!\-\-(([^\-]|\-[^\-]|\-\-[^\>])+)\-\-\>\s*$")
+RE_NAME_ONLY   = re.compile("[\w\d_-]+\Z")
+RE_XML_NAME    = re.compile("^[^\W\d][\w\-\.:]*$", re.UNICODE)
 # TODO: Support numerical entities
 # RE_ENTITY      = re.compile("&[A-Za-z];")
 
@@ -203,8 +404,11 @@ HTML_EXCEPTIONS = {
 # -----------------------------------------------------------------------------
 
 class Macro:
-	"""A collection of macros used by the parser. The `CATALOGUE` can
-	be updated live to register more macros."""
+	"""A collection of macros used by the parser. The `CATALOGUE` is
+	the default set of macros of every parser, use `Parser.defineMacro`
+	to register macros for a specific parser, or pass `macros` to an
+	`Engine`. Updating the `CATALOGUE` live affects every parser sharing
+	it, and is not safe while other threads are rendering."""
 
 	CSS_PATTERNS = (
 		"src/pcss/{0}.pcss",
@@ -263,6 +467,7 @@ class Macro:
 		```
 
 		"""
+		import glob
 		for p in paths:
 			p = p.format(name)
 			l = glob.glob(p)
@@ -324,6 +529,7 @@ class Macro:
 		paths defined by `JS` for the given `name`s and
 		replaces them by `<script>` tags."""
 		# SEE: http://stackoverflow.com/questions/1918996/how-can-i-load-my-own-js-module-with-goog-provide-and-goog-require#2007296
+		import json, deparse
 		loaded = []
 		# We get the module names, and resolve them to files using deparse
 		# FIXME: This is quite slow, we should try to factor this out as a
@@ -399,6 +605,151 @@ class Macro:
 		"import:js"       :ImportJS,
 	}
 
+# -----------------------------------------------------------------------------
+#
+# INCLUDE TEMPLATES
+#
+# -----------------------------------------------------------------------------
+
+class IncludeTemplate:
+	"""An included PAML file compiled into a list of lines, where each line
+	containing `$NAME` or `${NAME}` placeholders is pre-split into literal
+	parts and substitution slots. The substitutions are applied to the
+	source lines (before parsing) as they can change the structure of the
+	included PAML, but rendering the template with a new set of variables
+	only needs to splice the values in the slots.
+
+	Compiled templates are kept in the `CACHE`, and are recompiled when the
+	`mtime` or size of the file changes. Like the `Fragment.CACHE`, the
+	cache keeps at most `LIMIT` templates, evicting the least recently used
+	ones."""
+
+	CACHE = collections.OrderedDict()
+	LIMIT = 512
+	LOCK  = threading.Lock()
+
+	@classmethod
+	def Get( cls, path ):
+		"""Returns the compiled template for the file at the given path,
+		compiling it if it is not in the cache or if it has changed."""
+		signature = file_signature(path)
+		with cls.LOCK:
+			template = cls.CACHE.get(path)
+			if template and template.signature == signature:
+				cls.CACHE.move_to_end(path)
+				return template
+		text, _ = read_file(path)
+		# NOTE: We translate the line endings like a file opened in
+		# text mode would.
+		text  = text.replace(u"\r\n", u"\n").replace(u"\r", u"\n")
+		lines = [_ for _ in iter_lines(text) if not RE_PI.match(_)]
+		template = cls(lines, signature)
+		with cls.LOCK:
+			cls.CACHE[path] = template
+			cls.CACHE.move_to_end(path)
+			while len(cls.CACHE) > cls.LIMIT:
+				cls.CACHE.popitem(last=False)
+		return template
+
+	def __init__( self, lines, signature=None ):
+		self.lines     = lines
+		self.signature = signature
+		self.parts     = [self._compileLine(_) for _ in lines]
+
+	def _compileLine( self, line ):
+		"""Returns `None` if the line has no placeholder, or a list of
+		strings and `(name, original)` slots, following the semantics of
+		`string.Template.safe_substitute`."""
+		if "$" not in line: return None
+		parts  = []
+		offset = 0
+		for match in string.Template.pattern.finditer(line):
+			if match.start() > offset:
+				parts.append(line[offset:match.start()])
+			if match.group("escaped") is not None:
+				parts.append(string.Template.delimiter)
+			else:
+				name = match.group("named") or match.group("braced")
+				parts.append((name, match.group()) if name else match.group())
+			offset = match.end()
+		if offset < len(line):
+			parts.append(line[offset:])
+		return parts
+
+	def render( self, substitutions=None ):
+		"""Returns the lines of the template with the given substitutions
+		applied. Placeholders without a substitution are left as-is, and
+		values are converted with `str`, like `safe_substitute` does."""
+		if not substitutions: return self.lines
+		result = []
+		for line, parts in zip(self.lines, self.parts):
+			if parts is None:
+				result.append(line)
+			else:
+				result.append(u"".join(
+					_ if isinstance(_, str) else (str(substitutions[_[0]]) if _[0] in substitutions else _[1])
+					for _ in parts
+				))
+		return result
+
+class Fragment:
+	"""The parsed content of an included PAML file, which is spliced into
+	the including document instead of re-reading and re-parsing the file.
+
+	A fragment is made of the `prefix` nodes that are added to the current
+	element before the included content goes back to the include's
+	indentation (typically comments), the top-level `content` nodes, and
+	the `stack` of elements that are still open at the end of the file,
+	so that the including document can keep adding to them.
+
+	Fragments are kept in the `CACHE`, and are valid as long as the files
+	they depend on (the included file and its own includes) keep the same
+	signature. Fragments produced by macros are never cached across
+	renders, as macros depend on the contents of the file system. The
+	cache keeps at most `LIMIT` fragments, evicting the least recently
+	used ones first."""
+
+	CACHE = collections.OrderedDict()
+	LIMIT = 512
+	LOCK  = threading.Lock()
+
+	@classmethod
+	def Get( cls, key ):
+		with cls.LOCK:
+			fragment = cls.CACHE.get(key)
+			if fragment:
+				cls.CACHE.move_to_end(key)
+		if fragment and fragment.isValid():
+			return fragment
+		return None
+
+	@classmethod
+	def Set( cls, key, fragment ):
+		if not fragment.isVolatile:
+			with cls.LOCK:
+				cls.CACHE[key] = fragment
+				cls.CACHE.move_to_end(key)
+				while len(cls.CACHE) > cls.LIMIT:
+					cls.CACHE.popitem(last=False)
+		return fragment
+
+	def __init__( self, prefix, content, stack, override, dependencies, resetsParent=True, isSpliceable=True, isVolatile=False ):
+		self.prefix       = prefix
+		self.content      = content
+		self.resetsParent = resetsParent
+		self.stack        = stack
+		self.override     = override
+		self.dependencies = dependencies
+		self.isSpliceable = isSpliceable
+		self.isVolatile   = isVolatile
+
+	def isValid( self ):
+		"""Tells if none of the files this fragment depends on changed."""
+		for path, signature in self.dependencies.items():
+			if file_signature(path) != signature:
+				return False
+		return True
+
 # -----------------------------------------------------------------------------
 #
 # OBJECT MODEL
@@ -411,6 +762,9 @@ class Text:
 	def __init__(self, content):
 		self.content = content
 
+	def clone( self ):
+		return self.__class__(self.content)
+
 	def contentAsLines( self ):
 		return [self.content]
 
@@ -421,9 +775,84 @@ class RawText:
 	def __init__(self, content):
 		self.content = content
 
+	def clone( self ):
+		return self.__class__(self.content)
+
 	def contentAsLines( self ):
 		return [self.content]
 
+class RawFile(RawText):
+	"""A `RawText` that stands for the content of a file included as-is,
+	like non-PAML files given to `@include`. The file is kept as a reference
+	and only read when its content is needed. The content is cached in
+	`CACHE` along with the offset at which the file's bytes are the UTF-8
+	encoded content, so that an `Output` can copy them straight from the
+	file without decoding and encoding them again. The cache keeps at most
+	`LIMIT` files, evicting the least recently used ones."""
+
+	# The loaded files, as `{path:[signature, text, offset]}`, where `offset`
+	# is where the UTF-8 encoded `text` starts in the file, or `None` when
+	# the text is not the file's bytes as-is.
+	CACHE = collections.OrderedDict()
+	LIMIT = 128
+	LOCK  = threading.Lock()
+
+	@classmethod
+	def Load( cls, path ):
+		"""Returns the cache entry for the file at the given path, loading it
+		if it is not in the cache or if it has changed."""
+		signature = file_signature(path)
+		with cls.LOCK:
+			entry = cls.CACHE.get(path)
+			if entry and entry[0] == signature:
+				cls.CACHE.move_to_end(path)
+				return entry
+		with open(path, "rb") as f:
+			raw = f.read()
+		try:
+			text = None if b"\r" in raw else str(raw, DEFAULT_ENCODING)
+		except UnicodeDecodeError:
+			text = None
+		if text is None:
+			# NOTE: We translate the line endings like a file opened in
+			# text mode would.
+			text   = decode_buffer(raw, path=path)[0].replace(u"\r\n", u"\n").replace(u"\r", u"\n")
+			offset = None
+		else:
+			offset = 0
+		# We skip the XML declaration, if any
+		if text.startswith("<?xml"):
+			text = text[text.find("\n"):]
+			if offset is not None:
+				offset = len(raw) - len(text.encode(DEFAULT_ENCODING))
+		entry = [signature, text, offset]
+		with cls.LOCK:
+			cls.CACHE[path] = entry
+			cls.CACHE.move_to_end(path)
+			while len(cls.CACHE) > cls.LIMIT:
+				cls.CACHE.popitem(last=False)
+		return entry
+
+	def __init__( self, path ):
+		self.path = path
+
+	@property
+	def content( self ):
+		return self.Load(self.path)[1]
+
+	def clone( self ):
+		return self.__class__(self.path)
+
+class RawChunk(str):
+	"""Stands for the content of a `RawFile` in the output of a formatter
+	that streams to an `Output`. The string itself is the last character of
+	the content, which is all the formatter needs to know about it."""
+
+	def __new__( cls, node ):
+		chunk      = str.__new__(cls, node.content[-1:])
+		chunk.node = node
+		return chunk
+
 class Element:
 	"""Represents an element within the HTML document."""
 
@@ -455,6 +884,32 @@ class Element:
 	def append(self,n):
 		self.content.append(n)
 
+	def clone( self ):
+		"""Returns a deep copy of this element and its content. The copy is
+		done using an explicit stack, so that it works for deeply nested
+		elements."""
+		root  = self._copy()
+		stack = [(self, root)]
+		while stack:
+			source, target = stack.pop()
+			for child in source.content:
+				if isinstance(child, Element):
+					copy = child._copy()
+					stack.append((child, copy))
+				else:
+					copy = child.clone()
+				target.content.append(copy)
+		return root
+
+	def _copy( self ):
+		"""Returns a copy of this element, without its content."""
+		element = self.__class__.__new__(self.__class__)
+		element.__dict__.update(self.__dict__)
+		element.attributes    = [list(_) for _ in self.attributes]
+		element.formatOptions = list(self.formatOptions)
+		element.content       = []
+		return element
+
 	def isTextOnly( self ):
 		if len(self.content) == 0:
 			return True
@@ -496,6 +951,9 @@ class Comment(object):
 		self.isComment = True
 		self.content   = line
 
+	def clone( self ):
+		return self.__class__(self.content)
+
 	def contentAsLines( self ):
 		return [self.content]
 
@@ -505,6 +963,9 @@ class XMLComment(object):
 		self.isComment = True
 		self.content   = line
 
+	def clone( self ):
+		return self.__class__(self.content)
+
 	def contentAsLines( self ):
 		return [self.content]
 
@@ -514,6 +975,9 @@ class DocType(object):
 		self.isDocType = True
 		self.content   = line
 
+	def clone( self ):
+		return self.__class__(self.content)
+
 	def contentAsLines( self ):
 		return [self.content]
 
@@ -523,6 +987,9 @@ class ProcessingInstruction(object):
 		self.isPI = True
 		self.content   = line
 
+	def clone( self ):
+		return self.__class__(self.content)
+
 	def contentAsLines( self ):
 		return [self.content]
 
@@ -530,6 +997,261 @@ class Declaration(Element):
 	def __init__(self, name, attributes=None):
 		Element.__init__(self,name,attributes)
 
+# -----------------------------------------------------------------------------
+#
+# SERIALIZATION
+#
+# -----------------------------------------------------------------------------
+
+# The document tree is serialized as a flat, pre-order list of tuples that
+# only contain strings, integers and `None`, so that it can be stored with
+# `marshal`. Elements are encoded as
+#
+# `(NODE_ELEMENT, name, attributes, flags, mode, formatOptions, childCount)`
+#
+# and are followed by the records of their `childCount` children, while
+# the other nodes are encoded as `(NODE_*, content)`.
+
+TREE_FORMAT_VERSION = 1
+
+NODE_ELEMENT     = 0
+NODE_TEXT        = 1
+NODE_RAW_TEXT    = 2
+NODE_COMMENT     = 3
+NODE_XML_COMMENT = 4
+NODE_DOCTYPE     = 5
+NODE_PI          = 6
+NODE_RAW_FILE    = 7
+
+# The node classes, indexed by their `NODE_*` code
+NODE_TYPES = (Element, Text, RawText, Comment, XMLComment, DocType, ProcessingInstruction, RawFile)
+
+FLAG_INLINE      = 1
+FLAG_PI          = 2
+FLAG_DOCTYPE     = 4
+FLAG_COMMENT     = 8
+
+def tree_to_records( node ):
+	"""Returns the given node and its descendants as a flat tuple of
+	records."""
+	records = []
+	stack   = [node]
+	intern  = sys.intern
+	while stack:
+		node = stack.pop()
+		if isinstance(node, Element):
+			flags = (FLAG_INLINE  if node.isInline  else 0) \
+			      | (FLAG_PI      if node.isPI      else 0) \
+			      | (FLAG_DOCTYPE if node.isDoctype else 0) \
+			      | (FLAG_COMMENT if node.isComment else 0)
+			records.append((
+				NODE_ELEMENT,
+				intern(node.name),
+				tuple((intern(k), v) for k, v in node.attributes),
+				flags,
+				node.mode,
+				tuple(node.formatOptions),
+				len(node.content),
+			))
+			stack.extend(reversed(node.content))
+		elif isinstance(node, RawFile):
+			records.append((NODE_RAW_FILE, node.path))
+		else:
+			records.append((NODE_TYPES.index(node.__class__), node.content))
+	return tuple(records)
+
+def tree_from_records( records ):
+	"""Rebuilds the node (and its descendants) encoded in the given records,
+	as returned by `tree_to_records`."""
+	root  = None
+	# The stack contains the elements that still expect children, along
+	# with the number of children they expect.
+	stack = []
+	for record in records:
+		if record[0] == NODE_ELEMENT:
+			_, name, attributes, flags, mode, options, count = record
+			node = Element.__new__(Element)
+			node.name          = name
+			node.attributes    = [list(_) for _ in attributes]
+			node.content       = []
+			node.isInline      = bool(flags & FLAG_INLINE)
+			node.mode          = mode
+			node.isPI          = bool(flags & FLAG_PI)
+			node.isDoctype     = bool(flags & FLAG_DOCTYPE)
+			node.isComment     = bool(flags & FLAG_COMMENT)
+			node.formatOptions = list(options)
+		else:
+			node  = NODE_TYPES[record[0]](record[1])
+			count = 0
+		if stack:
+			parent = stack[-1]
+			parent[0].content.append(node)
+			parent[1] -= 1
+			if parent[1] == 0: stack.pop()
+		else:
+			root = node
+		if count:
+			stack.append([node, count])
+	return root
+
+def dumps( node ):
+	"""Serializes the given node (typically the document element returned
+	by `Parser.parseFileTree`) to a compact binary string."""
+	import marshal
+	return marshal.dumps((TREE_FORMAT_VERSION, tree_to_records(node)))
+
+def loads( data ):
+	"""Loads a node serialized with `dumps`. Note that formatters update
+	the nodes they format, so a loaded tree should only be formatted
+	once."""
+	import marshal
+	version, records = marshal.loads(data)
+	if version != TREE_FORMAT_VERSION:
+		raise Exception("Unsupported tree format version: {0}".format(version))
+	return tree_from_records(records)
+
+# -----------------------------------------------------------------------------
+#
+# PROFILING
+#
+# -----------------------------------------------------------------------------
+
+# The phases recorded by a `Profiler` attached to a `Parser` (and its
+# formatter). Phases are nested, so that the time spent in `PHASE_CLASSIFY`
+# (a line) includes the time spent parsing element headers and building the
+# tree for that line, while its `self` time is the time spent classifying it.
+PHASE_PARSE    = "parse"
+PHASE_CLASSIFY = "classify"
+PHASE_INCLUDE  = "include"
+PHASE_MACRO    = "macro"
+PHASE_HEADER   = "header"
+PHASE_TREE     = "tree"
+PHASE_FORMAT   = "format"
+PHASE_EMBED    = "embed"
+
+# The `Parser` methods measured by a profiler, as `{name:phase}`, where the
+# phase can be `(phase, recordIf)` for methods that are called on every line
+# but only do something when they return true.
+PROFILED_PARSER_METHODS = {
+	"parseFileTree"       : PHASE_PARSE,
+	"parseStringTree"     : PHASE_PARSE,
+	"_parseLine"          : PHASE_CLASSIFY,
+	"_parseInclude"       : (PHASE_INCLUDE, bool),
+	"_parseUse"           : (PHASE_INCLUDE, bool),
+	"_parseMacro"         : (PHASE_MACRO,   bool),
+	"_parsePAMLElement"   : PHASE_HEADER,
+	"_parseInlineElement" : (PHASE_HEADER, bool),
+}
+
+# The `Writer` methods measured by a profiler, as `{name:phase}`
+PROFILED_WRITER_METHODS = dict((_, PHASE_TREE) for _ in (
+	"onComment", "onXMLComment", "onProcessingInstruction", "onDocType",
+	"onTextAdd", "onRawTextAdd", "onRawFileAdd", "onElementStart", "onElementEnd",
+	"onDeclarationStart", "onDeclarationEnd",
+))
+
+class Profiler:
+	"""Records the number of calls and the time spent in each processing
+	phase, as well as arbitrary counters. Phases can be nested, the `time`
+	of a phase includes the time of its nested phases while its `self` time
+	excludes it.
+
+	A profiler is attached with `Parser.setProfiler`, and accumulates
+	measures until it is `reset`. Use `report` to get the measures as a
+	dictionary and `asText` to get them as a table."""
+
+	def __init__( self ):
+		self.reset()
+
+	def reset( self ):
+		# Each phase is `[count, time, self]`
+		self.phases   = {}
+		self.counters = {}
+		# Each entry is `[phase, started, nested time]`
+		self._stack   = []
+		return self
+
+	def start( self, phase ):
+		self._stack.append([phase, time.perf_counter(), 0.0])
+
+	def end( self, record=True ):
+		"""Ends the current phase. The phase is not recorded when `record` is
+		false, which is used for calls that turn out to do nothing."""
+		phase, started, nested = self._stack.pop()
+		elapsed = time.perf_counter() - started
+		if record:
+			self.record(phase, elapsed, nested)
+		elif self._stack:
+			self._stack[-1][2] += nested
+
+	def record( self, phase, elapsed, nested=0.0 ):
+		"""Records a call to the given phase that took `elapsed` seconds, out
+		of which `nested` were spent in nested phases."""
+		measure = self.phases.get(phase)
+		if not measure:
+			measure = self.phases[phase] = [0, 0.0, 0.0]
+		measure[0] += 1
+		measure[1] += elapsed
+		measure[2] += elapsed - nested
+		if self._stack:
+			self._stack[-1][2] += elapsed
+
+	def count( self, name, value=1 ):
+		self.counters[name] = self.counters.get(name, 0) + value
+
+	def wrap( self, phase, function, recordIf=None ):
+		"""Returns a function that calls the given function and records it
+		as the given phase. When given, `recordIf` is called with the result
+		to tell if the call should be recorded."""
+		def wrapper( *args, **kwargs ):
+			self.start(phase)
+			result = None
+			try:
+				result = function(*args, **kwargs)
+				return result
+			finally:
+				self.end(recordIf(result) if recordIf else True)
+		return wrapper
+
+	def instrument( self, target, methods ):
+		"""Wraps the given `{name:phase}` methods of the given object so that
+		they're recorded by this profiler. This sets instance attributes that
+		are removed by `Profiler.Uninstrument`."""
+		for name, phase in methods.items():
+			# NOTE: We always wrap the class' method, so that instrumenting
+			# twice doesn't nest the wrappers.
+			method = getattr(target.__class__, name).__get__(target)
+			if isinstance(phase, tuple):
+				setattr(target, name, self.wrap(phase[0], method, phase[1]))
+			else:
+				setattr(target, name, self.wrap(phase, method))
+		return target
+
+	@staticmethod
+	def Uninstrument( target, methods ):
+		for name in methods:
+			target.__dict__.pop(name, None)
+		return target
+
+	def report( self ):
+		"""Returns the measures as a dictionary with `phases`, mapping each
+		phase name to its `count`, `time` and `self` time (in seconds), and
+		`counters`."""
+		return dict(
+			phases   = dict((k, dict(count=v[0], time=v[1], self=v[2])) for k, v in self.phases.items()),
+			counters = dict(self.counters),
+		)
+
+	def asText( self ):
+		"""Returns the measures as a text table, sorted by decreasing `self`
+		time."""
+		lines = ["{0:<16s}  {1:>8s}  {2:>10s}  {3:>10s}".format("phase", "count", "time", "self")]
+		for name, (count, total, own) in sorted(self.phases.items(), key=lambda _: -_[1][2]):
+			lines.append("{0:<16s}  {1:>8d}  {2:>8.2f}ms  {3:>8.2f}ms".format(name, count, total * 1000, own * 1000))
+		for name in sorted(self.counters):
+			lines.append("{0:<16s}  {1:>8d}".format(name, self.counters[name]))
+		return "\n".join(lines) + "\n"
+
 # -----------------------------------------------------------------------------
 #
 # PARSER CLASS
@@ -553,8 +1275,14 @@ class Parser:
 	   spaces.
 	- 'tabsWidth', to specify the width of a tab in spaces, which is only used
 	   when the parser accepts both tabs and spaces.
+
+	A parser (and its writer and formatter) holds the state of the render
+	in progress, and must not be used by two threads at the same time. Use
+	an `Engine` to share a configuration between threads.
 	"""
 
+	SEARCH_PATHS = (".", "src/paml", "lib/paml")
+
 	# NOTE: Does not seem to be used, deprecating it
 	# @classmethod
 	# def ExpandIncludes( cls, text=None, path=None ):
@@ -585,13 +1313,58 @@ class Parser:
 		self._writer = Writer()
 		self._formatter = formatter or HTMLFormatter()
 		self._paths     = []
-		self._searchPaths = [".", "src/paml", "lib/paml"]
+		self._searchPaths = list(self.SEARCH_PATHS)
 		self._defaults  = defaults or {}
+		self.macros     = Macro.CATALOGUE
+		# The macros dictionary owned by this parser, see `defineMacro`
+		self._ownMacros = None
+		self._fragments = {}
+		self._dependencies = {}
+		self._isVolatile   = False
+		self.useFragmentCache = True
+		self.useMmap       = False
+		self.encoding      = None
+		self.profiler      = None
 
 	def setDefaults( self, defaults ):
 		self._defaults = defaults
 		return self
 
+	def defineMacro( self, name, function ):
+		"""Registers the given macro for this parser only. The macro is
+		a `function(parser, params, indent)`, see `Macro`."""
+		# NOTE: The macros are shared (with the `CATALOGUE`, an `Engine` or
+		# a parent parser) until this parser defines its own.
+		if self.macros is not self._ownMacros:
+			self.macros = self._ownMacros = dict(self.macros)
+		self.macros[name] = function
+		return self
+
+	def reset( self ):
+		"""Resets the state of this parser, its writer and its formatter so
+		that it can be reused for another render, keeping its configuration
+		(formatter, defaults, search paths, macros). This also releases the
+		references to the last parsed document."""
+		self._paths = []
+		self._startDocument()
+		if hasattr(self._formatter, "reset"):
+			self._formatter.reset()
+		return self
+
+	def setProfiler( self, profiler ):
+		"""Attaches the given `Profiler` to this parser, its writer and its
+		formatter, so that the time spent in each phase is recorded. Use
+		`None` to detach the current profiler."""
+		if self.profiler:
+			Profiler.Uninstrument(self, PROFILED_PARSER_METHODS)
+			Profiler.Uninstrument(self._writer, PROFILED_WRITER_METHODS)
+		self.profiler = profiler
+		self._formatter.profiler = profiler
+		if profiler:
+			profiler.instrument(self, PROFILED_PARSER_METHODS)
+			profiler.instrument(self._writer, PROFILED_WRITER_METHODS)
+		return self
+
 	def path( self ):
 		"""Returns the current path of the file being parsed, if any"""
 		if not self._paths or self._paths[-1] == "--":
@@ -608,36 +1381,133 @@ class Parser:
 	def parseFile( self, path ):
 		"""Parses the file with the given  path, and return the corresponding
 		HTML document."""
-		should_close = False
-		if path == "--":
-			f = sys.stdin
-		else:
-			# FIXME: File exists and is readable
-			f = open(path, "rb")
-			should_close = True
-		self._paths.append(path)
-		self._writer.onDocumentStart()
-		for l in f.readlines():
-			self._parseLine(ensure_unicode(l))
-		if should_close: f.close()
-		result = self._formatter.format(self._writer.onDocumentEnd())
-		self._paths.pop()
-		return result
+		return self._format(self.parseFileTree(path))
 
 	def parseString( self, text, path=None ):
 		"""Parses the given string and returns an HTML document."""
+		return self._format(self.parseStringTree(text, path))
+
+	def streamFile( self, path, output ):
+		"""Parses the file with the given path and writes the formatted
+		document to the given `output` file-like object as it goes. Each
+		top-level node is formatted and written as soon as the parser is
+		done with it (that is, when it goes back to its indentation) and is
+		then discarded, so that the memory used is bounded by the largest
+		top-level subtree rather than by the whole document. The output is
+		the same as `parseFile`'s, except for undeclared files that mix
+		UTF-8 and `FALLBACK_ENCODING` data, as the encoding is chosen from
+		the first non-ASCII chunk rather than from the whole file.
+
+		The file is read and decoded incrementally (see `iter_file_lines`)
+		so that it is never held in memory as a whole. When `output` is an
+		`Output`, the files included as-is are copied straight from the
+		files to the output (see `RawFile`)."""
+		self._paths.append(path)
+		try:
+			if path == "--":
+				self._stream((ensure_unicode(_) for _ in sys.stdin), output)
+			else:
+				with open(path, "rb") as f:
+					self._stream(iter_file_lines(f, path), output)
+		finally:
+			self._paths.pop()
+
+	def streamString( self, text, output, path=None ):
+		"""Like `streamFile`, but parses the given string."""
+		if path: self._paths.append(path)
+		try:
+			self._stream((_ + "\n" for _ in ensure_unicode(text).split("\n")), output)
+		finally:
+			if path: self._paths.pop()
+
+	def _stream( self, lines, output ):
+		formatter = self._formatter
+		writer    = self._writer
+		self._startDocument()
+		formatter.startStream(rawFiles=isinstance(output, Output))
+		document  = writer._document
+		content   = document.content
+		for line in lines:
+			self._parseLine(line)
+			# The top-level nodes are complete, except the last one if it
+			# is the open element at the bottom of the writer's stack.
+			count = len(content)
+			if count and writer._nodeStack and writer._nodeStack[0] is content[-1]:
+				count -= 1
+			if count:
+				nodes = content[:count]
+				del content[:count]
+				output.write(self._formatStream(formatter.formatStream, nodes))
+		writer.onDocumentEnd()
+		output.write(self._formatStream(formatter.formatStream, list(content)))
+		del content[:]
+		output.write(self._formatStream(formatter.endStream, document))
+
+	def _formatStream( self, function, value ):
+		if not self.profiler:
+			return function(value)
+		self.profiler.start(PHASE_FORMAT)
+		try:
+			return function(value)
+		finally:
+			self.profiler.end()
+
+	def _format( self, document ):
+		if not self.profiler:
+			return self._formatter.format(document)
+		self.profiler.start(PHASE_FORMAT)
+		try:
+			return self._formatter.format(document)
+		finally:
+			self.profiler.end()
+
+	def parseFileTree( self, path ):
+		"""Parses the file with the given path, and returns the resulting
+		document element, without formatting it."""
+		self._paths.append(path)
+		try:
+			self._startDocument()
+			for line in iter_lines(self._readFile(path)):
+				self._parseLine(line)
+			return self._writer.onDocumentEnd()
+		finally:
+			self._paths.pop()
+
+	def _readFile( self, path ):
+		"""Returns the decoded content of the file at the given path, or of
+		the standard input when the path is `--`. Files are read and decoded
+		in one go, see `read_file`."""
+		if path == "--":
+			return ensure_unicode(sys.stdin.read())
+		# FIXME: File exists and is readable
+		text, self.encoding = read_file(path, self.useMmap)
+		return text
+
+	def parseStringTree( self, text, path=None ):
+		"""Parses the given string and returns the resulting document
+		element, without formatting it."""
 		if path: self._paths.append(path)
 		try:
 			text = ensure_unicode(text)
 		except UnicodeEncodeError as e:
 			# FIXME: What should we do?
 			pass
+		try:
+			self._startDocument()
+			for line in text.split("\n"):
+				self._parseLine(line + "\n")
+			return self._writer.onDocumentEnd()
+		finally:
+			if path: self._paths.pop()
+
+	def _startDocument( self ):
+		"""Resets the state that is specific to a single render and starts a
+		new document."""
+		self._elementStack = []
+		self._fragments    = {}
+		self._dependencies = {}
+		self._isVolatile   = False
 		self._writer.onDocumentStart()
-		for line in text.split("\n"):
-			self._parseLine(line + "\n")
-		res = self._formatter.format(self._writer.onDocumentEnd())
-		if path: self._paths.pop()
-		return res
 
 	def _isInEmbed( self, indent=None ):
 		"""Tells if the current element is an embed element (like
@@ -867,29 +1737,100 @@ class Parser:
 		else:
 			if not path.endswith(".paml"):
 				# If it's not a PAML file we include it as-is, skipping
-				# any processing instruction
-				with open(path,"rt") as f:
-					text = f.read()
-					if text.startswith("<?xml"):
-						text = text[text.find("\n"):]
-					self._writer.onRawTextAdd(text)
+				# any processing instruction. The file is only referenced,
+				# see `RawFile`.
+				self._writer.onRawFileAdd(path)
+			elif not parseLine and self._canSpliceFragment(indent) and self._spliceFragment(self._getFragment(path, subs, indent), indent):
+				# The included file was spliced as an already parsed fragment
+				pass
 			else:
 				self._paths.append(path)
 				p = int(indent/4) * "\t"
 				relpath = os.path.relpath(path, os.path.dirname(path))
 				#(parseLine or self._parseLine)("#START:INCLUDE[{0}]".format(relpath))
-				with open(path,'rt') as f:
-					for l in f.readlines():
-						if RE_PI.match(l): continue
-						# FIXME: This does not work when I use tabs instead
-						l = ensure_unicode(l)
-						# We do the substituion
-						if subs: l = string.Template(l).safe_substitute(**subs)
-						(parseLine or self._parseLine) (p + l)
+				# FIXME: This does not work when I use tabs instead
+				for l in IncludeTemplate.Get(path).render(subs):
+					(parseLine or self._parseLine) (p + l)
 				#(parseLine or self._parseLine)("#END:INCLUDE[{0}]".format(relpath))
 				self._paths.pop()
 		return True
 
+	def _canSpliceFragment( self, indent ):
+		"""Tells if an included file can be spliced as a `Fragment` at the
+		given indentation, which is the case when the included lines would
+		be parsed at exactly that indentation outside of any embedded
+		content."""
+		return self.useFragmentCache \
+			and int(indent/4) * self._tabsWidth == indent \
+			and self._writer.mode() is None
+
+	def _getFragment( self, path, subs, indent ):
+		"""Returns the `Fragment` for the PAML file at the given path,
+		parsing it only if it is not already in the per-render or
+		cross-render cache. Fragments are keyed on everything that
+		influences the parsing of the file."""
+		override = self._writer._override
+		bem      = self._getBEMContext(indent)
+		key      = (
+			path,
+			tuple(sorted(subs.items())) if subs else None,
+			tuple(tuple(_) for _ in override) if override else None,
+			bem,
+			tuple(sorted(self._defaults.items())),
+			tuple(self._searchPaths),
+			(self._tabsOnly, self._spacesOnly, self._tabsWidth),
+		)
+		try:
+			hash(key)
+		except TypeError:
+			# NOTE: Defaults (or substitutions) can have lists or dicts as
+			# values, in which case we key on their representation.
+			key = repr(key)
+		fragment = self._fragments.get(key) or Fragment.Get(key)
+		if not fragment:
+			fragment = Fragment.Set(key, FragmentParser(self, override, bem).parseFragment(path, subs))
+		self._fragments[key] = fragment
+		return fragment
+
+	def _spliceFragment( self, fragment, indent ):
+		"""Adds a copy of the given fragment's nodes to the current document,
+		as if the fragment's file was parsed at the given indentation.
+		Returns `False` if the fragment cannot be spliced, in which case
+		the file should be parsed line by line."""
+		if not fragment.isSpliceable: return False
+		self._dependencies.update(fragment.dependencies)
+		self._isVolatile = self._isVolatile or fragment.isVolatile
+		writer = self._writer
+		writer._override = None
+		for node in fragment.prefix:
+			writer._node().append(node.clone())
+		if fragment.resetsParent:
+			self._gotoParentElement(indent)
+			parent  = writer._node()
+			content = [_.clone() for _ in fragment.content]
+			for node in content:
+				parent.append(node)
+			# We re-open the elements that were left open at the end of the
+			# fragment, so that the following lines can add to them.
+			node = None
+			for relindent, type, mode, bem, hints in fragment.stack:
+				node = (content if node is None else node.content)[-1]
+				self._elementStack.append((indent + relindent, type))
+				writer.pushMode(mode)
+				writer._pushStack(node, bem, hints)
+		if fragment.override is not None:
+			writer.overrideAttributesForNextElement([list(_) for _ in fragment.override])
+		return True
+
+	def _getBEMContext( self, indent ):
+		"""Returns the BEM prefixes of the elements that remain open when
+		content is added at the given indentation."""
+		stack  = self._writer._bemStack
+		offset = len(stack) - len(self._elementStack)
+		return tuple(_ for _ in stack[:offset] if _) + tuple(
+			b for (i, _), b in zip(self._elementStack, stack[offset:]) if b and i < indent
+		)
+
 	def _findIncludedPath( self, path ):
 		"""Looks for the given `path` and returns the first matching one."""
 		for parent in [os.path.dirname(self.path())] + self._searchPaths:
@@ -897,6 +1838,7 @@ class Parser:
 			local_path = os.path.normpath(os.path.join(local_dir, path))
 			for p in (local_path, local_path + ".paml", path, path + ".paml"):
 				if os.path.exists(p):
+					self._dependencies[p] = file_signature(p)
 					return p
 
 	def _parseUse( self, match, indent, parseLine=None ):
@@ -922,7 +1864,8 @@ class Parser:
 		if not match: return False
 		name   = match.group(2)[1:]
 		params = match.group(4)
-		macro  = Macro.Get(name)
+		macro  = self.macros.get(name)
+		self._isVolatile = True
 		assert macro, "paml.engine: Undefined macro: {0} in {1}".format(name, match.group())
 		macro(self, params, indent)
 		return True
@@ -937,29 +1880,27 @@ class Parser:
 
 	def _parseContentLine( self, line ):
 		"""Parses a line that is data/text that is part of an element
-		content."""
+		content. The line is tokenized in a single left-to-right pass, each
+		`RE_CONTENT` match being an inline element, already split in its
+		parts, along with its text."""
+		writer = self._writer
 		offset = 0
-		# We look for elements in the content
-		while offset < len(line):
-			element = RE_INLINE.search(line, offset)
-			if not element:
-				break
-			closing = line.find(">", element.end())
+		# We look for elements in the content, which most lines don't have
+		for match in (RE_CONTENT.finditer(line) if "<" in line else ()):
+			text, closing = match.group("text", "closing")
 			# Elements must have a closing
-			if closing == -1:
+			if not closing:
 				raise Exception("Unclosed inline tag: '%s'" % (line))
-			# We prepend the text from the offset to the eleemnt
-			text = line[offset:element.start()]
-			if text:
-				self._writer.onTextAdd(text)
+			# We prepend the text from the offset to the element
+			start = match.start()
+			if start > offset:
+				writer.onTextAdd(line[offset:start])
 			# And we append the element itself
-			group = element.group()[1:]
-			name,attributes,embed, hints=self._parsePAMLElement(group)
-			self._writer.onElementStart(name, attributes, isInline=True, hints=hints)
-			text = line[element.end():closing]
-			if text: self._writer.onTextAdd(text)
-			self._writer.onElementEnd()
-			offset = closing + 1
+			name, attributes, embed, hints = self._parseInlineElement(match) or self._parsePAMLElement(match.group("element")[1:])
+			writer.onElementStart(name, attributes, isInline=True, hints=hints)
+			if text: writer.onTextAdd(text)
+			writer.onElementEnd()
+			offset = match.end()
 		# We add the remaining text
 		if offset < len(line):
 			text = line[offset:]
@@ -991,11 +1932,13 @@ class Parser:
 		list of couples '(name, value'), hints are given as a list of strings."""
 		original = element
 		if element[-1] == ":": element = element[:-1]
+		# NOTE: Most elements are just a name, which we can return as-is
+		if RE_NAME_ONLY.match(element):
+			return (element, [], None, [])
 		# We look for the attributes list
 		parens_start = element.find("(")
 		pipe_start   = element.rfind("|")
 		at_start     = element.rfind("@")
-		rest         = None
 		if parens_start != -1:
 			parens_end = element.rfind(")")
 			if at_start < parens_end: at_start = -1
@@ -1003,29 +1946,8 @@ class Parser:
 			if attributes_list[-1] == ")": attributes_list = attributes_list[:-1]
 			attributes = self._parsePAMLAttributes(attributes_list)
 			element = element[:parens_start]
-			rest    = element[parens_end:]
 		else:
 			attributes = []
-		# Useful functions to manage attributes
-		def has_attribute( name, attributes ):
-			for a in attributes:
-				if a[0] == name: return a
-			return None
-		def set_attribute( name, value, attribtues ):
-			for a in attributes:
-				if a[0] == name:
-					a[1] = value
-					return
-			attributes.append([name,value])
-		def append_attribute( name, value, attributes, prepend=False ):
-			a = has_attribute(name, attributes)
-			if a:
-				if prepend:
-					a[1] = value + " " + a[1]
-				else:
-					a[1] = a[1] + " " + value
-			else:
-				set_attribute(name, value, attributes)
 		# We take care of embeds
 		if at_start != -1:
 			embed   = element[at_start+1:]
@@ -1037,13 +1959,46 @@ class Parser:
 		if pipe_start != -1:
 			hints   = (original[pipe_start+1:].rsplit("@", 1)[0]).split("+")
 			element = element[:pipe_start]
+		return self._makePAMLElement(element, attributes, embed, hints, original)
+
+	def _parseInlineElement( self, match ):
+		"""Returns the `(name, attributes, embed, hints)` of the inline element
+		of the given `RE_CONTENT` match, like `_parsePAMLElement` but from
+		the groups of the match. This returns `None` for elements with hints,
+		or with `|` or `@` in their attributes, which are left to
+		`_parsePAMLElement`."""
+		head, attributes, hints, embed = match.group("head", "attributes", "hints", "embed")
+		if hints:
+			return None
+		elif attributes:
+			if "|" in attributes or "@" in attributes: return None
+			attributes = self._parsePAMLAttributes(attributes[1:-1])
+			# NOTE: `_parsePAMLElement` gives an empty embed when there are
+			# attributes.
+			embed      = "" if embed else None
+		else:
+			attributes = []
+			embed      = embed[1:] if embed else None
+		# NOTE: Most elements are just a name
+		if RE_NAME_ONLY.match(head):
+			return (head, attributes, embed, [])
+		return self._makePAMLElement(head, attributes, embed, [], match.group("element")[1:])
+
+	def _makePAMLElement( self, element, attributes, embed, hints, original ):
+		"""Returns the `(name, attributes, embed, hints)` of the element with
+		the given head (a name followed by ids and classes), adding the ids
+		and classes to the given attributes."""
 		# We look for the classes
 		classes = element.split(".")
 		if len(classes) > 1:
 			element = classes[0]
-			classes = classes[1:]
-			classes = " ".join( classes)
-			append_attribute("class", classes, attributes, prepend=True)
+			classes = " ".join(classes[1:])
+			for a in attributes:
+				if a[0] == "class":
+					a[1] = classes + " " + a[1]
+					break
+			else:
+				attributes.append(["class", classes])
 		else:
 			element = classes[0]
 		eid = element.split("#")
@@ -1051,8 +2006,9 @@ class Parser:
 		# and do something appropriate
 		if len(eid) > 1:
 			assert len(eid) == 2, "More than one id given: %s" % (original)
-			if has_attribute("id", attributes):
-				raise Exception("Id already given as element attribute")
+			for a in attributes:
+				if a[0] == "id":
+					raise Exception("Id already given as element attribute")
 			attributes.insert(0,["id", eid[1]])
 			element = eid[0]
 		else:
@@ -1064,23 +2020,27 @@ class Parser:
 	def _parsePAMLAttributes( self, attributes ):
 		"""Parses a string representing PAML attributes and returns a list of
 		couples '[name, value]' representing the attributes."""
+		# NOTE: We match at an offset rather than slicing the remaining
+		# attributes after each match, which would be quadratic for long
+		# attribute lists and values.
 		result = []
-		original = attributes
-		while attributes:
-			match  = RE_ATTRIBUTE.match(attributes)
-			assert match, "Given attributes are malformed: %s" % (attributes)
-			name  = match.group(1)
-			value = match.group(4)
+		match  = RE_ATTRIBUTE.match
+		offset = 0
+		end    = len(attributes)
+		while offset < end:
+			m = match(attributes, offset)
+			assert m, "Given attributes are malformed: %s" % (attributes[offset:])
+			name, value = m.group(1, 4)
 			# handles '::' syntax for namespaces
-			name = name.replace("::",":")
+			if "::" in name: name = name.replace("::",":")
 			if value and value[0] == value[-1] and value[0] in ("'", '"'):
 				value = value[1:-1]
 			result.append([name, value])
-			attributes = attributes[match.end():]
-			if attributes:
-				assert attributes[0] == ",", "Attributes must be comma-separated: %s" % (attributes)
-				attributes = attributes[1:]
-				assert attributes, "Trailing comma with no remaining attributes: %s" % (original)
+			offset = m.end()
+			if offset < end:
+				assert attributes[offset] == ",", "Attributes must be comma-separated: %s" % (attributes[offset:])
+				offset += 1
+				assert offset < end, "Trailing comma with no remaining attributes: %s" % (attributes)
 		return result
 
 	def _gotoParentElement( self, currentIndent ):
@@ -1108,6 +2068,249 @@ class Parser:
 		else:
 			return 0, line
 
+class FragmentParser( Parser ):
+	"""Parses an included file in isolation from the including document,
+	producing a `Fragment`. The fragment parser inherits the configuration
+	of the including parser, and keeps track of the files the fragment
+	depends on as well as the point where the included content first goes
+	back to the indentation of the include (`resetIndex`)."""
+
+	def __init__( self, parent, override=None, bemContext=() ):
+		Parser.__init__(self, formatter=parent._formatter, defaults=parent._defaults)
+		self._tabsOnly        = parent._tabsOnly
+		self._spacesOnly      = parent._spacesOnly
+		self._tabsWidth       = parent._tabsWidth
+		self._searchPaths     = parent._searchPaths
+		self.macros           = parent.macros
+		self._paths           = list(parent._paths)
+		self._fragments       = parent._fragments
+		self.useFragmentCache = parent.useFragmentCache
+		self.resetIndex       = None
+		self.resetIndent      = None
+		if override is not None:
+			self._writer.overrideAttributesForNextElement(override)
+		self._writer._bemStack.extend(bemContext)
+		if parent.profiler:
+			self.setProfiler(parent.profiler)
+
+	def parseFragment( self, path, subs=None ):
+		"""Parses the PAML file at the given path with the given
+		substitutions, returning a `Fragment`."""
+		self._dependencies[path] = file_signature(path)
+		self._paths.append(path)
+		for line in IncludeTemplate.Get(path).render(subs):
+			self._parseLine(line)
+		self._paths.pop()
+		writer    = self._writer
+		content   = writer._document.content
+		index     = len(content) if self.resetIndex is None else self.resetIndex
+		stack     = []
+		offset    = len(writer._bemStack) - len(self._elementStack)
+		# The fragment can only be spliced if the included content goes back
+		# to the include's indentation first, and if the open elements can
+		# be found again in the parsed content.
+		spliceable = self.resetIndent in (None, 0)
+		node       = None
+		for i, (entry, element) in enumerate(zip(self._elementStack, writer._nodeStack)):
+			children = content if node is None else node.content
+			if not children or children[-1] is not element:
+				spliceable = False
+				break
+			node = element
+			stack.append((entry[0], entry[1], writer._modes[i], writer._bemStack[offset + i], writer._hintStack[i]))
+		return Fragment(
+			content[:index], content[index:], stack, writer._override,
+			self._dependencies, self.resetIndex is not None, spliceable, self._isVolatile
+		)
+
+	def _gotoParentElement( self, currentIndent ):
+		if self.resetIndex is None:
+			self.resetIndex  = len(self._writer._document.content)
+			self.resetIndent = currentIndent
+		Parser._gotoParentElement(self, currentIndent)
+
+class IncrementalDocument:
+	"""Keeps the parsed tree of a PAML document along with the element
+	created by each of its lines, so that when the document is edited, only
+	the innermost element enclosing the changed lines is re-parsed and
+	spliced into the tree. This is used by `paml-web` to avoid re-parsing
+	whole documents (and their includes) on every edit.
+
+	The element is re-parsed in context: the header lines of its ancestors
+	are parsed first, so that BEM prefixes and embedding modes are the
+	same as when parsing the whole document. When the change cannot be
+	isolated (for instance when it changes the indentation structure of the
+	enclosing element), the whole document is parsed again."""
+
+	def __init__( self, path=None ):
+		self.path         = path
+		self.lines        = None
+		self.tree         = None
+		self.key          = None
+		# The element created by each line, or `None`
+		self.nodes        = None
+		# Maps elements to their `(line, parent element)`
+		self.headers      = {}
+		self.dependencies = {}
+		self.isVolatile   = False
+
+	def parse( self, parser, text ):
+		"""Parses the given text using the given parser, re-using as much as
+		possible of the previous parse, and returns a copy of the document
+		element (as formatters update the elements they format)."""
+		lines = [_ + "\n" for _ in ensure_unicode(text).split("\n")]
+		key   = (
+			tuple(sorted(parser._defaults.items())), tuple(parser._searchPaths),
+			parser._tabsOnly, parser._spacesOnly, parser._tabsWidth,
+		)
+		if not (self.tree and key == self.key and self.isValid() and self._update(parser, lines)):
+			self._parseAll(parser, lines)
+		self.key = key
+		return self.tree.clone()
+
+	def isValid( self ):
+		"""Tells if the previous parse can be updated, which is not the case
+		when an included file changed or when macros were used."""
+		if self.isVolatile: return False
+		for path, signature in self.dependencies.items():
+			if file_signature(path) != signature:
+				return False
+		return True
+
+	def _parseAll( self, parser, lines ):
+		if self.path: parser._paths.append(self.path)
+		try:
+			parser._startDocument()
+			self.nodes   = []
+			self.headers = {}
+			self._parseLines(parser, lines, self.nodes, self.headers, set())
+			self.tree         = parser._writer.onDocumentEnd()
+			self.lines        = lines
+			self.dependencies = dict(parser._dependencies)
+			self.isVolatile   = parser._isVolatile
+		finally:
+			if self.path: parser._paths.pop()
+
+	def _parseLines( self, parser, lines, nodes, headers, seen ):
+		"""Parses the given lines, appending the element created by each line
+		(or `None`) to `nodes`, and registering the header line and parent
+		of each created element in `headers`. The `seen` set contains the
+		elements that were already on the stack, which are not created by
+		the line that goes back to them."""
+		stack = parser._writer._nodeStack
+		for line in lines:
+			parser._parseLine(line)
+			node = stack[-1] if stack else None
+			if node is None or node in seen:
+				nodes.append(None)
+			elif RE_INCLUDE.match(line) or RE_MACRO.match(line) or isinstance(node, Declaration):
+				# Elements opened by includes and macros are not created by
+				# the line itself.
+				seen.update(stack)
+				nodes.append(None)
+			else:
+				seen.add(node)
+				nodes.append(node)
+				headers[node] = (line, stack[-2] if len(stack) > 1 else None)
+
+	def _update( self, parser, lines ):
+		"""Updates the tree by re-parsing the innermost element that encloses
+		the lines that differ from the previous parse. Returns `False` if the
+		change could not be isolated."""
+		old = self.lines
+		if lines == old: return True
+		# We find the range of lines that changed
+		start = 0
+		end   = min(len(old), len(lines))
+		while start < end and old[start] == lines[start]:
+			start += 1
+		suffix = 0
+		while suffix < end - start and old[-1 - suffix] == lines[-1 - suffix]:
+			suffix += 1
+		old_end = len(old)   - suffix
+		new_end = len(lines) - suffix
+		changed = old[start:old_end] + lines[start:new_end]
+		indent  = self._getMinimumIndent(parser, changed)
+		if indent is None:
+			# Only blank lines changed, they belong to the enclosing element
+			# of their neighbours.
+			indent = self._getMinimumIndent(parser, lines[start-1:start] + lines[new_end:new_end+1])
+		if not indent: return False
+		# We look for the enclosing element, which is the closest line before
+		# the change with a lower indentation.
+		r = start - 1
+		while r >= 0 and (self._isBlank(lines[r]) or parser._getLineIndent(lines[r])[0] >= indent):
+			r -= 1
+		if r < 0 or self.nodes[r] is None: return False
+		node     = self.nodes[r]
+		r_indent = parser._getLineIndent(lines[r])[0]
+		# And we look for the line that ends the enclosing element, which
+		# must close the element for the change to be isolated.
+		e = new_end
+		while e < len(lines) and (self._isBlank(lines[e]) or parser._getLineIndent(lines[e])[0] > r_indent):
+			e += 1
+		if e < len(lines) and not self._isResetting(lines[e]): return False
+		old_e = e + old_end - new_end
+		# Includes with overrides may leak the override to the next element
+		for line in lines[r+1:e] + old[r+1:old_e]:
+			if "+" in line and RE_INCLUDE.match(line): return False
+		# We rebuild the ancestors' header lines
+		ancestors = []
+		parent    = self.headers[node][1]
+		while parent is not None:
+			if parent not in self.headers: return False
+			ancestors.insert(0, self.headers[parent][0])
+			parent = self.headers[parent][1]
+		# And we re-parse the element in context
+		if self.path: parser._paths.append(self.path)
+		parser._startDocument()
+		for line in ancestors:
+			parser._parseLine(line)
+		parser._parseLine(lines[r])
+		stack    = parser._writer._nodeStack
+		new_node = stack[-1] if stack else None
+		nodes    = []
+		headers  = {}
+		if new_node is not None and new_node.name == node.name:
+			self._parseLines(parser, lines[r+1:e], nodes, headers, set(stack))
+		if self.path: parser._paths.pop()
+		if new_node is None or new_node.name != node.name or parser._writer._override is not None:
+			return False
+		# We splice the new content in the tree
+		node.content = new_node.content
+		for _ in self.nodes[r+1:old_e]:
+			if _ is not None: del self.headers[_]
+		for _, (line, parent) in headers.items():
+			self.headers[_] = (line, node if parent is new_node else parent)
+		self.nodes[r+1:old_e] = nodes
+		self.lines = lines
+		self.dependencies.update(parser._dependencies)
+		self.isVolatile = self.isVolatile or parser._isVolatile
+		return True
+
+	def _getMinimumIndent( self, parser, lines ):
+		indent = None
+		for line in lines:
+			if self._isBlank(line): continue
+			i      = parser._getLineIndent(line)[0]
+			indent = i if indent is None else min(indent, i)
+		return indent
+
+	def _isBlank( self, line ):
+		"""Tells if the line is empty or a comment that is ignored by the
+		parser."""
+		if RE_EMPTY.match(line): return True
+		comment = RE_COMMENT.match(line.lstrip())
+		return bool(comment) and not comment.group(1).strip().startswith(("START:", "END:"))
+
+	def _isResetting( self, line ):
+		"""Tells if the given line closes the elements that have the same or
+		a greater indentation, which is the case of elements and text."""
+		text = line.lstrip()
+		return not (RE_PI.match(text) or RE_DOCTYPE.match(text) or RE_XML_COMMENT.match(text)
+			or RE_INCLUDE.match(line) or RE_USE.match(line) or RE_MACRO.match(line)
+			or RE_COMMENT.match(text))
+
 # -----------------------------------------------------------------------------
 #
 # FORMATTING FUNCTION (BORROWED FROM LAMBDAFACTORY MODELWRITER MODULE)
@@ -1116,6 +2319,58 @@ class Parser:
 
 RE_SPACES = re.compile("\s")
 
+# The types of elements returned by `HTMLFormatter._startElement`
+T_INLINE      = "IN"
+T_SINGLE_LINE = "SL"
+T_BLOCK       = "BL"
+
+# The flags that affect the formatting of text, as returned by
+# `HTMLFormatter.getTextFlags`.
+TEXT_FLAGS = (
+	FORMAT_PRESERVE,
+	FORMAT_NORMALIZE,
+	FORMAT_STRIP,
+	FORMAT_SINGLE_LINE,
+	FORMAT_COMPACT,
+	FORMAT_XSL,
+	FORMAT_WRAP,
+)
+
+def indent_text( text, prefix="", start=True, end=False ):
+	"""Prefixes each line of the given text with `prefix` (except the first
+	one when `start` is `False`), dropping the trailing EOL if any and adding
+	one when `end` is `True`. See `HTMLFormatter.indentString`."""
+	if not text:
+		return "\n" if end else ""
+	if text[-1] == "\n":
+		text = text[:-1]
+	if prefix:
+		text = text.replace("\n", "\n" + prefix)
+		if start: text = prefix + text
+	return text + "\n" if end else text
+
+def create_text_transform( preserve, normalize, strip, singleLine, compact, xsl ):
+	"""Returns a `transform(text, prefix)` function that applies all the
+	text formatting steps of `HTMLFormatter.writeText` for the given
+	flags in one go."""
+	escape = not preserve
+	normalize, strip = escape and normalize, escape and strip
+	indent = escape and not singleLine
+	start  = end = not compact
+	def transform( text, prefix ):
+		if escape:
+			text = text.replace("<", "&lt;").replace(">", "&gt;")
+		if normalize:
+			text = RE_SPACES.sub(" ", text)
+		if strip:
+			text = text.strip("\t\n ")
+		if indent:
+			text = indent_text(text, prefix, start, end)
+		if xsl:
+			text = xsl_escape(text)
+		return text
+	return transform
+
 class HTMLFormatter:
 	"""Formats the elements of the PAML object model. A formatter really acts
 	as a state machine, and keeps track of the various formatting hints bound to
@@ -1132,6 +2387,9 @@ class HTMLFormatter:
 
 	"""
 
+	# The text transforms created by `create_text_transform`, by flags
+	TEXT_TRANSFORMS = {}
+
 	def __init__( self, strict=False ):
 		"""Creates a new formatter."""
 		self.indent = 0
@@ -1139,12 +2397,20 @@ class HTMLFormatter:
 		# as the HTML is going to be minified anyway.
 		self.indentValue = ""
 		self.textWidth = 80
-		# FIXME
-		self.defaults = {}
+		# NOTE: The defaults are shared with `HTML_DEFAULTS` until
+		# `setDefaults` is called, which copies them first.
 		self.defaults = HTML_DEFAULTS
 		self.flags    = [[]]
+		# The levels at which each flag is defined, see `findFlag`
+		self._flagLevels = {}
+		# The top-level text pending while streaming, see `formatStream`
+		self._streamText = []
+		self.rawFiles    = False
 		self.useProcessCache = True
 		self.strict          = strict
+		self.profiler        = None
+		# The already processed content of embedded elements, by `id`
+		self.precompiled     = {}
 		self._init()
 
 	def _init( self ):
@@ -1156,6 +2422,8 @@ class HTMLFormatter:
 		assert type(formatOptions) in (list, tuple)
 		for f in formatOptions:
 			assert f in FORMAT_OPTIONS, "Unknown formatting option: %s" % (f)
+		if self.defaults is HTML_DEFAULTS:
+			self.defaults = dict(HTML_DEFAULTS)
 		self.defaults[element] = list(formatOptions)
 
 	def getDefaults( self, elementName ):
@@ -1178,6 +2446,7 @@ class HTMLFormatter:
 			self.setFlags(FORMAT_NORMALIZE)
 		if flag not in self.flags[-1]:
 			self.flags[-1].append(flag)
+			self._flagLevels.setdefault(flag, []).append(len(self.flags) - 1)
 
 	def setFlags( self, *flags ):
 		"""Set the given flags, given as varargs."""
@@ -1185,7 +2454,10 @@ class HTMLFormatter:
 
 	def popFlags( self ):
 		"""Pops the given flags from the flags queue."""
-		self.flags.pop()
+		for flag in self.flags.pop():
+			levels = self._flagLevels[flag]
+			levels.pop()
+			if not levels: del self._flagLevels[flag]
 
 	def hasFlag( self, flag ):
 		"""Tells if the given flag is currently defined."""
@@ -1197,6 +2469,25 @@ class HTMLFormatter:
 		else:
 			return self.findFlag(flag) != -1
 
+	def getTextFlags( self ):
+		"""Returns the `TEXT_FLAGS` as a tuple of booleans telling if each
+		flag is defined (as `hasFlag` would)."""
+		levels   = self._flagLevels
+		preserve = self.findFlag(FORMAT_PRESERVE)
+		return tuple(
+			(self.findFlag(_) > preserve) if _ == FORMAT_SINGLE_LINE else (_ in levels)
+			for _ in TEXT_FLAGS
+		)
+
+	def getTextTransform( self, flags, xsl=False ):
+		"""Returns the text transform for the given `getTextFlags`,
+		optionally applying the XSL escaping as well."""
+		key       = flags[:5] + (xsl,)
+		transform = self.TEXT_TRANSFORMS.get(key)
+		if not transform:
+			transform = self.TEXT_TRANSFORMS.setdefault(key, create_text_transform(*key))
+		return transform
+
 	def getFlags( self ):
 		"""Returns the list of defined flags, by order of definition (last flags
 		are more recent."""
@@ -1208,11 +2499,10 @@ class HTMLFormatter:
 	def findFlag( self, flag ):
 		"""Finds the level at which the given flag is defined. Returns -1 if it
 		is not found."""
-		for i in range(0, len(self.flags)):
-			j = len(self.flags) - 1 - i
-			if flag in self.flags[j]:
-				return j
-		return -1
+		# NOTE: The levels are tracked by `setFlag` and `popFlags`, so that
+		# this does not depend on the depth of the flags stack.
+		levels = self._flagLevels.get(flag)
+		return levels[-1] if levels else -1
 
 	# -------------------------------------------------------------------------
 	# MAIN FORMATTING OPERATIONS
@@ -1226,30 +2516,114 @@ class HTMLFormatter:
 		self._formatContent(document)
 		return self.endWriting()
 
+	def startStream( self, indent=0, rawFiles=False ):
+		"""Starts formatting a document whose top-level nodes are given one
+		after the other to `formatStream`, see `Parser.streamFile`. With
+		`rawFiles`, the output is returned as a list of strings and
+		`RawFile` nodes, whose content is to be copied by an `Output`."""
+		self.startWriting()
+		self.indent      = indent
+		self.rawFiles    = rawFiles
+		self._streamText = []
+
+	def formatStream( self, nodes ):
+		"""Formats the given top-level nodes of the streamed document and
+		returns the output that is complete. The result of a stream is the
+		same as what `format` returns for the whole document."""
+		self._formatNodes(nodes, self._streamText)
+		# NOTE: The last string is kept, as `_isNewLine` depends on it
+		result = self._result
+		if len(result) < 2: return u""
+		output = self._streamOutput(result[:-1])
+		del result[:-1]
+		return output
+
+	def endStream( self, document ):
+		"""Ends the streamed document and returns the remaining output."""
+		self._writeContentText(document, self._streamText)
+		self._streamText = []
+		if not self.rawFiles:
+			return self.endWriting()
+		output = self._streamOutput(self._result)
+		del self._result
+		self.rawFiles = False
+		return output
+
+	def _streamOutput( self, result ):
+		"""Returns the given output strings joined, or with `rawFiles` as
+		a list where the `RawChunk` placeholders are replaced by their
+		`RawFile`."""
+		if not self.rawFiles:
+			return u"".join(result)
+		output = []
+		text   = []
+		for _ in result:
+			if isinstance(_, RawChunk):
+				if text:
+					output.append(u"".join(text))
+					del text[:]
+				output.append(_.node)
+			else:
+				text.append(_)
+		if text:
+			output.append(u"".join(text))
+		return output
+
 	def _formatContent( self, element ):
 		"""Formats the content of the given element. This uses the formatting
 		operations defined in this class."""
-		text   = []
-		# NOTE: In this process we aggregate text elements, which are typically
-		# one text element per line. This allows proper formatting
-		for e in element.content:
-			if isinstance(e, Element):
-				if text:
-					self.writeText("".join(text))
-					text = []
-				self._formatElement(e)
-			elif isinstance(e, Text):
-				text.append(e.content)
-			elif isinstance(e, RawText):
-				self._result.append(e.content)
-			elif isinstance(e, XMLComment):
-				self._result.append(u"<!-- {0} -->\n".format(xml_escape(e.content)))
-			elif isinstance(e, ProcessingInstruction):
-				self._result.append(u"<?{0}?>\n".format(e.content))
-			elif isinstance(e, DocType):
-				self._result.append(u"<!{0}>\n".format(e.content))
+		text = []
+		self._formatNodes(element.content, text)
+		self._writeContentText(element, text)
+
+	def _formatNodes( self, nodes, text ):
+		"""Formats the given nodes from the content of an element. Nested
+		elements are formatted with an explicit stack rather than
+		recursively, so that the nesting depth of documents is not limited
+		by Python's recursion limit. The text that ends the given nodes is
+		not written but aggregated in `text`, as it may be continued."""
+		# Each frame is `[element, content iterator, text, end]`, where `end`
+		# is what `_startElement` returned for the element.
+		stack = [[None, iter(nodes), text, None]]
+		while stack:
+			frame = stack[-1]
+			text  = frame[2]
+			# NOTE: In this process we aggregate text elements, which are typically
+			# one text element per line. This allows proper formatting
+			for e in frame[1]:
+				if isinstance(e, Element):
+					if text:
+						self.writeText("".join(text))
+						del text[:]
+					end = self._startElement(e)
+					if end is not None:
+						stack.append([e, iter(e.content), [], end])
+						break
+				elif isinstance(e, Text):
+					text.append(e.content)
+				elif isinstance(e, RawText):
+					if self.rawFiles and isinstance(e, RawFile) and RawFile.Load(e.path)[2] is not None:
+						self._result.append(RawChunk(e))
+					else:
+						self._result.append(e.content)
+				elif isinstance(e, XMLComment):
+					self._result.append(u"<!-- {0} -->\n".format(xml_escape(e.content)))
+				elif isinstance(e, ProcessingInstruction):
+					self._result.append(u"<?{0}?>\n".format(e.content))
+				elif isinstance(e, DocType):
+					self._result.append(u"<!{0}>\n".format(e.content))
+				else:
+					raise Exception("Unsupported content type: %s" % (e))
 			else:
-				raise Exception("Unsupported content type: %s" % (e))
+				# The content of the element is formatted, so we close it
+				stack.pop()
+				if frame[3] is not None:
+					self._writeContentText(frame[0], text)
+					self._endElement(frame[3])
+
+	def _writeContentText( self, element, text ):
+		"""Writes the text aggregated at the end of the given element's
+		content."""
 		if text:
 			#text = "".join(map(lambda _:_.encode("utf-8"), text))
 			text  = ("\n" if self.hasFlag(FORMAT_PRESERVE) else "").join(text)
@@ -1261,21 +2635,35 @@ class HTMLFormatter:
 		"""Tells wether the given element (when considered as an inline) can
 		span one single line. It can if only it has inlines that can span
 		one line and text without EOLs as content."""
-		if isinstance(element, Text):
-			return element.content.find("\n") == -1
-		elif isinstance(element, Comment):
-			return False
-		else:
-			for c in element.content:
-				if not self._inlineCanSpanOneLine(c):
+		# NOTE: This is a depth-first traversal in document order, using an
+		# explicit stack.
+		stack = [element]
+		while stack:
+			element = stack.pop()
+			if isinstance(element, Text):
+				if element.content.find("\n") != -1:
 					return False
-			return True
+			elif isinstance(element, Comment):
+				return False
+			else:
+				stack.extend(reversed(element.content))
+		return True
 
-	# FIXME: This should probably be moved to the parser
-	# FIXME: Yes, it should DEFINITELY be moved above
 	def _formatElement( self, element ):
 		"""Formats the given element and its content, by using the formatting
 		operations defined in this class."""
+		end = self._startElement(element)
+		if end is not None:
+			self._formatContent(element)
+			self._endElement(end)
+
+	# FIXME: This should probably be moved to the parser
+	# FIXME: Yes, it should DEFINITELY be moved above
+	def _startElement( self, element ):
+		"""Processes the given element and writes its start tag (or the
+		element itself when it has no content), returning `(end tag, type)`
+		to be given to `_endElement` once its content is written, or `None`
+		when the element is complete."""
 		if isinstance(element, Comment): return self._formatComment(element)
 		attributes = element._attributesAsHTML(strict=self.strict)
 		exceptions = HTML_EXCEPTIONS.get(element.name)
@@ -1287,14 +2675,17 @@ class HTMLFormatter:
 			if not_empty != None and not content:
 				element.content.append(Text(not_empty))
 		# Does this element has any content that needs to be pre-processed?
-		if mode and mode.startswith("sugar"):
+		if id(element) in self.precompiled:
+			# The content was already processed, see `paml.aio`
+			element.content = [Text(self.precompiled.pop(id(element)))]
+		elif mode and mode.startswith("sugar"):
 			lines = element.contentAsLines()
 			version = mode[len("sugar"):]
 			import paml.web
 			source = u"".join(lines)
 			t = time.time()
 			res, _ = paml.web.processSugar(source, "", cache=self.useProcessCache, includeSource=element.mode.endswith("+source"), version=version)
-			logging.info("Parsed Sugar: {0} lines in {1:0.2f}s".format(len(lines), time.time() - t))
+			self._onProcessed("Sugar", lines, t)
 			element.content = [Text(res)]
 		elif mode in ("coffeescript", "coffee"):
 			lines = element.contentAsLines()
@@ -1302,7 +2693,7 @@ class HTMLFormatter:
 			source = u"".join(lines)
 			t = time.time()
 			res, _ = paml.web.processCoffeeScript(source, "", cache=self.useProcessCacheFalse)
-			logging.info("Parsed CoffeeScript: {0} lines in {1:0.2f}s".format(len(lines), time.time() - t))
+			self._onProcessed("CoffeeScript", lines, t)
 			element.content = [Text(res)]
 		elif mode in ("typescript", "ts"):
 			lines = element.contentAsLines()
@@ -1310,7 +2701,7 @@ class HTMLFormatter:
 			source = u"".join(lines)
 			t = time.time()
 			res, _ = paml.web.processTypeScript(source, "", cache=self.useProcessCacheFalse)
-			logging.info("Parsed TypeScript: {0} lines in {1:0.2f}s".format(len(lines), time.time() - t))
+			self._onProcessed("TypeScript", lines, t)
 			element.content = [Text(res)]
 		elif mode  in ("clevercss", "ccss"):
 			lines = element.contentAsLines()
@@ -1318,7 +2709,7 @@ class HTMLFormatter:
 			source = u"".join(lines)
 			t = time.time()
 			res, _ = paml.web.processCleverCSS(source, ".")
-			logging.info("Parsed CleverCSS: {0} lines in {1:0.2f}s".format(len(lines), time.time() - t))
+			self._onProcessed("CleverCSS", lines, t)
 			element.content = [Text(res)]
 		elif mode  in ("pythoniccss", "pcss"):
 			lines = element.contentAsLines()
@@ -1326,7 +2717,7 @@ class HTMLFormatter:
 			source = u"".join(lines)
 			t = time.time()
 			res, _ = paml.web.processPCSS(source, ".")
-			logging.info("Parsed PCSS: {0} lines in {1:0.2f}s".format(len(lines), time.time() - t))
+			self._onProcessed("PCSS", lines, t)
 			element.content = [Text(res)]
 		elif element.mode and element.mode.endswith("nobrackets"):
 			lines = element.contentAsLines()
@@ -1336,24 +2727,29 @@ class HTMLFormatter:
 			prefix = element.mode[0:0-(len("nobrackets"))]
 			suffix = ".nb"
 			if prefix: suffix = "." + prefix + suffix
+			import tempfile
 			p = tempfile.mktemp(suffix=suffix)
 			with open(p, "w") as f: f.write(source)
 			res, _ = paml.web.processNobrackets(source, p)
 			if os.path.exists(p): os.unlink(p)
-			logging.info("Parsed Nobrackets: {0} lines in {1:0.2f}s".format(len(lines), time.time() - t))
+			self._onProcessed("Nobrackets", lines, t)
 			element.content = [Text(res)]
 		elif mode == "texto":
 			lines = element.contentAsLines()
 			import texto
 			source = u"".join(lines)
+			t = time.time()
 			res    = ensure_unicode(texto.toHTML(source))
+			self._onProcessed("Texto", lines, t)
 			element.content = [Text(res)]
 			self.setFlag(FORMAT_PRESERVE)
 		elif mode == "hjson":
 			lines = element.contentAsLines()
 			import hjson
 			source = u"".join(lines)
+			t = time.time()
 			res    = ensure_unicode(hjson.dumpsJSON(hjson.loads(source)))
+			self._onProcessed("HJSON", lines, t)
 			element.content = [Text(res)]
 		elif mode == "raw":
 			text = "".join(element.contentAsLines())
@@ -1387,25 +2783,18 @@ class HTMLFormatter:
 			if element.isInline:
 				self.pushFlags(FORMAT_SINGLE_LINE)
 				self.writeTag(start)
-				self._formatContent(element)
-				self.writeTag(end)
-				self.popFlags()
+				return (end, T_INLINE)
 			# Or maybe the element has a SINGLE_LINE flag, in which case we add a
 			# newline inbetween
 			elif self.hasFlag(FORMAT_SINGLE_LINE) or element.isTextOnly():
 				self.writeTag(start)
-				self._formatContent(element)
-				self.writeTag(end)
+				return (end, T_SINGLE_LINE)
 			# Otherwise it's a normal open/closed element
 			else:
 				self.writeTag(start)
 				if not self.hasFlag(FORMAT_COMPACT) and not self.hasFlag(FORMAT_PRESERVE):
 					self.startIndent()
-				self._formatContent(element)
-				if not self.hasFlag(FORMAT_COMPACT) and not self.hasFlag(FORMAT_PRESERVE):
-					self.endIndent()
-				self.writeTag(end)
-			self.popFlags()
+				return (end, T_BLOCK)
 		# Otherwise it doesn't have any content
 		else:
 			if not self.strict and exceptions and exceptions.get("NO_CLOSING"):
@@ -1414,14 +2803,47 @@ class HTMLFormatter:
 				text =  "<%s%s />" % (element.name, attributes)
 			# And if it's an inline, we don't add a newline
 			self.writeTag(text)
+			return None
+
+	def _endElement( self, end ):
+		"""Writes the end tag returned by `_startElement`, once the content
+		of the element is written."""
+		end, type = end
+		if type == T_INLINE:
+			self.writeTag(end)
+			self.popFlags()
+		elif type == T_SINGLE_LINE:
+			self.writeTag(end)
+		else:
+			# NOTE: The flags are tested again, as the content may have
+			# changed them (see `texto`).
+			if not self.hasFlag(FORMAT_COMPACT) and not self.hasFlag(FORMAT_PRESERVE):
+				self.endIndent()
+			self.writeTag(end)
+		self.popFlags()
 
 	def _formatComment( self, comment ):
 		self.writeTag(u"<!-- {0} -->\n".format(comment.content))
 
+	def _onProcessed( self, processor, lines, started ):
+		"""Logs (and records in the profiler, if any) that the given lines of
+		embedded content were processed by the given processor, starting at
+		the given `time.time()`."""
+		elapsed = time.time() - started
+		getLogger().info("Parsed {0}: {1} lines in {2:0.2f}s".format(processor, len(lines), elapsed))
+		if self.profiler:
+			self.profiler.record(PHASE_EMBED, elapsed)
+			self.profiler.count(PHASE_EMBED + ":" + processor.lower())
+
 	# -------------------------------------------------------------------------
 	# TEXT OUTPUT COMMANDS
 	# -------------------------------------------------------------------------
 
+	# NOTE: The output is a list of strings that is joined at the end. Text
+	# continuing the current line is appended as a new (non-empty) string
+	# rather than concatenated to the last one, which would be quadratic for
+	# long lines, so `_isNewLine` only needs to look at the last string.
+
 	def _isNewLine( self ):
 		"""Tells wether the current line is a new line."""
 		if not self._result or not self._result[-1]: return False
@@ -1433,10 +2855,24 @@ class HTMLFormatter:
 			if not  self._result:
 				self._result.append("")
 			else:
-				self._result[-1] = self._result[-1] + "\n"
+				self._result.append("\n")
+
+	def reset( self ):
+		"""Resets the state of the last render, keeping the configuration."""
+		self.indent      = 0
+		self.flags       = [[]]
+		self._flagLevels = {}
+		self._result     = []
+		self._streamText = []
+		self.rawFiles    = False
+		self.precompiled = {}
 
 	def startWriting( self ):
-		self._result = []
+		# NOTE: The flags are reset as well, so that a render interrupted
+		# by an exception does not affect the next one.
+		self.flags       = [[]]
+		self._flagLevels = {}
+		self._result     = []
 
 	def startIndent( self ):
 		self.indent += 1
@@ -1448,37 +2884,32 @@ class HTMLFormatter:
 	def writeTag( self, tagText ):
 		if self._isNewLine():
 			self._result.append(self.indentAsSpaces() + tagText)
-		else:
-			if self._result:
-				self._result[-1] = self._result[-1] + tagText
-			else:
-				self._result.append(tagText)
+		elif tagText or not self._result:
+			self._result.append(tagText)
 
 	def writeText( self, text ):
 		result = self._result
-		text   = self.formatText(text)
-		if self.hasFlag(FORMAT_XSL):
-			text = xsl_escape(text)
-		if self.hasFlag(FORMAT_PRESERVE):
+		flags  = self.getTextFlags()
+		preserve, wrap = flags[0], flags[6]
+		text   = self.getTextTransform(flags, flags[5])(text, self.indentAsSpaces())
+		if preserve:
 			result.append(text)
 		else:
 			if self._isNewLine():
-				if self.hasFlag(FORMAT_WRAP):
+				if wrap:
 					#print "WRAP ",repr(self.wrapText(text))
 					result.append(self.wrapText(text))
 				else:
 					#print "INDENT ",repr(self.indentAsSpaces() + text)
 					result.append( self.indentAsSpaces() + text)
 			elif result:
-				offset = len(result[-1])
-				if self.hasFlag(FORMAT_WRAP):
+				if wrap:
 					#print "APPEND WRAP ",repr(self.wrapText(text, len(result[-1])))
-					result[-1] = result[-1] + self.wrapText(text, len(result[-1]))
-				else:
-					#print "APPEND ",repr(text)
-					result[-1] = result[-1] + text
+					text = self.wrapText(text, len(result[-1]))
+				#print "APPEND ",repr(text)
+				if text: result.append(text)
 			else:
-				if self.hasFlag(FORMAT_WRAP):
+				if wrap:
 					result.append(self.wrapText(text, len(result[-1])))
 				else:
 					result.append(text)
@@ -1486,16 +2917,7 @@ class HTMLFormatter:
 	def formatText( self, text ):
 		"""Returns the given text properly formatted according to
 		this formatted configuration."""
-		if not self.hasFlag(FORMAT_PRESERVE):
-			text = xml_escape(text)
-			if self.hasFlag(FORMAT_NORMALIZE):
-				text = self.normalizeText(text)
-			if self.hasFlag(FORMAT_STRIP):
-				text = self.stripText(text)
-			if not self.hasFlag(FORMAT_SINGLE_LINE):
-				compact = self.hasFlag(FORMAT_COMPACT)
-				text    = self.indentString(text, start=not compact, end=not compact)
-		return text
+		return self.getTextTransform(self.getTextFlags())(text, self.indentAsSpaces())
 
 	def endWriting( self ):
 		res = "".join(self._result)
@@ -1548,24 +2970,7 @@ class HTMLFormatter:
 		If 'start' is True, then the start line will be indented as well,
 		otherwise it won't. When 'end' is True, a newline is inserted at
 		the end of the resulting text, otherwise not."""
-		if indent is None: indent = self.indent
-		first_line = True
-		result     = []
-		prefix     = self.indentAsSpaces(indent)
-		lines      = text.split("\n")
-		line_i     = 0
-		for line in lines:
-			if not line and line_i == len(lines)-1:
-				continue
-			if first_line and not start:
-				result.append(line)
-			else:
-				result.append(prefix + line)
-			first_line = False
-			line_i += 1
-		result = "\n".join(result)
-		if end: result += "\n"
-		return result
+		return indent_text(text, self.indentAsSpaces(indent), start, end)
 
 	def indentAsSpaces( self, indent=None, increment=0 ):
 		"""Converts the 'indent' value to a string filled with spaces or tabs
@@ -1579,11 +2984,7 @@ class HTMLFormatter:
 
 	def stripText( self, text ):
 		"""Strips leading and trailing spaces or eols from this text"""
-		while text and text[0] in '\t\n ':
-			text = text[1:]
-		while text and text[-1] in '\t\n ':
-			text = text[:-1]
-		return text
+		return text.strip("\t\n ")
 
 	def reformatText( self, text ):
 		"""Reformats a text so that it fits a particular text width."""
@@ -1604,10 +3005,14 @@ class JSFormatter( HTMLFormatter ):
 		assert len(elements) == len(document.content) == 1, "JSHTMLFormatter can only be used with one element"
 		return self._formatContent(elements[0])
 
+	def startStream( self, indent=0, rawFiles=False ):
+		raise Exception("JSFormatter does not support streaming, use `format` instead")
+
 	def _formatContent( self, value ):
 		"""Formats the content of the given element. This uses the formatting
 		operations defined in this class."""
 		# FIXME: Should escape entities
+		import json
 		if isinstance( value, Text ):
 			return  json.dumps(value.content)
 		elif isinstance( value, Element ):
@@ -1629,13 +3034,157 @@ class JSFormatter( HTMLFormatter ):
 			assert None, "Unrecognized value type: " + str(value)
 
 class XMLFormatter( HTMLFormatter ):
+	"""Formats the PAML object model as an XML document. The markup is
+	written directly in a single pass over the tree, without building an
+	intermediate DOM. The output is the same as what `XMLDOMFormatter`
+	produces for the documents it supports, with these differences:
+
+	- raw text (typically included SVG/XML files) is passed through as-is
+	  instead of being re-parsed,
+	- attributes are written in the order they are given, where the DOM
+	  writes namespace declarations first,
+	- doctypes, an explicit `<?xml ...?>` declaration, comments and
+	  processing instructions are written, where the DOM drops the first
+	  two and fails on the others,
+	- several root elements are written (unless `check` is set), where
+	  the DOM fails.
+
+	When `check` is `True`, the formatter makes sure the result is
+	well-formed XML (valid names, a single root element, well-formed raw
+	text and processing instructions) and raises an exception otherwise.
+
+	This is the formatter of the `xml` format (`paml -t xml`, `parse`,
+	`Engine`), which `paml-web` uses for `.xml.paml` and `.xsl.paml`
+	files (see `paml.web.XML_FORMAT`)."""
+
+	DECLARATION = u'<?xml version="1.0" ?>'
+
+	def __init__( self, check=False ):
+		HTMLFormatter.__init__(self)
+		self.check = check
+
+	def format( self, document, indent=0 ):
+		self.startStream(indent)
+		return self.formatStream(document.content) + self.endStream(document)
+
+	def startStream( self, indent=0, rawFiles=False ):
+		self._declaration = self.DECLARATION
+		self._roots       = 0
+		self._started     = False
+
+	def formatStream( self, nodes ):
+		result = []
+		for node in nodes:
+			if isinstance(node, Element):
+				self._roots += 1
+				if self.check and self._roots > 1:
+					raise Exception("XML documents can only have one root element, got: <{0}>".format(node.name))
+				self._formatContent(node, result)
+			elif isinstance(node, ProcessingInstruction) and not result and not self._started and node.content.startswith("xml "):
+				# An explicit XML declaration replaces the default one
+				self._declaration = u"<?{0}?>".format(node.content)
+			elif not isinstance(node, Text) and not isinstance(node, RawText):
+				# NOTE: Top-level text is skipped, as it would not be
+				# well-formed XML.
+				self._formatContent(node, result)
+		if not result:
+			return u""
+		elif self._started:
+			return u"".join(result)
+		else:
+			# The declaration is written along with the first output
+			self._started = True
+			return self._declaration + u"".join(result)
+
+	def endStream( self, document ):
+		if self.check and not self._roots:
+			raise Exception("XML documents must have a root element")
+		return u"" if self._started else self._declaration
+
+	def _formatContent( self, value, result=None ):
+		"""Writes the given value and its descendants to the `result`
+		list, using an explicit stack so that deeply nested documents do
+		not hit the recursion limit."""
+		result = [] if result is None else result
+		check  = self.check
+		stack  = [value]
+		while stack:
+			value = stack.pop()
+			if isinstance(value, str):
+				# Closing tags are pushed as strings
+				result.append(value)
+			elif isinstance(value, Text):
+				result.append(self.escapeText(value.content))
+			elif isinstance(value, RawText):
+				if check: self._checkRawText(value.content)
+				result.append(value.content)
+			elif isinstance(value, Element):
+				if check: self._checkName(value.name)
+				if value.isPI:
+					text = u"".join(value.contentAsLines())
+					if check and "?>" in text:
+						raise Exception("Processing instruction cannot contain '?>': {0}".format(value.name))
+					result.append(u"<?{0} {1}?>".format(value.name, text) if text else u"<?{0}?>".format(value.name))
+					continue
+				result.append(u"<")
+				result.append(value.name)
+				for name, attribute in value.attributes:
+					if check: self._checkName(name)
+					result.append(u' {0}="{1}"'.format(name, self.escapeText(attribute or u"")))
+				if value.content:
+					result.append(u">")
+					stack.append(u"</{0}>".format(value.name))
+					stack.extend(reversed(value.content))
+				else:
+					result.append(u"/>")
+			elif isinstance(value, Comment) or isinstance(value, XMLComment):
+				if check and "--" in value.content:
+					raise Exception("XML comments cannot contain '--': {0}".format(value.content))
+				result.append(u"<!--{0}-->".format(value.content))
+			elif isinstance(value, ProcessingInstruction):
+				result.append(u"<?{0}?>".format(value.content))
+			elif isinstance(value, DocType):
+				result.append(u"<!{0}>".format(value.content))
+			else:
+				raise Exception("Unsupported content type: %s" % (value))
+		return result
+
+	def escapeText( self, text ):
+		"""Escapes the given text so that it can be used as XML text or
+		attribute value."""
+		if "&" in text: text = text.replace("&", "&amp;")
+		if "<" in text: text = text.replace("<", "&lt;")
+		if '"' in text: text = text.replace('"', "&quot;")
+		if ">" in text: text = text.replace(">", "&gt;")
+		return text
+
+	def _checkName( self, name ):
+		if not RE_XML_NAME.match(name):
+			raise Exception("Invalid XML name: {0}".format(repr(name)))
+
+	def _checkRawText( self, text ):
+		import xml.parsers.expat
+		parser = xml.parsers.expat.ParserCreate()
+		try:
+			parser.Parse(u"<_>{0}</_>".format(text), True)
+		except xml.parsers.expat.ExpatError as e:
+			raise Exception("Raw text is not well-formed XML: {0}".format(e))
+
+class XMLDOMFormatter( HTMLFormatter ):
+	"""Formats the PAML object model as an `xml.dom` document, optionally
+	appending the nodes to the given `root` node. Use this when you need
+	the DOM nodes, otherwise `XMLFormatter` is much faster."""
 
 	def __init__( self, document=None, root=None ):
+		import xml.dom
 		self.dom  = xml.dom.getDOMImplementation()
 		self.doc  = document or self.dom.createDocument(None, None, None)
 		self.node = None
 		self.root = root
 
+	def startStream( self, indent=0, rawFiles=False ):
+		raise Exception("XMLDOMFormatter does not support streaming, use `format` instead")
+
 	def format( self, document, indent=0 ):
 		elements = [v for v in document.content if isinstance(v, Element)]
 		for _ in elements:
@@ -1737,6 +3286,13 @@ class Writer:
 		self._node().append(node)
 		return node
 
+	def onRawFileAdd( self, path ):
+		"""Adds the content of the file at the given path, as-is, to the
+		current element."""
+		node = RawFile(path)
+		self._node().append(node)
+		return node
+
 	def onElementStart( self, name, attributes=None, isInline=False, hints=None ):
 		# We extend the override if present
 		if self._override:
@@ -1858,6 +3414,206 @@ class Writer:
 		else:
 			return None
 
+# -----------------------------------------------------------------------------
+#
+# OUTPUT
+#
+# -----------------------------------------------------------------------------
+
+class Output:
+	"""A sink for `Parser.streamFile` that writes the output encoded as
+	UTF-8 to the given binary file-like object. The files included as-is
+	(`RawFile`) are not decoded and encoded again: they are copied with
+	`os.sendfile` when the stream is backed by a file descriptor, and
+	read from the files in chunks otherwise."""
+
+	def __init__( self, stream ):
+		self.stream = stream
+		try:
+			self.fileno = stream.fileno()
+		except (AttributeError, OSError, ValueError):
+			self.fileno = None
+		self.useSendfile = self.fileno is not None and hasattr(os, "sendfile")
+
+	def write( self, output ):
+		"""Writes the given output, which is either a string or a list of
+		strings and `RawFile` nodes, as returned by `formatStream`."""
+		if isinstance(output, str):
+			if output: self.stream.write(output.encode(DEFAULT_ENCODING))
+			return
+		for chunk in output:
+			if isinstance(chunk, RawFile):
+				self.copy(chunk)
+			elif chunk:
+				self.stream.write(chunk.encode(DEFAULT_ENCODING))
+
+	def copy( self, node ):
+		"""Copies the bytes of the given `RawFile` to the stream."""
+		signature, text, offset = RawFile.Load(node.path)
+		if offset is not None:
+			if self.useSendfile and self._sendfile(node.path, signature, offset):
+				return
+			if self._copyfile(node.path, signature, offset):
+				return
+		# NOTE: The text is the file's bytes decoded, so we fall back to
+		# encoding it when the file has changed since it was loaded.
+		self.stream.write(text.encode(DEFAULT_ENCODING))
+
+	def _sendfile( self, path, signature, offset ):
+		"""Copies the file at the given path from the given `offset` with
+		`os.sendfile`, returning `False` when it cannot be used."""
+		self.stream.flush()
+		with open(path, "rb") as f:
+			# NOTE: The file might have changed since it was loaded
+			if file_signature(path) != signature:
+				return False
+			size  = signature[1]
+			start = offset
+			while offset < size:
+				try:
+					count = os.sendfile(self.fileno, f.fileno(), offset, size - offset)
+				except OSError:
+					# Some streams (like terminals) do not support `sendfile`
+					if offset != start: raise
+					self.useSendfile = False
+					return False
+				if not count:
+					f.seek(offset)
+					self._write(f, size - offset)
+					break
+				offset += count
+		return True
+
+	def _copyfile( self, path, signature, offset ):
+		"""Copies the file at the given path from the given `offset` by
+		reading it in chunks, returning `False` when it has changed."""
+		with open(path, "rb") as f:
+			if file_signature(path) != signature:
+				return False
+			f.seek(offset)
+			self._write(f, signature[1] - offset)
+		return True
+
+	def _write( self, f, count ):
+		"""Writes `count` bytes read from the given file to the stream."""
+		while count > 0:
+			data = f.read(min(count, STREAM_CHUNK))
+			if not data:
+				break
+			self.stream.write(data)
+			count -= len(data)
+
+	def flush( self ):
+		self.stream.flush()
+
+# -----------------------------------------------------------------------------
+#
+# ENGINE
+#
+# -----------------------------------------------------------------------------
+
+class Engine:
+	"""A PAML configuration that can be shared between threads. The
+	configuration is frozen when the engine is created: the defaults,
+	formatting defaults and macros are read-only mappings and the search
+	paths a tuple, so that they can be shared safely.
+
+	Each render uses its own `Parser` and formatter (see `createParser`
+	and `createFormatter`), which hold all the state of the render, so any
+	number of threads can render with the same engine at the same time.
+	Parsers are kept in a pool once released, so that they are reset and
+	reused instead of being created for every render.
+
+	>	parser = engine.acquireParser()
+	>	try:
+	>		html = parser.parseString(text, path)
+	>	finally:
+	>		engine.releaseParser(parser)
+
+	>	engine = Engine("html", defaults={"TITLE":"Hello"})
+	>	html   = engine.parseString(text, path)
+
+	Note that the `Fragment` and `IncludeTemplate` caches are global and
+	shared by all the renders, but their entries are never modified once
+	created."""
+
+	def __init__( self, format="html", defaults=None, searchPaths=None, formatDefaults=None, macros=None, tabsWidth=TAB_WIDTH, tabsOnly=False, spacesOnly=False, useFragmentCache=True, poolSize=16 ):
+		assert formatter(format), "Unsupported format: {0}".format(format)
+		self.format           = format
+		self.defaults         = types.MappingProxyType(dict(defaults or {}))
+		self.searchPaths      = tuple(searchPaths or Parser.SEARCH_PATHS)
+		self.formatDefaults   = types.MappingProxyType(dict((k, tuple(v)) for k, v in (formatDefaults or {}).items()))
+		self.macros           = types.MappingProxyType(dict(Macro.CATALOGUE, **(macros or {})))
+		self.tabsWidth        = tabsWidth
+		self.tabsOnly         = tabsOnly
+		self.spacesOnly       = spacesOnly
+		self.useFragmentCache = useFragmentCache
+		self.poolSize         = poolSize
+		self._pool            = []
+		self._poolLock        = threading.Lock()
+		# NOTE: This validates the formatting defaults early
+		self.createFormatter()
+
+	def createFormatter( self ):
+		"""Returns a new formatter for this engine's format, with the
+		engine's formatting defaults."""
+		result = formatter(self.format)
+		for element, options in self.formatDefaults.items():
+			result.setDefaults(element, options)
+		return result
+
+	def createParser( self ):
+		"""Returns a new parser configured like this engine, which can be
+		used for any number of renders by a single thread at a time."""
+		return self._configure(Parser(formatter=self.createFormatter()))
+
+	def acquireParser( self ):
+		"""Returns a parser from the pool, or a new one if the pool is
+		empty. The parser must be given back with `releaseParser`."""
+		with self._poolLock:
+			if self._pool:
+				return self._pool.pop()
+		return self.createParser()
+
+	def releaseParser( self, parser ):
+		"""Resets the given parser and puts it back in the pool, unless
+		the pool is full. Its configuration is restored, but the formatter
+		is expected to be left as it was."""
+		parser.reset()
+		self._configure(parser)
+		with self._poolLock:
+			if len(self._pool) < self.poolSize:
+				self._pool.append(parser)
+
+	def _configure( self, parser ):
+		parser._defaults        = self.defaults
+		parser._searchPaths     = list(self.searchPaths)
+		parser._tabsWidth       = self.tabsWidth
+		parser._tabsOnly        = self.tabsOnly
+		parser._spacesOnly      = self.spacesOnly
+		parser.macros           = self.macros
+		parser.useFragmentCache = self.useFragmentCache
+		return parser
+
+	def _parse( self, method, *args ):
+		parser = self.acquireParser()
+		try:
+			return getattr(parser, method)(*args)
+		finally:
+			self.releaseParser(parser)
+
+	def parseString( self, text, path=None ):
+		return self._parse("parseString", text, path)
+
+	def parseFile( self, path ):
+		return self._parse("parseFile", path)
+
+	def parseStringTree( self, text, path=None ):
+		return self._parse("parseStringTree", text, path)
+
+	def parseFileTree( self, path ):
+		return self._parse("parseFileTree", path)
+
 # -----------------------------------------------------------------------------
 #
 # COMMAND-LINE INTERFACE
@@ -1878,13 +3634,26 @@ def parse( text, path=None, format="html" ):
 	return parser.parseString(text, path=path)
 
 def run( arguments, input=None ):
+	import argparse
 	p = argparse.ArgumentParser(description="Processes PAML files")
 	p.add_argument("file",  type=str, help="File to process", nargs="?")
 	p.add_argument("-t", "--to",  dest="format", help="Converts the PAML to HTML or JavaScript", choices=("html", "js", "xml", "xhtml"))
 	p.add_argument("-d", "--def", dest="var",   type=str, action="append")
+	p.add_argument("-p", "--profile", action="store_true", help="Outputs the time spent in each phase to stderr")
+	p.add_argument("-s", "--stream", action="store_true", help="Writes each top-level element to stdout as soon as it is parsed, using bounded memory")
 	args      = p.parse_args(arguments)
 	env       = dict(_.split("=",1) for _ in args.var or ())
 	parser    = Parser(formatter=formatter(args.format), defaults=env)
+	if args.stream:
+		output = Output(sys.stdout.buffer)
+		parser.streamFile(args.file or "--", output)
+		output.flush()
+		return ""
+	if args.profile:
+		profiler = Profiler()
+		result   = parser.setProfiler(profiler).parseFile(args.file or "--")
+		sys.stderr.write(profiler.asText())
+		return result
 	return parser.parseFile(args.file or "--")
 
 # -----------------------------------------------------------------------------
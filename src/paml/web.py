@@ -11,25 +11,42 @@
 
 # TODO: Should be moved to retro
 
-import os, sys, re, json, subprocess, tempfile, hashlib, threading, mimetypes, functools
+import os, sys, re, json, time, inspect, subprocess, tempfile, hashlib, threading, mimetypes, functools, collections
 from   paml import engine
 try:
 	import retro
 	from   retro.contrib.localfiles import LocalFiles
-	from   retro.contrib.cache      import SignatureCache, MemoryCache
 	from   retro.contrib            import proxy
 except ImportError as e:
 	pass
 
 # FIXME: Should have a context
 
-SIG_CACHE       = SignatureCache ()
-MEMORY_CACHE    = MemoryCache ()
+# The default limits of the processor output caches (`SIG_CACHE` and
+# `MEMORY_CACHE`), see `BoundedCache`.
+CACHE_ENTRIES   = 1000
+CACHE_BYTES     = 64 * 1024 * 1024
+CACHE_POLICY    = "lru"
+# When set, the outdated outputs of the processors wrapped by `revalidated`
+# are served while they are recompiled in the background.
+STALE_WHILE_REVALIDATE = False
 PROCESSORS      = {}
 COMMANDS        = None
 NOBRACKETS      = None
 PAMELA_DEFAULTS = {}
 LOCKS           = {}
+DOCUMENTS       = {}
+# The `engine.Engine` (and its pool of parsers) for each PAML format
+ENGINES         = {}
+# When set, edited PAML files are incrementally re-parsed. This keeps the
+# parsed tree of every served PAML file in `DOCUMENTS`, which is why it is
+# opt-in (`--incremental`), typically when editing the files.
+INCREMENTAL     = False
+# The format used for `.xml.paml` and `.xsl.paml` files. They are written
+# by the `engine.XMLFormatter` (`xml`), unless set to `xhtml`, which uses
+# the HTML formatter as earlier versions did (it processes embedded blocks
+# and formatting hints, but does not write well-formed XML).
+XML_FORMAT      = "xml"
 PANDOC_HEADER   = """
 <!DOCTYPE html>
 <html><head>
@@ -63,13 +80,438 @@ try:
 except:
 	HAS_TEMPLATING = None
 
+# -----------------------------------------------------------------------------
+#
+# METRICS
+#
+# -----------------------------------------------------------------------------
+
+class Metrics:
+	"""A minimal thread-safe registry of counters, gauges and histograms that
+	can be exported in the Prometheus text format. Values are identified by
+	the metric name and the given labels, and metrics must be `define`d
+	before they're used."""
+
+	# The histogram buckets, in seconds
+	BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+	def __init__( self ):
+		self._lock        = threading.Lock()
+		self._definitions = {}
+		self._values      = {}
+
+	def define( self, name, type, help ):
+		"""Defines the metric with the given name, where `type` is one of
+		`counter`, `gauge` or `histogram`."""
+		assert type in ("counter", "gauge", "histogram")
+		self._definitions[name] = (type, help)
+		self._values.setdefault(name, {})
+		return self
+
+	def increment( self, name, value=1, **labels ):
+		"""Adds the given value to the given counter or gauge."""
+		key = tuple(sorted(labels.items()))
+		with self._lock:
+			values      = self._values[name]
+			values[key] = values.get(key, 0) + value
+
+	def observe( self, name, value, **labels ):
+		"""Records the given value in the given histogram."""
+		key = tuple(sorted(labels.items()))
+		with self._lock:
+			values = self._values[name]
+			# Each histogram is `[count per bucket..., sum, count]`
+			measure = values.get(key)
+			if not measure:
+				measure = values[key] = [0] * (len(self.BUCKETS) + 2)
+			for i, limit in enumerate(self.BUCKETS):
+				if value <= limit:
+					measure[i] += 1
+			measure[-2] += value
+			measure[-1] += 1
+
+	def get( self, name, **labels ):
+		"""Returns the current value of the given metric, which is a list for
+		histograms."""
+		return self._values[name].get(tuple(sorted(labels.items())))
+
+	def reset( self ):
+		with self._lock:
+			for name in self._values:
+				self._values[name] = {}
+
+	def asPrometheus( self ):
+		"""Returns the metrics in the Prometheus text exposition format."""
+		lines = []
+		with self._lock:
+			for name in sorted(self._definitions):
+				type, help = self._definitions[name]
+				lines.append("# HELP {0} {1}".format(name, help))
+				lines.append("# TYPE {0} {1}".format(name, type))
+				for key, value in sorted(self._values[name].items()):
+					if type == "histogram":
+						for i, limit in enumerate(self.BUCKETS):
+							lines.append("{0}_bucket{1} {2}".format(name, self._formatLabels(key + (("le", repr(limit)),)), value[i]))
+						lines.append("{0}_bucket{1} {2}".format(name, self._formatLabels(key + (("le", "+Inf"),)), value[-1]))
+						lines.append("{0}_sum{1} {2}".format(name, self._formatLabels(key), repr(float(value[-2]))))
+						lines.append("{0}_count{1} {2}".format(name, self._formatLabels(key), value[-1]))
+					else:
+						lines.append("{0}{1} {2}".format(name, self._formatLabels(key), value))
+		return "\n".join(lines) + "\n"
+
+	def _formatLabels( self, labels ):
+		if not labels: return ""
+		return "{" + ",".join('{0}="{1}"'.format(k, str(v).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")) for k, v in labels) + "}"
+
+METRICS = Metrics()
+METRICS.define("paml_processor_requests_total",   "counter",   "Requests handled by each processor")
+METRICS.define("paml_processor_errors_total",     "counter",   "Requests that failed in each processor")
+METRICS.define("paml_processor_in_flight",        "gauge",     "Requests currently being processed by each processor")
+METRICS.define("paml_processor_duration_seconds", "histogram", "Time spent processing requests by each processor")
+METRICS.define("paml_cache_hits_total",           "counter",   "Processor outputs found up to date in the cache")
+METRICS.define("paml_cache_misses_total",         "counter",   "Processor outputs missing or outdated in the cache")
+METRICS.define("paml_cache_invalidations_total",  "counter",   "Processor outputs discarded because their source changed")
+METRICS.define("paml_cache_evictions_total",      "counter",   "Processor outputs evicted to make room in the cache")
+METRICS.define("paml_cache_entries",              "gauge",     "Processor outputs currently in the cache")
+METRICS.define("paml_cache_bytes",                "gauge",     "Estimated size in bytes of the processor outputs in the cache")
+METRICS.define("paml_cache_failures_total",       "counter",   "Compile failures served from the cache instead of running the compiler again")
+METRICS.define("paml_cache_stale_total",          "counter",   "Outdated processor outputs served while they are recompiled")
+METRICS.define("paml_revalidations_in_flight",    "gauge",     "Processor outputs currently being recompiled in the background")
+METRICS.define("paml_revalidation_failures_total","counter",   "Background recompilations that failed, whose error is then served")
+METRICS.define("paml_subprocess_runs_total",      "counter",   "Compiler subprocesses run, by command")
+METRICS.define("paml_subprocess_failures_total",  "counter",   "Compiler subprocesses that exited with an error, by command")
+METRICS.define("paml_subprocess_in_flight",       "gauge",     "Compiler subprocesses currently running, by command")
+METRICS.define("paml_subprocess_duration_seconds","histogram", "Time spent running compiler subprocesses, by command")
+METRICS.define("paml_lock_waiting",               "gauge",     "Calls currently waiting for a processor lock")
+METRICS.define("paml_lock_wait_seconds",          "histogram", "Time spent waiting for a processor lock")
+
+def measured( name, processor ):
+	"""Wraps the given processor so that its requests, errors, latency and
+	in-flight calls are recorded in `METRICS` under the given name."""
+	def wrapper(*a, **kwa):
+		METRICS.increment("paml_processor_in_flight", 1, processor=name)
+		t = time.time()
+		try:
+			return processor(*a, **kwa)
+		except Exception as e:
+			METRICS.increment("paml_processor_errors_total", processor=name)
+			raise e
+		finally:
+			METRICS.increment("paml_processor_in_flight", -1, processor=name)
+			METRICS.increment("paml_processor_requests_total", processor=name)
+			METRICS.observe("paml_processor_duration_seconds", time.time() - t, processor=name)
+	functools.update_wrapper(wrapper, processor)
+	return wrapper
+
+# -----------------------------------------------------------------------------
+#
+# CACHE
+#
+# -----------------------------------------------------------------------------
+
+def cachedSize( value ):
+	"""Returns the estimated size of the given cached value, which is the
+	`len()` of its strings and bytes, summed over the items of tuples and
+	lists, like the `(content, type)` couples returned by processors, or
+	the `size()` of values that define it, like `CompileFailure`."""
+	if isinstance(value, (str, bytes, bytearray)):
+		return len(value)
+	elif isinstance(value, (tuple, list)):
+		return sum(cachedSize(_) for _ in value)
+	elif value is None:
+		return 0
+	elif hasattr(value, "size"):
+		return value.size()
+	else:
+		return sys.getsizeof(value)
+
+class BoundedCache:
+	"""A thread-safe in-memory cache of processor outputs, bounded both by
+	a number of entries (`limit`) and by the estimated size in bytes of
+	its values (`size`, see `cachedSize`). When a bound is exceeded, the least recently used
+	entries are evicted with the `lru` policy, and the least frequently used
+	ones with the `lfu` policy (the least recently used first on a tie).
+
+	Each entry can have a signature (like the `mtime` of its source file),
+	in which case it is only returned for the same signature and discarded
+	otherwise. Hits, misses, invalidations and evictions are counted in
+	`stats` and in `METRICS`, under the cache's `name`."""
+
+	POLICIES = ("lru", "lfu")
+
+	def __init__( self, name, limit=CACHE_ENTRIES, size=CACHE_BYTES, policy=CACHE_POLICY ):
+		self.name  = name
+		self.bytes = 0
+		self.stats = dict(hits=0, misses=0, invalidations=0, evictions=0, rejections=0, stale=0)
+		# The entries are `{key:[signature, value, size, uses]}`, ordered from
+		# the least to the most recently used.
+		self._entries = collections.OrderedDict()
+		self._lock    = threading.Lock()
+		self.configure(limit, size, policy)
+
+	def configure( self, limit=None, size=None, policy=None ):
+		"""Updates the given bounds and policy, evicting the entries that
+		no longer fit."""
+		assert policy is None or policy in self.POLICIES, "Unsupported cache policy: {0}".format(policy)
+		with self._lock:
+			self.limit  = self.limit  if limit  is None else limit
+			self.size   = self.size   if size   is None else size
+			self.policy = self.policy if policy is None else policy
+			self._evict()
+		return self
+
+	def get( self, key, signature=None, stale=False ):
+		"""Returns `(is_same, value)` for the given key and signature, where
+		`is_same` is `False` when the entry is missing or has another
+		signature, in which case it is removed. With `stale`, an entry with
+		another signature is kept and its value is returned."""
+		with self._lock:
+			entry = self._entries.get(key)
+			if entry and entry[0] != signature and stale:
+				self._entries.move_to_end(key)
+				self._count("stale", "paml_cache_stale_total")
+				return False, entry[1]
+			elif entry and entry[0] != signature:
+				self._remove(key)
+				self._count("invalidations", "paml_cache_invalidations_total")
+				entry = None
+			if not entry:
+				self._count("misses", "paml_cache_misses_total")
+				return False, None
+			entry[3] += 1
+			self._entries.move_to_end(key)
+			self._count("hits", "paml_cache_hits_total")
+			return True, entry[1]
+
+	def has( self, key, signature=None ):
+		"""Tells if there is an entry for the given key and signature, without
+		counting it as a use."""
+		with self._lock:
+			entry = self._entries.get(key)
+			return bool(entry) and entry[0] == signature
+
+	def set( self, key, value, signature=None ):
+		"""Stores the given value for the given key and signature, evicting
+		other entries as needed. Values larger than the whole cache are not
+		stored."""
+		size = cachedSize(value)
+		with self._lock:
+			self._remove(key)
+			if size > self.size:
+				self._count("rejections")
+			else:
+				self._entries[key] = [signature, value, size, 0]
+				self.bytes += size
+				METRICS.increment("paml_cache_entries", 1, cache=self.name)
+				METRICS.increment("paml_cache_bytes", size, cache=self.name)
+				self._evict(key)
+		return value
+
+	def remove( self, key ):
+		with self._lock:
+			self._remove(key)
+
+	def clear( self ):
+		with self._lock:
+			for key in list(self._entries):
+				self._remove(key)
+
+	def keys( self ):
+		with self._lock:
+			return list(self._entries.keys())
+
+	def __len__( self ):
+		with self._lock:
+			return len(self._entries)
+
+	def _remove( self, key ):
+		entry = self._entries.pop(key, None)
+		if entry:
+			self.bytes -= entry[2]
+			METRICS.increment("paml_cache_entries", -1, cache=self.name)
+			METRICS.increment("paml_cache_bytes", -entry[2], cache=self.name)
+		return entry
+
+	def _evict( self, keep=None ):
+		"""Evicts entries until the cache is within its bounds, keeping the
+		entry with the given key (the one that was just added)."""
+		while len(self._entries) > self.limit or self.bytes > self.size:
+			candidates = ((k, v) for k, v in self._entries.items() if k != keep)
+			if self.policy == "lfu":
+				# NOTE: This is linear in the number of entries, which is fine
+				# for the few thousand entries of a typical cache.
+				key = min(candidates, key=lambda _:_[1][3], default=(None,))[0]
+			else:
+				key = next(candidates, (None,))[0]
+			if key is None: break
+			self._remove(key)
+			self._count("evictions", "paml_cache_evictions_total")
+
+	def _count( self, stat, metric=None ):
+		self.stats[stat] += 1
+		if metric:
+			METRICS.increment(metric, cache=self.name)
+
+# The output of processors for files, keyed by path (and query) and
+# checked against the file's signature, and the output of processors for
+# text without a path, keyed by a hash of the command and text.
+SIG_CACHE    = BoundedCache("signature")
+MEMORY_CACHE = BoundedCache("memory")
+# The results of the processors wrapped by `revalidated`, by call, or the
+# `CompileFailure` of their last compilation. As they are called without
+# the processors' own caching, this is the only copy of their outputs.
+STALE_CACHE  = BoundedCache("stale")
+# The keys of the `STALE_CACHE` entries being recompiled
+REVALIDATING = set()
+REVALIDATING_LOCK = threading.Lock()
+
+class CompileFailure:
+	"""A compile failure, stored in the caches in place of the output so
+	that the compiler is not run again on the same input. The failure is
+	discarded along with the entry when the input changes. `data` is the
+	output of the compiler, if any, and `error` its error message.
+
+	As the `SIG_CACHE` is keyed on the path only, the failure also keeps
+	the `command` that failed, so that it is not returned for another
+	command run on the same file (see `isFor`)."""
+
+	def __init__( self, data, error, command=None ):
+		self.data    = data
+		self.error   = error
+		self.command = tuple(command or ())
+
+	def isFor( self, command ):
+		"""Tells if this failure is the result of the given command."""
+		return self.command == tuple(command or ())
+
+	def size( self ):
+		"""Returns the size of the failure for `BoundedCache`."""
+		return len(self.data or "") + len(self.error or "")
+
+	def result( self, name ):
+		"""Returns `(data, error)` like `_processCommandSteps`, or raises
+		the error when there was no output, as the original failure did."""
+		METRICS.increment("paml_cache_failures_total", command=name)
+		if self.data is None:
+			raise Exception(self.error)
+		return engine.ensure_unicode(self.data), self.error
+
+def configureCaches( limit=None, size=None, policy=None ):
+	"""Updates the bounds and eviction policy of the processor caches."""
+	for cache in (SIG_CACHE, MEMORY_CACHE, STALE_CACHE):
+		cache.configure(limit, size, policy)
+
+def revalidated( processor ):
+	"""Wraps the given processor so that, when `STALE_WHILE_REVALIDATE` is
+	set, its result is served from the `STALE_CACHE` even when its source
+	has changed. The outdated result is then recompiled by a single
+	background thread, and swapped in when it is ready. When recompiling
+	fails, the error is served instead (see `_endRevalidation`) until the
+	source changes again."""
+	def wrapper( text, path, request=None, cache=True, **options ):
+		key, signature = _getRevalidationKey(processor, path, request, options) if STALE_WHILE_REVALIDATE and cache else (None, None)
+		if not key:
+			return processor(text, path, request, cache, **options)
+		result = _getStale(processor, key, signature)
+		if result is None:
+			try:
+				result = processor(text, path, request, False, **options)
+			except Exception as e:
+				_setStaleFailure(key, signature, e)
+				raise e
+			return STALE_CACHE.set(key, result, signature)
+		if _startRevalidation(key, signature):
+			threading.Thread(
+				target=_revalidate, args=(key, signature, processor, text, path, request, options),
+				name="paml-revalidate", daemon=True
+			).start()
+		return result
+	functools.update_wrapper(wrapper, processor)
+	return wrapper
+
+def _getRevalidationKey( processor, path, request, options ):
+	"""Returns the `STALE_CACHE` key for the given processor call, along
+	with the signature of its source files, or `(None, None)` when the call
+	is not for source files (like embedded blocks)."""
+	paths = tuple(path) if isinstance(path, list) or isinstance(path, tuple) else (path,)
+	if not all(_ and os.path.isfile(_) for _ in paths):
+		return None, None
+	key   = (processor.__name__, paths, request.path() if request else None, tuple(sorted(options.items())))
+	return key, tuple(engine.file_signature(_) for _ in paths)
+
+def _getStale( processor, key, signature ):
+	"""Returns the result stored in the `STALE_CACHE` for the given key,
+	even if it is outdated, or `None` when there is none. A failure is
+	raised when it is for the given signature, and otherwise ignored as
+	there is no output to serve while recompiling."""
+	is_same, result = STALE_CACHE.get(key, signature, stale=True)
+	if isinstance(result, CompileFailure):
+		if is_same:
+			return result.result(processor.__name__)
+		result = None
+	return result
+
+def _setStaleFailure( key, signature, error ):
+	"""Stores the given compile error in the `STALE_CACHE`, unless it is an
+	`OSError`, which means the compiler could not be run."""
+	if not isinstance(error, OSError):
+		STALE_CACHE.set(key, CompileFailure(None, str(error)), signature)
+
+def _startRevalidation( key, signature ):
+	"""Tells if the revalidation of the given key can start, which is the
+	case when the entry is outdated and not already being recompiled."""
+	with REVALIDATING_LOCK:
+		if key in REVALIDATING or STALE_CACHE.has(key, signature): return False
+		REVALIDATING.add(key)
+	METRICS.increment("paml_revalidations_in_flight", 1)
+	return True
+
+def _endRevalidation( key, signature, path, result, error=None ):
+	"""Stores the recompiled result and ends the revalidation. When it
+	failed with the given error, the failure replaces the outdated result,
+	so that the error is served, and it is logged and counted in
+	`METRICS`."""
+	if error is None:
+		STALE_CACHE.set(key, result, signature)
+	else:
+		METRICS.increment("paml_revalidation_failures_total", processor=key[0])
+		engine.getLogger().warning("paml-web: revalidation failed for {0}: {1}".format(path, error))
+		_setStaleFailure(key, signature, error)
+	with REVALIDATING_LOCK:
+		REVALIDATING.discard(key)
+	METRICS.increment("paml_revalidations_in_flight", -1)
+
+def _revalidate( key, signature, processor, text, path, request, options ):
+	result = error = None
+	try:
+		# NOTE: The text given to the processor might be outdated, so we
+		# read the source again.
+		if isinstance(path, str) and os.path.isfile(path):
+			with open(path, "rt") as f:
+				text = f.read()
+		result = processor(text, path, request, False, **options)
+	except Exception as e:
+		error = e
+	finally:
+		_endRevalidation(key, signature, path, result, error)
+
+# -----------------------------------------------------------------------------
+#
+# PROCESSORS
+#
+# -----------------------------------------------------------------------------
 
 def locked(f):
 	"""Ensures that the wrapped function is not executed concurrently."""
 	def wrapper(*a, **kwa):
 		name = f.__name__
 		if name not in LOCKS: LOCKS[name] = threading.Lock()
-		lock = LOCKS[name] ; lock.acquire()
+		lock = LOCKS[name]
+		METRICS.increment("paml_lock_waiting", 1, lock=name)
+		t = time.time()
+		lock.acquire()
+		METRICS.increment("paml_lock_waiting", -1, lock=name)
+		METRICS.observe("paml_lock_wait_seconds", time.time() - t, lock=name)
 		try:
 			res = f(*a, **kwa)
 			lock.release()
@@ -79,12 +521,14 @@ def locked(f):
 			raise e
 			return None
 	functools.update_wrapper(wrapper, f)
+	# NOTE: This is copied to the wrappers of the wrapper, see `isLocked`
+	wrapper.locked = True
 	return wrapper
 
 def processPAML( pamlText, path, request=None ):
-	parser = engine.Parser()
-	parser.setDefaults(PAMELA_DEFAULTS)
 	if request and request.get("as") == "js":
+		parser = engine.Parser()
+		parser.setDefaults(PAMELA_DEFAULTS)
 		parser._formatter = engine.JSHTMLFormatter()
 		result = parser.parseString(pamlText, path)
 		assign = request.get("assign")
@@ -104,22 +548,62 @@ def processPAML( pamlText, path, request=None ):
 					suffix = "}" + suffix
 		return prefix + result + suffix, "text/javascript"
 	else:
-		type   = "text/html"
-		format = "html"
-		# FIXME: Somehow using XML does not work the same
-		if path.endswith(".xsl.paml"):
-			# NOTE: Use text/xsl does not work in FF, or Chrome for that matter.
-			# otherwise it is not parsed as an XML document.
-			# SEE: https://stackoverflow.com/questions/13752836/chrome-says-resource-interpreted-as-stylesheet-but-transferred-with-mime-type-a#21604288
-			type   = "text/xml"
-			format = "xhtml"
-		elif path.endswith(".xml.paml"):
-			type = "text/xml"
-			format = "xhtml"
-		parser._formatter = engine.formatter(format)
-		result = parser.parseString(pamlText, path)
+		format, type = getPAMLFormat(path)
+		pool   = getEngine(format)
+		parser = pool.acquireParser()
+		try:
+			if INCREMENTAL and path:
+				document, lock = getIncrementalDocument(path)
+				with lock:
+					tree = document.parse(parser, pamlText)
+				result = parser._formatter.format(tree)
+			else:
+				result = parser.parseString(pamlText, path)
+		finally:
+			pool.releaseParser(parser)
 		return result, type
 
+def getEngine( format ):
+	"""Returns the `engine.Engine` for the given format, configured with
+	the `PAMELA_DEFAULTS`. Its parsers are pooled and reused across
+	requests."""
+	if format not in ENGINES:
+		ENGINES.setdefault(format, engine.Engine(format, defaults=PAMELA_DEFAULTS))
+	return ENGINES[format]
+
+def loadDefaults( path=".paml-defaults" ):
+	"""Loads the `PAMELA_DEFAULTS` from the given JSON file, if it exists,
+	and returns them. The engines are re-created with the new defaults."""
+	global PAMELA_DEFAULTS
+	if os.path.exists(path):
+		with open(path) as f:
+			PAMELA_DEFAULTS = json.load(f)
+		ENGINES.clear()
+	return PAMELA_DEFAULTS
+
+def getPAMLFormat( path ):
+	"""Returns the `(format, content type)` of the PAML file at the given
+	path."""
+	type   = "text/html"
+	format = "html"
+	if path.endswith(".xsl.paml"):
+		# NOTE: Use text/xsl does not work in FF, or Chrome for that matter.
+		# otherwise it is not parsed as an XML document.
+		# SEE: https://stackoverflow.com/questions/13752836/chrome-says-resource-interpreted-as-stylesheet-but-transferred-with-mime-type-a#21604288
+		type   = "text/xml"
+		format = XML_FORMAT
+	elif path.endswith(".xml.paml"):
+		type = "text/xml"
+		format = XML_FORMAT
+	return format, type
+
+def getIncrementalDocument( path ):
+	"""Returns the `engine.IncrementalDocument` bound to the given path, along
+	with the lock that guards its updates."""
+	if path not in DOCUMENTS:
+		DOCUMENTS.setdefault(path, (engine.IncrementalDocument(path), threading.Lock()))
+	return DOCUMENTS[path]
+
 def processPAMLXML( pamlText, path, request=None ):
 	result, type = processPAML( pamlText, path, request )
 	return result, "text/xml" if type == "text/html" else type
@@ -129,10 +613,11 @@ def processCleverCSS( text, path, request=None ):
 	result = clevercss.convert(text)
 	return result, "text/css"
 
-def cacheGet( text, path, cache ):
+def cacheGet( text, path, cache, command=None ):
 	"""Retrieves the given data from the cache. If path is given, then
-	the `SIG_CACHE` will be used, testing the `mtime` of the file at the
-	given path.
+	the `SIG_CACHE` will be used, testing the signature (`mtime` and size)
+	of the file at the given path. Otherwise the `MEMORY_CACHE` is used,
+	keyed on the given `command` and `text`.
 
 	Note that `path` can contain a query string, which will be striped to
 	acces the mtime."""
@@ -141,28 +626,106 @@ def cacheGet( text, path, cache ):
 			# The path might have a query string, in which case we remove it
 			subpath       = path.split("?",1)[0]
 			cache         = SIG_CACHE
-			timestamp     = SignatureCache.mtime(subpath)
+			timestamp     = engine.file_signature(subpath)
 			# We get/set using the actual path, not the subpath
-			is_same, data = cache.get(path,timestamp)
+			is_same, data = cache.get(path, timestamp)
 			return cache, is_same, data, timestamp
 		else:
 			text    = engine.ensure_unicode(text)
-			sig     = hashlib.sha256(bytes(u" ".join(command) + text)).hexdigest()
+			sig     = hashlib.sha256(engine.ensure_bytes(u" ".join(command or ()) + u"\n" + text)).hexdigest()
 			cache   = MEMORY_CACHE
-			is_same = cache.has(sig)
-			data    = cache.get(sig)
+			is_same, data = cache.get(sig)
 			return cache, is_same, data, sig
 	else:
 		return cache, False, None, None
 
+def cacheSet( cache, path, key, data ):
+	"""Stores the given data in the cache returned by `cacheGet`, where `key`
+	is the key (or signature) returned by `cacheGet`."""
+	if cache is SIG_CACHE:
+		cache.set(path, data, key)
+	elif cache is MEMORY_CACHE:
+		cache.set(key, data)
+	return data
+
 # FIXME: The caching infrastructure should not be dependent on the path
 # only. For instance, we might want to cache the same file, but compiled
 # with different command (options).
 def _processCommand( command, text, path, cache=True, tmpsuffix="tmp",
 		tmpprefix="paml_", resolveData=None, allowEmpty=False, cwd=None):
+	return runSteps(_processCommandSteps(command, text, path, cache,
+		tmpsuffix, tmpprefix, resolveData, allowEmpty, cwd))
+
+# NOTE: The processors that run commands are written as generators of
+# "steps": they yield the `(command, cwd)` to run and are sent back the
+# `(data, error, returncode)` of the command. This allows for the same
+# processor to be run synchronously (`runSteps`) or asynchronously (see
+# `paml.aio`).
+
+def runSteps( steps ):
+	"""Runs the given processor steps synchronously, running the commands
+	with `_runCommand` and returning the processor's result."""
+	try:
+		command = next(steps)
+		while True:
+			try:
+				result = _runCommand(*command)
+			except Exception as e:
+				# The steps get a chance to clean up
+				command = steps.throw(e)
+			else:
+				command = steps.send(result)
+	except StopIteration as e:
+		return e.value
+
+def _runCommand( command, cwd=None ):
+	"""Runs the given command, given as a list of arguments that are joined
+	as a single shell line, and returns `(data, error, returncode)`."""
+	# FIXME: Honestly, I have so many problems with popen it's unbelievable.
+	# I sometimes get sugar to freeze without any reason. I'm keeping the
+	# following snippet for reference of what not to do.
+	# ---
+	# cmd     = subprocess.Popen(command, shell=False, stdout=subprocess.PIPE,
+	# 		stderr=subprocess.PIPE, cwd=cwd)
+	# data    = cmd.stdout.read()
+	# error   = cmd.stderr.read()
+	# print ("  data",  repr(data))
+	# print ("  error", repr(error))
+	# print ("waiting...")
+	# cmd.wait()
+	# ---
+	# Here the `shell` means single-line comman,d
+	name = _getCommandName(command)
+	METRICS.increment("paml_subprocess_in_flight", 1, command=name)
+	t  = time.time()
+	try:
+		p  = subprocess.Popen(" ".join(command), shell=True,
+			stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True,
+			cwd=cwd)
+		data, error = p.communicate()
+	finally:
+		METRICS.increment("paml_subprocess_in_flight", -1, command=name)
+		METRICS.observe("paml_subprocess_duration_seconds", time.time() - t, command=name)
+		METRICS.increment("paml_subprocess_runs_total", command=name)
+	if p.returncode != 0:
+		METRICS.increment("paml_subprocess_failures_total", command=name)
+	return data, error, p.returncode
+
+def _getCommandName( command ):
+	"""Returns the name of the program run by the given command, as used in
+	`METRICS`."""
+	return os.path.basename(command[0].split()[0]) if command and command[0].strip() else "?"
+
+def _processCommandSteps( command, text, path, cache=True, tmpsuffix="tmp",
+		tmpprefix="paml_", resolveData=None, allowEmpty=False, cwd=None):
 	timestamp = has_changed = data = None
 	error = None
-	cache, is_same, data, cache_key = cacheGet( text, path, cache)
+	cache, is_same, data, cache_key = cacheGet( text, path, cache, command)
+	if is_same and isinstance(data, CompileFailure):
+		if data.isFor(command):
+			return data.result(_getCommandName(command))
+		# NOTE: Another command failed on the same file
+		is_same = False
 	if (not is_same) or (not cache):
 		if not path or os.path.isdir(path):
 			temp_created = True
@@ -172,50 +735,41 @@ def _processCommand( command, text, path, cache=True, tmpsuffix="tmp",
 			command = command[:-1] + [path]
 		else:
 			temp_created = False
-		# FIXME: Honestly, I have so many problems with popen it's unbelievable.
-		# I sometimes get sugar to freeze without any reason. I'm keeping the
-		# following snippet for reference of what not to do.
-		# ---
-		# cmd     = subprocess.Popen(command, shell=False, stdout=subprocess.PIPE,
-		# 		stderr=subprocess.PIPE, cwd=cwd)
-		# data    = cmd.stdout.read()
-		# error   = cmd.stderr.read()
-		# print ("  data",  repr(data))
-		# print ("  error", repr(error))
-		# print ("waiting...")
-		# cmd.wait()
-		# ---
-		# Here the `shell` means single-line comman,d
-		p  = subprocess.Popen(" ".join(command), shell=True,
-			stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True,
-			cwd=cwd)
-		data, error = p.communicate()
+		# NOTE: The temp file is removed even when running the command
+		# fails, in which case the error is thrown into this generator.
+		try:
+			data, error, returncode = yield (command, cwd)
+		finally:
+			if temp_created:
+				os.unlink(path)
 		if error:
 			error = engine.ensure_unicode(error)
 		# DEBUG:
 		# If we have a resolveData attribute, we use it to resolve/correct the
 		# data
-		if temp_created:
-			os.unlink(path)
 		if not data and resolveData:
 			data = resolveData()
 		if not data and not allowEmpty:
-			raise Exception(error or u"No data processing `{0}`".format(u" ".join(command)))
-		# A return code of 0 means success, even if there was output on stderr
-		if not temp_created and p.returncode == 0:
+			error = error or u"No data processing `{0}`".format(u" ".join(command))
+			if not temp_created:
+				cacheSet(cache, path, cache_key, CompileFailure(None, error, command))
+			raise Exception(error)
+		# A return code of 0 means success, even if there was output on
+		# stderr. Failures are cached as well, so that the compiler is not
+		# run again until the input changes.
+		if not temp_created:
 			# We don't cache temp files. Temp files are only created when
 			# we don't have a path.
-			if cache is SIG_CACHE:
-				cache.set(path,cache_key,data)
-				assert cache.has(path, cache_key)
-			elif cache is MEMORY_CACHE:
-				cache.set(cache_key,data)
-				assert cache.has(cache_key) == data
+			cacheSet(cache, path, cache_key, data if returncode == 0 else CompileFailure(data, error, command))
 	assert data is not None, "paml.web._processCommand: None returned by {0}".format(command)
 	return engine.ensure_unicode(data), error
 
+@revalidated
 @locked
 def processSugar( text, path, request=None, cache=True, includeSource=False, version="" ):
+	return runSteps(_processSugarSteps(text, path, request, cache, includeSource, version))
+
+def _processSugarSteps( text, path, request=None, cache=True, includeSource=False, version="" ):
 	text        = engine.ensure_unicode(text or "")
 	multi_paths = None
 	sugar       = getCommands()["sugar" + version]
@@ -270,32 +824,49 @@ def processSugar( text, path, request=None, cache=True, includeSource=False, ver
 	] + options + [
 		" ".join(norm_path(_) for _  in multi_paths) if multi_paths else norm_path(path)
 	]
-	res, error = _processCommand(command, text, path + query, cache, cwd=temp_path)
+	try:
+		res, error = yield from _processCommandSteps(command, text, path + query, cache, cwd=temp_path)
+	finally:
+		# We clean up the temp dir
+		if os.path.exists(temp_path):
+			os.rmdir(temp_path)
+		if temp_output and os.path.exists(temp_output): os.unlink(temp_output)
 	if error and not(res.strip()):
 		res = "console.error("+ json.dumps(error) +")"
-	# We clean up the temp dir
-	if os.path.exists(temp_path):
-		os.rmdir(temp_path)
-	if temp_output and os.path.exists(temp_output): os.unlink(temp_output)
 	return res, "text/javascript"
 
 def processCoffeeScript( text, path, request=None, cache=True ):
+	return runSteps(_processCoffeeScriptSteps(text, path, request, cache))
+
+def _processCoffeeScriptSteps( text, path, request=None, cache=True ):
 	command = [
 		getCommands()["coffee"],"-cp",
 		path
 	]
-	return _processCommand(command, text, path, cache)[0], "text/javascript"
+	return (yield from _processCommandSteps(command, text, path, cache))[0], "text/javascript"
 
 def processBabelJS( text, path, cache=True ):
+	return runSteps(_processBabelJSSteps(text, path, cache))
+
+def _processBabelJSSteps( text, path, cache=True ):
 	command = [
 		getCommands()["babel"],
 		path
 	]
-	return _processCommand(command, text, path, cache)[0], "text/javascript"
+	return (yield from _processCommandSteps(command, text, path, cache))[0], "text/javascript"
 
+@revalidated
 def processTypeScript( text, path, request=None, cache=True ):
+	return runSteps(_processTypeScriptSteps(text, path, request, cache))
+
+def _processTypeScriptSteps( text, path, request=None, cache=True ):
 	timestamp = has_changed = data = None
+	compiler  = [getCommands()["typescript"]]
 	cache, is_same, data, cache_key = cacheGet( text, path, cache)
+	if is_same and isinstance(data, CompileFailure):
+		if data.isFor(compiler):
+			return data.result("typescript")[0], "text/javascript"
+		is_same = False
 	if (not is_same) or (not cache):
 		# We get the process through `tsc`
 		temp_path = tempfile.mktemp(prefix="pamlweb-", suffix=".ts.js")
@@ -307,8 +878,16 @@ def processTypeScript( text, path, request=None, cache=True ):
 				with file(temp_path) as f:
 					return f.read()
 			return None
-		# We bypass the cache
-		error,_ = _processCommand(command, text, path, cache=None, resolveData=read_file)
+		# We bypass the cache, but we cache the failures along with the
+		# output.
+		try:
+			error,_ = yield from _processCommandSteps(command, text, path, cache=None, resolveData=read_file)
+		except OSError as e:
+			# The compiler could not be run, which is not a compile failure
+			raise e
+		except Exception as e:
+			cacheSet(cache, path, cache_key, CompileFailure(None, str(e), compiler))
+			raise e
 		data  = None
 		# We don't expect to have an error there
 		# if error.strip():
@@ -321,23 +900,25 @@ def processTypeScript( text, path, request=None, cache=True ):
 		if error and error != data:
 			data = "\n//\t".join(["// ERROR: {0}\n//".format(" ".join(command))] + error.split("\n")) + "\n" + data
 		# Now we retrieve the cache
-		if cache is SIG_CACHE:
-			cache.set(path,cache_key,data)
-			assert cache.has(path, cache_key)
-		elif cache is MEMORY_CACHE:
-			cache.set(cache_key,data)
-			assert cache.has(cache_key) == data
+		cacheSet(cache, path, cache_key, data)
 	return data,"text/javascript"
 
 def processPandoc( text, path, request=None, cache=True ):
+	return runSteps(_processPandocSteps(text, path, request, cache))
+
+def _processPandocSteps( text, path, request=None, cache=True ):
 	command = [
 		getCommands()["pandoc"],
 		path
 	]
-	return PANDOC_HEADER + _processCommand(command, text, path, cache)[0] + PANDOC_FOOTER, "text/html"
+	return PANDOC_HEADER + (yield from _processCommandSteps(command, text, path, cache))[0] + PANDOC_FOOTER, "text/html"
 
 
+@revalidated
 def processPCSS( text, path, request=None, cache=True ):
+	return runSteps(_processPCSSSteps(text, path, request, cache))
+
+def _processPCSSSteps( text, path, request=None, cache=True ):
 	# NOTE: Disabled until memory leaks are fixed
 	# import pythoniccss
 	# result = pythoniccss.convert(text)
@@ -346,7 +927,7 @@ def processPCSS( text, path, request=None, cache=True ):
 		getCommands()["pcss"],
 		path
 	]
-	return _processCommand(command, text, path, cache, allowEmpty=False)[0], "text/css"
+	return (yield from _processCommandSteps(command, text, path, cache, allowEmpty=False))[0], "text/css"
 
 def processHJSON( text, path, request=None, cache=True ):
 	import hjson
@@ -414,10 +995,7 @@ def processNobrackets( text, path, request=None, cache=True ):
 		# Now for caching-friendlyness, we store the content_type in addition
 		# to the data
 		data = content_type + "\t" + res
-		if   cache is SIG_CACHE:
-			cache.set(cache_path, cache_key, data)
-		elif cache is MEMORY_CACHE:
-			cache.set(cache_key, data)
+		cacheSet(cache, cache_path, cache_key, data)
 		return res, content_type
 	else:
 		# We can retrieve the content from the cache
@@ -433,10 +1011,7 @@ def processBlock( text, path, request=None, cache=True ):
 	# FIXME: Should try a command here
 	if (not is_same) or (not cache):
 		data = polyblocks.process(text, path=path, xsl="lib/xsl/block.xsl")
-		if   cache is SIG_CACHE:
-			cache.set(cache_path, cache_key, data)
-		elif cache is MEMORY_CACHE:
-			cache.set(cache_key, data)
+		cacheSet(cache, cache_path, cache_key, data)
 		return data, "text/xml"
 	else:
 		return data, "text/xml"
@@ -446,7 +1021,7 @@ def getProcessors():
 	setup."""
 	global PROCESSORS
 	if not PROCESSORS:
-		PROCESSORS = {
+		processors = {
 			"xml.paml" : processPAMLXML,
 			"xsl.paml" : processPAMLXML,
 			"paml"     : processPAML,
@@ -464,12 +1039,17 @@ def getProcessors():
 			"nb"       : processNobrackets,
 			"block"    : processBlock,
 		}
+		PROCESSORS = dict((k, measured(k, v)) for k, v in processors.items())
 	return PROCESSORS
 
 def resolveFile( component, request, path ):
 	"""A custom path resolution function that will alias `.ts.js` files
 	to `.ts` files."""
-	p = component._resolvePath(path)
+	return resolveAlias(component._resolvePath(path))
+
+def resolveAlias( p ):
+	"""Returns the local file (or files) served for the given local path,
+	as `resolveFile` does once the path is resolved by the component."""
 	if not os.path.exists(p):
 		name = p.rsplit(".", 1)[0]
 		if p.endswith(".ts.js"):
@@ -494,17 +1074,310 @@ def resolveFile( component, request, path ):
 		return res
 	return p
 
+def getMetricsComponent( metrics=None ):
+	"""Returns a Retro component that serves the given metrics (`METRICS`
+	by default) in the Prometheus text format at `/_paml/metrics`."""
+	# NOTE: The component is defined here as Retro is optional, and is
+	# only needed when running the server.
+	class MetricsComponent(retro.Component):
+
+		def __init__( self, metrics ):
+			retro.Component.__init__(self, name="PAMLMetrics")
+			self.metrics = metrics
+
+		@retro.on(GET_HEAD="/_paml/metrics", priority=10)
+		def getMetrics( self, request ):
+			return request.respond(self.metrics.asPrometheus(), "text/plain; version=0.0.4; charset=utf-8")
+
+	return MetricsComponent(metrics or METRICS)
+
 def getLocalFiles(root=""):
 	"""Returns a Retro LocalFile component initialized with the PAML
 	processor."""
-	return LocalFiles(root=root,processors=getProcessors(),resolver=resolveFile,optsuffix=[".paml",".html"], lastModified=False, writable=True)
+	return LocalFiles(root=root,processors=getProcessors(),resolver=resolveFile,optsuffix=LOCAL_SUFFIXES, lastModified=False, writable=True)
+
+# -----------------------------------------------------------------------------
+#
+# WARM-UP
+#
+# -----------------------------------------------------------------------------
+
+# The optional suffixes of the files served by `getLocalFiles`
+LOCAL_SUFFIXES      = [".paml", ".html"]
+
+# The source suffixes that are served under another URL suffix, as
+# `(source suffix, URL suffix)`. This is the reverse of `resolveAlias` and
+# of the `LOCAL_SUFFIXES`, and only aliases that actually resolve to the
+# source file are used.
+SERVED_ALIASES      = (
+	(".ts",       ".ts.js"),
+	(".ts",       ".js"),
+	(".sjs",      ".js"),
+	(".es6.js",   ".js"),
+	(".pcss",     ".css"),
+	(".hjson",    ".json"),
+	(".xml.paml", ".xml"),
+	(".xsl.paml", ".xsl"),
+	(".paml",     ""),
+	(".html",     ""),
+)
+
+# Directories that are never walked when looking for served files
+SKIPPED_DIRECTORIES = ("node_modules", "__pycache__")
+
+def getProcessorFor( path ):
+	"""Returns the processor for the given local path, picked the same way
+	as `LocalFiles.processorFor`."""
+	processors = getProcessors()
+	matches    = sorted(_ for _ in processors if path.endswith(_))
+	return processors[matches[-1]] if matches else None
+
+def resolveLocalPath( root, path ):
+	"""Returns the local file served for the given URL path relative to the
+	given root, resolved the same way as `getLocalFiles` does."""
+	p = os.path.abspath(os.path.join(root, path))
+	if not os.path.exists(p):
+		for suffix in LOCAL_SUFFIXES:
+			if os.path.exists(p + suffix):
+				p = p + suffix
+				break
+	return resolveAlias(p)
+
+def getServedFiles( root=".", exclude=() ):
+	"""Yields the absolute path of each file under the given root that can
+	be served. Hidden files and directories, `SKIPPED_DIRECTORIES` and the
+	`exclude`d absolute paths are ignored."""
+	root = os.path.abspath(root)
+	for parent, dirs, files in os.walk(root):
+		dirs[:] = sorted(_ for _ in dirs if not _.startswith(".") and _ not in SKIPPED_DIRECTORIES and os.path.join(parent, _) not in exclude)
+		for name in sorted(files):
+			if not name.startswith("."):
+				yield os.path.join(parent, name)
+
+def getServedURLs( root, path ):
+	"""Returns the URL paths (relative to the given root) that resolve to
+	the file at the given absolute path, starting with its own path."""
+	relpath = os.path.relpath(path, os.path.abspath(root))
+	urls    = [relpath]
+	for source, alias in SERVED_ALIASES:
+		if relpath.endswith(source):
+			url = relpath[:-len(source)] + alias
+			if url and url not in urls and resolveLocalPath(root, url) == path:
+				urls.append(url)
+	return urls
+
+def getServedPaths( root="." ):
+	"""Yields `(urls, path)` for each file under the given root that is
+	served through a processor, where `path` is the absolute path of the
+	file and `urls` are the URL paths (relative to the root) that resolve
+	to it."""
+	for path in getServedFiles(root):
+		if getProcessorFor(path):
+			yield getServedURLs(root, path), path
+
+def isLocked( processor ):
+	"""Tells if the given processor is `locked`, in which case its calls
+	are run one after the other."""
+	return getattr(processor, "locked", False)
+
+def isCached( processor ):
+	"""Tells if the given processor caches its output, which is the case
+	of the processors that take a `cache` argument. The output of the PAML
+	processors, in particular, is not cached."""
+	return "cache" in inspect.signature(processor).parameters
+
+def warmup( root=".", jobs=None ):
+	"""Precompiles every file under the given root that is served through
+	a processor, and returns a list of `(path, duration, error)`.
+
+	This only populates the caches of the processors that have one (see
+	`isCached`). PAML files are not cached, so they are only checked for
+	errors, and their `engine.IncrementalDocument` is created when
+	`INCREMENTAL` is set. Files are compiled by `jobs` threads (one per
+	CPU by default), except for those of `locked` processors, which are
+	compiled one after the other in the calling thread, as they would be
+	serialized anyway."""
+	from concurrent.futures import ThreadPoolExecutor
+	def compile( path ):
+		t = time.time()
+		try:
+			# NOTE: We read the file the same way `LocalFiles` does
+			with open(path, "rt") as f:
+				text = f.read()
+			getProcessorFor(path)(text, path)
+			return (path, time.time() - t, None)
+		except Exception as e:
+			return (path, time.time() - t, e)
+	paths   = [_ for urls, _ in getServedPaths(root)]
+	results = {}
+	with ThreadPoolExecutor(max_workers=jobs or os.cpu_count() or 1) as pool:
+		futures = [pool.submit(compile, _) for _ in paths if not isLocked(getProcessorFor(_))]
+		# NOTE: The locked processors are run while the pool is busy with
+		# the others.
+		for path in paths:
+			if isLocked(getProcessorFor(path)):
+				results[path] = compile(path)
+		for future in futures:
+			result = future.result()
+			results[result[0]] = result
+	return [results[_] for _ in paths]
+
+# -----------------------------------------------------------------------------
+#
+# EXPORT
+#
+# -----------------------------------------------------------------------------
+
+# The name of the manifest written at the root of an export
+EXPORT_MANIFEST    = "paml-manifest.json"
+
+# The number of hexadecimal digits of the hash in hashed asset names
+EXPORT_HASH_LENGTH = 10
+
+# The extension of exported files, by content type, used for URLs that
+# don't already have one (like `index` for `index.paml`)
+EXPORT_EXTENSIONS  = {
+	"text/html"              : ".html",
+	"text/xml"               : ".xml",
+	"text/css"               : ".css",
+	"text/javascript"        : ".js",
+	"application/json"       : ".json",
+	"text/plain"             : ".txt",
+}
+
+def getExportURL( urls, contentType ):
+	"""Returns the URL path at which a processed file, served at the given
+	URLs (as returned by `getServedURLs`) with the given content type, is
+	exported. This is the shortest alias with the extension of the content
+	type (`b.js` for `b.sjs`), or else the shortest alias with an
+	extension (`f.xsl` for `f.xsl.paml`), or else the extension-less alias
+	with the extension of the content type (`index.html` for `index.paml`).
+	Files without alias are exported under their own path."""
+	extension = EXPORT_EXTENSIONS.get((contentType or "").split(";")[0].strip())
+	aliases   = sorted(urls[1:], key=len)
+	for url in aliases:
+		if extension and url.endswith(extension):
+			return url
+	for url in aliases:
+		if os.path.splitext(os.path.basename(url))[1]:
+			return url
+	for url in aliases:
+		return url + (extension or "")
+	return urls[0]
+
+def getHashedURL( url, data ):
+	"""Returns `(hashed url, digest)` for the given URL and data, where the
+	hashed URL has the first `EXPORT_HASH_LENGTH` digits of the SHA-256 of
+	the data inserted before its extension."""
+	digest    = hashlib.sha256(data).hexdigest()
+	base, ext = os.path.splitext(url)
+	return "{0}.{1}{2}".format(base, digest[:EXPORT_HASH_LENGTH], ext), digest
+
+def export( root=".", output="dist", jobs=None, hashed=True ):
+	"""Exports the files served from the given root as static files in the
+	given output directory. Files with a processor are rendered and written
+	at the URL given by `getExportURL`, other files are copied as-is.
+	Files are exported in parallel by `jobs` threads (one per CPU by
+	default).
+
+	Unless `hashed` is false, a copy of each asset (everything but HTML
+	documents, which are entry points) is written under a hashed name.
+	A manifest mapping each exported URL to its `source`, `type`, `sha256`
+	and `hashed` URL is written as `EXPORT_MANIFEST` in the output
+	directory. Returns `(manifest, errors)` where errors is a list of
+	`(path, exception)`.
+
+	Sources that are exported at the same URL (like `a.ts` and `a.sjs`,
+	both exported as `a.js`) would overwrite each other: none of them is
+	exported, and each gets an error instead."""
+	from concurrent.futures import ThreadPoolExecutor
+	output = os.path.abspath(output)
+	def write( url, data ):
+		path = os.path.join(output, url)
+		parent = os.path.dirname(path)
+		if not os.path.exists(parent):
+			try:
+				os.makedirs(parent)
+			except OSError as e:
+				# NOTE: Another thread might have created it in between
+				if not os.path.isdir(parent): raise e
+		with open(path, "wb") as f:
+			f.write(data)
+	def process( path ):
+		try:
+			processor = getProcessorFor(path)
+			if processor:
+				with open(path, "rt") as f:
+					text = f.read()
+				content, content_type = processor(text, path)
+				url  = getExportURL(getServedURLs(root, path), content_type)
+				data = engine.ensure_bytes(content)
+			else:
+				url  = os.path.relpath(path, os.path.abspath(root))
+				content_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+				with open(path, "rb") as f:
+					data = f.read()
+			write(url, data)
+			entry = dict(source=os.path.relpath(path, os.path.abspath(root)), type=content_type)
+			hashed_url, entry["sha256"] = getHashedURL(url, data)
+			if hashed and not content_type.startswith("text/html"):
+				write(hashed_url, data)
+				entry["hashed"] = hashed_url
+			return (path, url.replace(os.sep, "/"), entry, None)
+		except Exception as e:
+			return (path, None, None, e)
+	paths    = list(getServedFiles(root, exclude=(output,)))
+	manifest = {}
+	errors   = []
+	with ThreadPoolExecutor(max_workers=jobs or os.cpu_count() or 1) as pool:
+		results = list(pool.map(process, paths))
+	sources = collections.defaultdict(list)
+	for path, url, entry, error in results:
+		if error:
+			errors.append((path, error))
+		else:
+			sources[url].append(path)
+	for path, url, entry, error in results:
+		if error:
+			pass
+		elif len(sources[url]) > 1:
+			# NOTE: The colliding files were written concurrently, so
+			# whatever is in the output is removed.
+			for _ in (url, entry.get("hashed")):
+				if _ and os.path.exists(os.path.join(output, _)):
+					os.unlink(os.path.join(output, _))
+			others = ", ".join(os.path.relpath(_, os.path.abspath(root)) for _ in sources[url] if _ != path)
+			errors.append((path, Exception("paml.web.export: {0} is exported at the same URL as {1}: {2}".format(entry["source"], others, url))))
+		else:
+			manifest[url] = entry
+	if not os.path.exists(output): os.makedirs(output)
+	with open(os.path.join(output, EXPORT_MANIFEST), "wt") as f:
+		json.dump(manifest, f, indent=1, sort_keys=True)
+	return manifest, errors
 
 def run( arguments, options={} ):
+	global STALE_WHILE_REVALIDATE, XML_FORMAT, INCREMENTAL
 	import argparse
 	p = argparse.ArgumentParser(description="Starts a web server that translates PAML files")
 	p.add_argument("values",  type=str, nargs="*")
 	p.add_argument("-d", "--def", dest="var",   type=str, action="append")
+	p.add_argument("-w", "--warmup", action="store_true", help="Precompiles the served files before accepting requests")
+	p.add_argument("-j", "--jobs", type=int, help="Number of files precompiled or exported in parallel")
+	p.add_argument("-e", "--export", type=str, help="Exports the served files as static files to the given directory, instead of serving them")
+	p.add_argument("--cache-entries", type=int, help="Maximum number of processor outputs kept in memory (default {0})".format(CACHE_ENTRIES))
+	p.add_argument("--cache-size", type=int, help="Maximum size in megabytes of the processor outputs kept in memory (default {0})".format(CACHE_BYTES // (1024 * 1024)))
+	p.add_argument("--xml-format", choices=("xhtml", "xml"), help="Format of the .xml.paml and .xsl.paml files, xhtml uses the HTML formatter as earlier versions did (default {0})".format(XML_FORMAT))
+	p.add_argument("--incremental", action="store_true", help="Re-parses only the edited parts of PAML files, keeping their parsed trees in memory")
+	p.add_argument("--stale-while-revalidate", action="store_true", help="Serves the previous output of Sugar, TypeScript and PCSS files while they are recompiled")
+	p.add_argument("--cache-policy", choices=BoundedCache.POLICIES, help="Evicts the least recently (lru) or frequently (lfu) used outputs first (default {0})".format(CACHE_POLICY))
 	args      = p.parse_args(arguments)
+	configureCaches(args.cache_entries, None if args.cache_size is None else args.cache_size * 1024 * 1024, args.cache_policy)
+	if args.stale_while_revalidate:
+		STALE_WHILE_REVALIDATE = True
+	if args.xml_format:
+		XML_FORMAT = args.xml_format
+	if args.incremental:
+		INCREMENTAL = True
 	options.update(dict(_.split("=",1) for _ in args.var or ""))
 	options.update(dict((_.split("=",1)[0].lower(), _.split("=",1)[1]) for _ in args.values or "" if not _.startswith("proxy:")))
 	# We merge some of the options that match COMMAND definitions, so we
@@ -515,17 +1388,31 @@ def run( arguments, options={} ):
 			commands[k] = v
 
 	# We can load defaults. This should be moved to a dedicated option.
-	global PAMELA_DEFAULTS
-	defaults_path = ".paml-defaults"
-	if os.path.exists(defaults_path):
-		with open(defaults_path) as f:
-			PAMELA_DEFAULTS = json.load(f)
+	loadDefaults()
 	processors = getProcessors()
 	if "plain" in options:
 		for v in options["plain"].split(","):
 			del processors[v.strip()]
+	if args.export:
+		t = time.time()
+		manifest, errors = export(".", args.export, args.jobs)
+		for path, error in errors:
+			sys.stderr.write("paml-web: export failed for {0}: {1}\n".format(path, error))
+		sys.stderr.write("paml-web: exported {0} files to {1} in {2:0.2f}s, {3} failed\n".format(
+			len(manifest), args.export, time.time() - t, len(errors)))
+		return 1 if errors else 0
+	if args.warmup:
+		t       = time.time()
+		results = warmup(".", args.jobs)
+		for path, duration, error in results:
+			if error:
+				sys.stderr.write("paml-web: warm-up failed for {0}: {1}\n".format(path, error))
+		sys.stderr.write("paml-web: warmed up {0} files in {1:0.2f}s, {2} cached, {3} failed\n".format(
+			len(results), time.time() - t,
+			len([_ for _ in results if not _[2] and isCached(getProcessorFor(_[0]))]),
+			len([_ for _ in results if _[2]])))
 	files   = getLocalFiles()
-	comps   = [files]
+	comps   = [getMetricsComponent(), files]
 	proxies = [x[len("proxy:"):] for x in [x for x in args.values if x.startswith("proxy:")]]
 	comps.extend(proxy.createProxies(proxies))
 	app     = retro.Application(components=comps)
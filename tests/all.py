@@ -0,0 +1,922 @@
+#!/usr/bin/env python
+# encoding: utf8
+# -----------------------------------------------------------------------------
+# Project           :   PAML
+# -----------------------------------------------------------------------------
+# License           :   Lesser GNU Public License
+# -----------------------------------------------------------------------------
+# Creation date     :   19-Oct-2026
+# Last mod.         :   19-Oct-2026
+# -----------------------------------------------------------------------------
+
+# Regression tests for the PAML engine, run with `make test`. The `*.paml`
+# files next to this script are used as fixtures.
+
+import os, io, sys, glob, time, codecs, random, shutil, string, asyncio, tempfile, threading, unittest, subprocess
+
+TESTS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(TESTS), "src"))
+
+from paml import engine, benchmark
+
+FIXTURES = sorted(glob.glob(os.path.join(TESTS, "*.paml")))
+
+# The depth of the documents used to check that deep nesting does not hit
+# the recursion limit, see `benchmark.nested`.
+DEEP_NESTING = 10000
+
+def nestedSource( depth ):
+	"""Returns the PAML source of the document returned by
+	`benchmark.nested` for the given depth."""
+	lines = ["\t" * i + "<div(data-level={0})\n".format(i) for i in range(depth)]
+	lines.append("\t" * depth + "Lorem ipsum\n")
+	return "".join(lines)
+
+def render( f, *args ):
+	"""Returns the result of `f(*args)`, or the class and message of the
+	exception it raised, so that failures can be compared too."""
+	try:
+		return f(*args)
+	except Exception as e:
+		return "{0}: {1}".format(e.__class__.__name__, e)
+
+def edit( lines, r ):
+	"""Returns a copy of the given lines with a random edit made with the
+	given `random.Random`: a line is changed, duplicated, removed or
+	re-indented."""
+	lines = list(lines)
+	if not lines: return lines
+	i     = r.randrange(len(lines))
+	kind  = r.choice(("change", "duplicate", "remove", "indent", "dedent"))
+	if kind == "change":
+		lines[i] = lines[i][:-1] + " edited\n"
+	elif kind == "duplicate":
+		lines.insert(i, lines[i])
+	elif kind == "remove":
+		del lines[i]
+	elif kind == "indent":
+		lines[i] = "\t" + lines[i]
+	elif lines[i].startswith("\t"):
+		lines[i] = lines[i][1:]
+	return lines
+
+class ReferenceTokenizer( engine.Parser ):
+	"""A parser that tokenizes content lines like PAML did before it was
+	done in a single pass, used as a reference for
+	`Parser._parseContentLine`."""
+
+	def _parseContentLine( self, line ):
+		offset = 0
+		while offset < len(line):
+			element = engine.RE_INLINE.search(line, offset)
+			if not element:
+				break
+			closing = line.find(">", element.end())
+			if closing == -1:
+				raise Exception("Unclosed inline tag: '%s'" % (line))
+			text = line[offset:element.start()]
+			if text:
+				self._writer.onTextAdd(text)
+			name, attributes, embed, hints = self._parsePAMLElement(element.group()[1:])
+			self._writer.onElementStart(name, attributes, isInline=True, hints=hints)
+			text = line[element.end():closing]
+			if text: self._writer.onTextAdd(text)
+			self._writer.onElementEnd()
+			offset = closing + 1
+		if offset < len(line):
+			text = line[offset:]
+			if text and text[-1] == "\n": text = text[:-1] + " "
+			if text: self._writer.onTextAdd(text)
+
+class ReferenceAttributes( engine.Parser ):
+	"""A parser that parses attribute lists like PAML did before it was done
+	at an offset, used as a reference for `Parser._parsePAMLAttributes`."""
+
+	def _parsePAMLAttributes( self, attributes ):
+		result   = []
+		original = attributes
+		while attributes:
+			match = engine.RE_ATTRIBUTE.match(attributes)
+			assert match, "Given attributes are malformed: %s" % (attributes)
+			name  = match.group(1).replace("::", ":")
+			value = match.group(4)
+			if value and value[0] == value[-1] and value[0] in ("'", '"'):
+				value = value[1:-1]
+			result.append([name, value])
+			attributes = attributes[match.end():]
+			if attributes:
+				assert attributes[0] == ",", "Attributes must be comma-separated: %s" % (attributes)
+				attributes = attributes[1:]
+				assert attributes, "Trailing comma with no remaining attributes: %s" % (original)
+		return result
+
+class InFixtures( unittest.TestCase ):
+	"""Runs the tests from the fixtures directory, so that includes are
+	found."""
+
+	def setUp( self ):
+		self.cwd = os.getcwd()
+		os.chdir(TESTS)
+
+	def tearDown( self ):
+		os.chdir(self.cwd)
+
+# -----------------------------------------------------------------------------
+#
+# PACKAGE
+#
+# -----------------------------------------------------------------------------
+
+class Package( unittest.TestCase ):
+	"""Importing `paml` does not import its submodules, which are imported
+	on first access."""
+
+	def testLazyImports( self ):
+		script = "; ".join((
+			"import sys, paml",
+			"print(sorted(_ for _ in sys.modules if _.startswith('paml')))",
+			"print(paml.toHTML('<p:Hello'), paml.engine.parse('<p:Hello'), paml.web.__name__)",
+			"print(hasattr(paml, 'missing'))",
+		))
+		env    = dict(os.environ, PYTHONPATH=os.path.join(os.path.dirname(TESTS), "src"))
+		output = subprocess.check_output([sys.executable, "-c", script], env=env).decode("utf8").split("\n")
+		self.assertEqual(output[:3], ["['paml']", "<p>Hello</p> <p>Hello</p> paml.web", "False"])
+
+# -----------------------------------------------------------------------------
+#
+# INCLUDE TEMPLATES
+#
+# -----------------------------------------------------------------------------
+
+class IncludeTemplates( unittest.TestCase ):
+	"""`IncludeTemplate.render` must give the same lines as
+	`string.Template.safe_substitute`, which it replaces, and its cache
+	must be bounded."""
+
+	SUBSTITUTIONS = (
+		{},
+		{"name":"value"},
+		{"name":1, "id":None, "other":u"é"},
+		{"name":"$id", "id":[1, 2]},
+	)
+
+	def testSafeSubstitute( self ):
+		lines = [u"<p:$name $$name ${name} ${id}x $other $ $1 ${broken\n", u"no placeholder\n"]
+		for path in FIXTURES:
+			lines.extend(engine.read_file(path)[0].split("\n"))
+		template = engine.IncludeTemplate(lines)
+		for substitutions in self.SUBSTITUTIONS:
+			# NOTE: Includes without substitutions are left as-is
+			expected = [string.Template(_).safe_substitute(substitutions) if substitutions else _ for _ in lines]
+			self.assertEqual(template.render(substitutions), expected, substitutions)
+
+	def testLimit( self ):
+		path = tempfile.mkdtemp()
+		try:
+			limit = engine.IncludeTemplate.LIMIT
+			for i in range(limit + 10):
+				name = os.path.join(path, "{0}.paml".format(i))
+				with open(name, "w") as f:
+					f.write("<p:$value\n")
+				self.assertEqual(engine.IncludeTemplate.Get(name).render({"value":i}), [u"<p:{0}\n".format(i)])
+			self.assertEqual(len(engine.IncludeTemplate.CACHE), limit)
+			self.assertNotIn(os.path.join(path, "0.paml"), engine.IncludeTemplate.CACHE)
+		finally:
+			shutil.rmtree(path)
+			engine.IncludeTemplate.CACHE.clear()
+
+# -----------------------------------------------------------------------------
+#
+# INCREMENTAL PARSING
+#
+# -----------------------------------------------------------------------------
+
+class Incremental( InFixtures ):
+	"""An `IncrementalDocument` must give the same output as parsing the
+	whole edited document again."""
+
+	def testEdits( self ):
+		r = random.Random(0)
+		for path in FIXTURES:
+			document = engine.IncrementalDocument(path)
+			pool     = engine.Engine("html")
+			lines    = engine.read_file(path)[0].split("\n")
+			lines    = [_ + "\n" for _ in lines]
+			for i in range(20):
+				text     = "".join(lines)[:-1]
+				parser   = pool.acquireParser()
+				try:
+					result = render(lambda: parser._formatter.format(document.parse(parser, text)))
+				finally:
+					pool.releaseParser(parser)
+				self.assertEqual(result, render(pool.parseString, text, path), "{0} after {1} edits".format(path, i))
+				lines = edit(lines, r)
+
+	def testWeb( self ):
+		from paml import web
+		path   = os.path.join(TESTS, "syntax-inline.paml")
+		text   = engine.read_file(path)[0]
+		edited = text + "\n<p:Edited\n"
+		# NOTE: Incremental parsing is opt-in, as it keeps the parsed trees
+		self.assertFalse(web.INCREMENTAL)
+		expected = [web.processPAML(text, path), web.processPAML(edited, path)]
+		self.assertNotIn(path, web.DOCUMENTS)
+		web.INCREMENTAL = True
+		try:
+			self.assertEqual([web.processPAML(text, path), web.processPAML(edited, path)], expected)
+			self.assertIn(path, web.DOCUMENTS)
+		finally:
+			web.INCREMENTAL = False
+			web.DOCUMENTS.clear()
+
+# -----------------------------------------------------------------------------
+#
+# SERIALIZATION
+#
+# -----------------------------------------------------------------------------
+
+class Serialization( InFixtures ):
+	"""Trees loaded with `loads` must be the same as the trees given to
+	`dumps`."""
+
+	def testFixtures( self ):
+		for path in FIXTURES:
+			try:
+				tree = engine.Parser().parseFileTree(path)
+			except Exception:
+				continue
+			records = engine.tree_to_records(tree)
+			loaded  = engine.loads(engine.dumps(tree))
+			self.assertEqual(engine.tree_to_records(loaded), records, path)
+			self.assertEqual(render(engine.Parser()._format, loaded), render(engine.Parser()._format, tree), path)
+
+	def testVersion( self ):
+		import marshal
+		data = marshal.dumps((-1, ()))
+		self.assertRaises(Exception, engine.loads, data)
+
+# -----------------------------------------------------------------------------
+#
+# TOKENIZER
+#
+# -----------------------------------------------------------------------------
+
+class Tokenizer( InFixtures ):
+	"""`Parser._parseContentLine` must give the same nodes and errors as
+	the `ReferenceTokenizer`."""
+
+	def testFixtures( self ):
+		for path in FIXTURES:
+			self.assertEqual(render(engine.Parser().parseFile, path), render(ReferenceTokenizer().parseFile, path), path)
+
+	def testLines( self ):
+		r = random.Random(0)
+		for path in FIXTURES:
+			lines = engine.read_file(path)[0].split("\n")
+			for line in lines:
+				line = r.choice(lines) + line.lstrip() + "\n"
+				self.assertEqual(self.tokenize(engine.Parser(), line), self.tokenize(ReferenceTokenizer(), line), repr(line))
+
+	def testElements( self ):
+		# NOTE: `_parseInlineElement` must give the same result as
+		# `_parsePAMLElement` for the elements it does not leave to it.
+		names    = ["a", "x-y", "?q", "ns::e", "\u00e9", "9"]
+		values   = ["v", "'q v'", '"d,v"', "'x)y'", "a|b", "m@n", "f(x", "'a'b", "::"]
+		heads    = names + ["", "a.b", "a#b", "#b.c", ".c.d", "a#b#c", "a.b#c"]
+		suffixes = ["", ":", "@body", "@body:", "|c", "|c+d@x:"]
+		parser   = engine.Parser()
+		checked  = 0
+		for head in heads:
+			for attributes in [""] + ["({0})".format(_) for _ in names] + ["(a={0})".format(_) for _ in values] + ["(a,id=i,class={0})".format(_) for _ in values]:
+				for suffix in suffixes:
+					line = "<{0}{1}{2}text>".format(head, attributes, suffix)
+					for match in engine.RE_CONTENT.finditer(line):
+						got = render(parser._parseInlineElement, match)
+						if got is not None:
+							checked += 1
+							self.assertEqual(got, render(parser._parsePAMLElement, match.group("element")[1:]), line)
+		self.assertGreater(checked, 1000)
+
+	def tokenize( self, parser, line ):
+		parser._startDocument()
+		parser._writer.onElementStart("div", [])
+		error = render(parser._parseContentLine, line)
+		return error, engine.tree_to_records(parser._writer.onDocumentEnd())
+
+# -----------------------------------------------------------------------------
+#
+# ATTRIBUTES
+#
+# -----------------------------------------------------------------------------
+
+class Attributes( InFixtures ):
+	"""`Parser._parsePAMLAttributes` must give the same attributes and
+	errors as `ReferenceAttributes`."""
+
+	NAMES  = ("a", "data-value", "xlink::href", "x_1")
+	VALUES = ("", "1", "value", "'a, b'", '"(c)"', "'it''s'", "x y", "'unclosed")
+
+	def testFixtures( self ):
+		for path in FIXTURES:
+			self.assertEqual(render(engine.Parser().parseFile, path), render(ReferenceAttributes().parseFile, path), path)
+
+	def testLists( self ):
+		r = random.Random(0)
+		for i in range(2000):
+			attributes = []
+			for j in range(r.randint(1, 5)):
+				value = r.choice(self.VALUES)
+				attributes.append(r.choice(self.NAMES) + ("=" + value if value else ""))
+			text = r.choice((",", ", ", " ", ",,")).join(attributes) + r.choice(("", "", ","))
+			self.assertEqual(render(engine.Parser()._parsePAMLAttributes, text), render(ReferenceAttributes()._parsePAMLAttributes, text), repr(text))
+
+# -----------------------------------------------------------------------------
+#
+# XML
+#
+# -----------------------------------------------------------------------------
+
+class XML( unittest.TestCase ):
+	"""The `XMLFormatter` must produce the same output as the
+	`XMLDOMFormatter` it replaces, except for the differences given in its
+	documentation."""
+
+	# The fixtures for which the outputs differ, and why
+	DIFFERENCES = {
+		"syntax-doctype.paml" : "the doctype is kept",
+		"syntax-xml.paml"     : "the XML declaration is kept",
+		"use.paml"            : "the attributes are kept in order",
+	}
+
+	def setUp( self ):
+		self.cwd = os.getcwd()
+		os.chdir(TESTS)
+
+	def tearDown( self ):
+		os.chdir(self.cwd)
+
+	def testSameAsDOM( self ):
+		for path in FIXTURES:
+			try:
+				expected = engine.XMLDOMFormatter().format(engine.Parser().parseFileTree(path))
+			except Exception:
+				# NOTE: The DOM formatter fails on comments, processing
+				# instructions and documents with several roots.
+				continue
+			output = engine.XMLFormatter().format(engine.Parser().parseFileTree(path))
+			reason = self.DIFFERENCES.get(os.path.basename(path))
+			if reason:
+				self.assertNotEqual(output, expected, reason)
+			else:
+				self.assertEqual(output, expected, path)
+
+	def testWeb( self ):
+		from paml import web
+		self.assertEqual(web.getPAMLFormat("feed.xml.paml"), ("xml", "text/xml"))
+		self.assertEqual(web.getPAMLFormat("feed.xsl.paml"), ("xml", "text/xml"))
+		self.assertEqual(web.getPAMLFormat("index.paml"),    ("html", "text/html"))
+		output, type = web.processPAML("<feed\n\t<entry:Hello\n", "feed.xml.paml")
+		self.assertEqual(output, u'<?xml version="1.0" ?><feed><entry>Hello </entry></feed>')
+
+	def testDefaults( self ):
+		pool = engine.Engine("xml", formatDefaults={"p":[engine.FORMAT_COMPACT]})
+		self.assertEqual(pool.parseString("<p\n\thello\n"), u'<?xml version="1.0" ?><p>hello </p>')
+
+# -----------------------------------------------------------------------------
+#
+# ENCODINGS
+#
+# -----------------------------------------------------------------------------
+
+class Encodings( unittest.TestCase ):
+	"""Files must be decoded the same way whether they are read as a whole
+	(`read_file`) or streamed (`iter_file_lines`), see `decode_buffer`."""
+
+	TEXT = u"<p\n\tcafé crème\n"
+
+	def setUp( self ):
+		self.path = tempfile.mkdtemp()
+
+	def tearDown( self ):
+		shutil.rmtree(self.path)
+
+	def assertDecoded( self, data, encoding, text=TEXT, sizes=(1, 3, 1024) ):
+		path = os.path.join(self.path, "encoding.paml")
+		with open(path, "wb") as f:
+			f.write(data)
+		self.assertEqual(engine.read_file(path), (text, encoding))
+		for size in sizes:
+			with open(path, "rb") as f:
+				self.assertEqual(u"".join(engine.iter_file_lines(f, path, size)), text, size)
+		output = io.StringIO()
+		engine.Parser().streamFile(path, output)
+		self.assertEqual(output.getvalue(), engine.Parser().parseFile(path))
+		self.assertIn(u"café crème", output.getvalue())
+
+	def testUTF8( self ):
+		self.assertDecoded(self.TEXT.encode("utf8"), "utf8")
+
+	def testBOM( self ):
+		self.assertDecoded(codecs.BOM_UTF8 + self.TEXT.encode("utf8"), "utf-8-sig")
+
+	def testUTF16( self ):
+		self.assertDecoded(self.TEXT.encode("utf-16"), "utf-16")
+
+	def testCodingComment( self ):
+		text = u"# -*- coding: latin-1 -*-\n" + self.TEXT
+		self.assertDecoded(text.encode("latin-1"), "iso8859-1", text)
+
+	def testFallback( self ):
+		self.assertDecoded(self.TEXT.encode("latin-1"), engine.FALLBACK_ENCODING)
+
+	def testLateFallback( self ):
+		# NOTE: The non-ASCII text comes after the first chunk
+		text = u"<p\n" + u"\tx\n" * engine.STREAM_CHUNK + self.TEXT[3:]
+		self.assertDecoded(text.encode("latin-1"), engine.FALLBACK_ENCODING, text, (7, engine.STREAM_CHUNK))
+
+# -----------------------------------------------------------------------------
+#
+# BOUNDED CACHES
+#
+# -----------------------------------------------------------------------------
+
+class BoundedCaches( unittest.TestCase ):
+	"""The eviction policies and bounds of `paml.web.BoundedCache`."""
+
+	def cache( self, **options ):
+		from paml import web
+		return web.BoundedCache("test", **options)
+
+	def testLRU( self ):
+		cache = self.cache(limit=3, policy="lru")
+		for key in "abc": cache.set(key, key)
+		cache.get("a")
+		cache.set("d", "d")
+		self.assertEqual(cache.keys(), ["c", "a", "d"])
+		self.assertEqual(cache.stats["evictions"], 1)
+
+	def testLFU( self ):
+		cache = self.cache(limit=3, policy="lfu")
+		for key in "abc": cache.set(key, key)
+		for key in "aab": cache.get(key)
+		cache.set("d", "d")
+		self.assertEqual(cache.keys(), ["a", "b", "d"])
+		# NOTE: On a tie, the least recently used entry is evicted
+		cache.get("d")
+		cache.set("e", "e")
+		self.assertEqual(cache.keys(), ["a", "d", "e"])
+
+	def testSize( self ):
+		cache = self.cache(size=10)
+		cache.set("a", "x" * 4)
+		cache.set("b", ("x" * 4, None))
+		self.assertEqual(cache.bytes, 8)
+		cache.set("c", "x" * 4)
+		self.assertEqual(cache.keys(), ["b", "c"])
+		self.assertEqual(cache.bytes, 8)
+		cache.configure(size=5)
+		self.assertEqual(cache.keys(), ["c"])
+		self.assertEqual(cache.bytes, 4)
+
+	def testRejected( self ):
+		cache = self.cache(size=10)
+		cache.set("a", "x" * 4)
+		self.assertEqual(cache.set("b", "x" * 11), "x" * 11)
+		self.assertEqual(cache.keys(), ["a"])
+		self.assertEqual(cache.stats["rejections"], 1)
+		# NOTE: An oversized value still replaces the previous entry
+		cache.set("a", "x" * 11)
+		self.assertEqual((cache.keys(), cache.bytes), ([], 0))
+
+	def testSignature( self ):
+		cache = self.cache()
+		cache.set("a", "value", 1)
+		self.assertTrue(cache.has("a", 1))
+		self.assertFalse(cache.has("a", 2))
+		self.assertEqual(cache.get("a", 2, stale=True), (False, "value"))
+		self.assertEqual(cache.get("a", 1), (True, "value"))
+		self.assertEqual(cache.get("a", 2), (False, None))
+		self.assertEqual(len(cache), 0)
+		self.assertEqual(cache.stats["invalidations"], 1)
+
+	def testThreads( self ):
+		cache  = self.cache(limit=50, size=1000)
+		errors = []
+		def run( seed ):
+			rng = random.Random(seed)
+			try:
+				for i in range(2000):
+					key = rng.randint(0, 100)
+					cache.set(key, "x" * rng.randint(0, 40), key % 3)
+					cache.has(rng.randint(0, 100), 0)
+					cache.get(rng.randint(0, 100), 1)
+					cache.keys()
+			except Exception as e:
+				errors.append(e)
+		threads = [threading.Thread(target=run, args=(_,)) for _ in range(8)]
+		for _ in threads: _.start()
+		for _ in threads: _.join()
+		self.assertEqual(errors, [])
+		self.assertLessEqual(len(cache), 50)
+		self.assertLessEqual(cache.bytes, 1000)
+		self.assertEqual(cache.bytes, sum(len(cache.get(_, _ % 3)[1]) for _ in cache.keys()))
+
+# -----------------------------------------------------------------------------
+#
+# COMPILE FAILURES
+#
+# -----------------------------------------------------------------------------
+
+class CompileFailures( unittest.TestCase ):
+	"""Commands that fail are not run again until their input changes, see
+	`paml.web.CompileFailure`."""
+
+	def setUp( self ):
+		from paml import web
+		self.web  = web
+		self.path = tempfile.mkdtemp()
+		self.source = os.path.join(self.path, "source.txt")
+		self.runs   = os.path.join(self.path, "runs")
+		self.write("source")
+		web.SIG_CACHE.clear()
+
+	def tearDown( self ):
+		shutil.rmtree(self.path)
+		self.web.SIG_CACHE.clear()
+
+	def write( self, text ):
+		with open(self.source, "w") as f:
+			f.write(text)
+		# NOTE: The signature has a one second resolution on some systems
+		mtime = time.time() + len(text)
+		os.utime(self.source, (mtime, mtime))
+
+	def command( self, script ):
+		"""Returns a command that logs its runs and then runs the given
+		shell script with the source as `$0`."""
+		return ["sh", "-c", "'echo >> {0}; {1}'".format(self.runs, script), self.source]
+
+	def countRuns( self ):
+		if not os.path.exists(self.runs): return 0
+		with open(self.runs) as f:
+			return len(f.read())
+
+	def testCached( self ):
+		failing = self.command("echo failed >&2; exit 1")
+		for i in range(3):
+			with self.assertRaises(Exception) as context:
+				self.web._processCommand(failing, None, self.source)
+			self.assertIn("failed", str(context.exception))
+		self.assertEqual(self.countRuns(), 1)
+
+	def testInvalidated( self ):
+		failing = self.command("echo failed >&2; exit 1")
+		self.assertRaises(Exception, self.web._processCommand, failing, None, self.source)
+		self.write("changed")
+		self.assertRaises(Exception, self.web._processCommand, failing, None, self.source)
+		self.assertEqual(self.countRuns(), 2)
+
+	def testPartialOutput( self ):
+		failing = self.command("cat \"$0\"; echo warning >&2; exit 2")
+		for i in range(2):
+			self.assertEqual(self.web._processCommand(failing, None, self.source), (u"source", u"warning\n"))
+		self.assertEqual(self.countRuns(), 1)
+
+	def testOtherCommand( self ):
+		failing = self.command("echo failed >&2; exit 1")
+		self.assertRaises(Exception, self.web._processCommand, failing, None, self.source)
+		self.assertEqual(self.web._processCommand(["cat", self.source], None, self.source)[0], u"source")
+
+# -----------------------------------------------------------------------------
+#
+# STALE WHILE REVALIDATE
+#
+# -----------------------------------------------------------------------------
+
+class StaleWhileRevalidate( unittest.TestCase ):
+	"""Outdated outputs are served while they are recompiled in the
+	background, see `paml.web.revalidated`."""
+
+	def setUp( self ):
+		from paml import web
+		self.web    = web
+		self.path   = tempfile.mkdtemp()
+		self.source = os.path.join(self.path, "source.txt")
+		self.calls  = []
+		# The compilation waits for this event, so that the tests can see
+		# the stale output.
+		self.ready  = threading.Event()
+		self.ready.set()
+		self.write("first")
+		web.STALE_CACHE.clear()
+		web.STALE_WHILE_REVALIDATE = True
+		def compile( text, path, request=None, cache=True ):
+			self.calls.append(cache)
+			self.ready.wait(5)
+			with open(path) as f:
+				text = f.read()
+			if "error" in text:
+				raise Exception("Cannot compile: " + text)
+			return text.upper(), "text/plain"
+		self.compile = web.revalidated(compile)
+
+	def tearDown( self ):
+		self.web.STALE_WHILE_REVALIDATE = False
+		self.ready.set()
+		self.wait()
+		self.web.STALE_CACHE.clear()
+		shutil.rmtree(self.path)
+
+	def write( self, text ):
+		with open(self.source, "w") as f:
+			f.write(text)
+		mtime = time.time() + len(self.calls) + len(text)
+		os.utime(self.source, (mtime, mtime))
+
+	def wait( self ):
+		for thread in threading.enumerate():
+			if thread.name == "paml-revalidate":
+				thread.join(5)
+
+	def testStale( self ):
+		self.assertEqual(self.compile(None, self.source), ("FIRST", "text/plain"))
+		self.ready.clear()
+		self.write("second")
+		self.assertEqual(self.compile(None, self.source), ("FIRST", "text/plain"))
+		self.assertEqual(self.compile(None, self.source), ("FIRST", "text/plain"))
+		self.ready.set()
+		self.wait()
+		self.assertEqual(self.compile(None, self.source), ("SECOND", "text/plain"))
+		# NOTE: The processor's own caches are bypassed, as the outputs are
+		# kept in the `STALE_CACHE`.
+		self.assertEqual(self.calls, [False, False])
+
+	def testFailure( self ):
+		failures = self.web.METRICS.get("paml_revalidation_failures_total", processor="compile") or 0
+		self.compile(None, self.source)
+		self.write("error")
+		self.assertEqual(self.compile(None, self.source), ("FIRST", "text/plain"))
+		self.wait()
+		for i in range(2):
+			with self.assertRaises(Exception) as context:
+				self.compile(None, self.source)
+			self.assertIn("Cannot compile: error", str(context.exception))
+		self.assertEqual(len(self.calls), 2)
+		self.assertEqual(self.web.METRICS.get("paml_revalidation_failures_total", processor="compile"), failures + 1)
+		# The failure is kept until the source changes
+		self.write("fixed")
+		self.assertEqual(self.compile(None, self.source), ("FIXED", "text/plain"))
+
+	def testFirstFailure( self ):
+		self.write("error")
+		for i in range(2):
+			self.assertRaises(Exception, self.compile, None, self.source)
+		self.assertEqual(len(self.calls), 1)
+
+# -----------------------------------------------------------------------------
+#
+# WARM-UP
+#
+# -----------------------------------------------------------------------------
+
+class Warmup( unittest.TestCase ):
+	"""`paml.web.warmup` compiles the served files, running the `locked`
+	processors in the calling thread."""
+
+	def setUp( self ):
+		from paml import web
+		self.web        = web
+		self.root       = tempfile.mkdtemp()
+		self.processors = web.PROCESSORS
+		self.calls      = []
+		self.running    = 0
+		self.concurrent = 0
+		lock = threading.Lock()
+		def process( text, path, request=None, cache=True ):
+			with lock:
+				self.running += 1
+				self.concurrent = max(self.concurrent, self.running)
+			time.sleep(0.05)
+			with lock:
+				self.running -= 1
+			self.calls.append((os.path.basename(path), threading.current_thread()))
+			if "error" in text: raise Exception(text)
+			return text, "text/plain"
+		@web.locked
+		def processLocked( text, path, request=None, cache=True ):
+			return process(text, path, request, cache)
+		web.PROCESSORS = {"a":process, "l":web.measured("l", processLocked)}
+		for name in ("1.a", "2.a", "3.a", "1.l", "2.l", "error.a", "ignored.txt"):
+			with open(os.path.join(self.root, name), "w") as f:
+				f.write(name)
+
+	def tearDown( self ):
+		self.web.PROCESSORS = self.processors
+		shutil.rmtree(self.root)
+
+	def testWarmup( self ):
+		results = self.web.warmup(self.root, 4)
+		self.assertEqual([os.path.basename(_[0]) for _ in results], ["1.a", "1.l", "2.a", "2.l", "3.a", "error.a"])
+		self.assertEqual([str(_[2]) for _ in results if _[2]], ["error.a"])
+		self.assertEqual(sorted(_ for _, thread in self.calls if thread is threading.current_thread()), ["1.l", "2.l"])
+		self.assertGreater(self.concurrent, 1)
+
+	def testProcessors( self ):
+		self.web.PROCESSORS = self.processors
+		processors = self.web.getProcessors()
+		self.assertEqual(sorted(_ for _ in processors if self.web.isLocked(processors[_])), ["sjs"])
+		self.assertFalse(self.web.isCached(processors["paml"]))
+		self.assertTrue(self.web.isCached(processors["sjs"]))
+		self.assertTrue(self.web.isCached(processors["ts"]))
+
+# -----------------------------------------------------------------------------
+#
+# EXPORT
+#
+# -----------------------------------------------------------------------------
+
+class Export( unittest.TestCase ):
+	"""`paml.web.export` writes the served files as static files."""
+
+	def setUp( self ):
+		from paml import web
+		self.web    = web
+		self.root   = tempfile.mkdtemp()
+		self.output = os.path.join(self.root, "dist")
+		self.files  = {"index.paml":"<p:Hello\n", "data.txt":"data\n", "page.paml":"<p:Page\n"}
+
+	def tearDown( self ):
+		shutil.rmtree(self.root)
+
+	def export( self ):
+		for name, text in self.files.items():
+			with open(os.path.join(self.root, name), "w") as f:
+				f.write(text)
+		return self.web.export(self.root, self.output, 2)
+
+	def read( self, url ):
+		with open(os.path.join(self.output, url)) as f:
+			return f.read()
+
+	def testExport( self ):
+		manifest, errors = self.export()
+		self.assertEqual(errors, [])
+		self.assertEqual(sorted(manifest), ["data.txt", "index.html", "page.html"])
+		self.assertEqual(self.read("index.html"), "<p>Hello</p>")
+		self.assertEqual(self.read(manifest["data.txt"]["hashed"]), "data\n")
+		self.assertEqual(manifest["index.html"]["source"], "index.paml")
+
+	def testCollision( self ):
+		# NOTE: Both `page.paml` and `page.html` are exported as `page.html`
+		self.files["page.html"] = "<p>Other</p>"
+		manifest, errors = self.export()
+		self.assertEqual(sorted(manifest), ["data.txt", "index.html"])
+		self.assertEqual(sorted(os.path.basename(_) for _, e in errors), ["page.html", "page.paml"])
+		self.assertIn("page.html", str(errors[0][1]))
+		self.assertFalse(os.path.exists(os.path.join(self.output, "page.html")))
+
+# -----------------------------------------------------------------------------
+#
+# ASYNCIO
+#
+# -----------------------------------------------------------------------------
+
+class AsyncIO( unittest.TestCase ):
+	"""The `paml.aio` API and its ASGI `Application`, driven with fake
+	scopes."""
+
+	def setUp( self ):
+		from paml import aio, web
+		self.aio  = aio
+		self.web  = web
+		self.root = tempfile.mkdtemp()
+		with open(os.path.join(self.root, "index.paml"), "w") as f:
+			f.write("<p:Hello\n")
+		with open(os.path.join(self.root, "data.txt"), "w") as f:
+			f.write("data\n")
+
+	def tearDown( self ):
+		shutil.rmtree(self.root)
+
+	async def call( self, app, path, method="GET" ):
+		"""Calls the given ASGI application and returns `(status, headers,
+		body)`."""
+		sent = []
+		async def receive():
+			return {"type":"http.request"}
+		async def send( message ):
+			sent.append(message)
+		await app({"type":"http", "method":method, "path":path}, receive, send)
+		return sent[0]["status"], dict(sent[0]["headers"]), sent[1]["body"]
+
+	def testApplication( self ):
+		app = self.aio.Application(self.root)
+		async def run():
+			return await asyncio.gather(
+				self.call(app, "/index.paml"),
+				self.call(app, "/index"),
+				self.call(app, "/data.txt"),
+				self.call(app, "/data.txt", "HEAD"),
+				self.call(app, "/missing"),
+				self.call(app, "/../etc/passwd"),
+				self.call(app, "/_paml/metrics"),
+			)
+		results = asyncio.run(run())
+		self.assertEqual(results[0], (200, {b"content-type":b"text/html"}, b"<p>Hello</p>"))
+		self.assertEqual(results[1], results[0])
+		self.assertEqual(results[2], (200, {b"content-type":b"text/plain"}, b"data\n"))
+		self.assertEqual(results[3], (200, {b"content-type":b"text/plain"}, b""))
+		self.assertEqual(results[4][0], 404)
+		self.assertEqual(results[5][0], 403)
+		self.assertEqual(results[6][0], 200)
+		self.assertIn(b"paml_processor_requests_total", results[6][2])
+
+	def testNotBlocking( self ):
+		# NOTE: The document is parsed in an executor, so the loop keeps
+		# running other tasks in the meantime.
+		text  = "<ul\n" + "\t<li:<a(href=#{0}):Item {0}>\n" * 20000
+		ticks = []
+		async def tick():
+			while True:
+				ticks.append(time.time())
+				await asyncio.sleep(0.001)
+		async def run():
+			ticker = asyncio.ensure_future(tick())
+			await asyncio.sleep(0)
+			try:
+				return await self.aio.processPAML(text, os.path.join(self.root, "long.paml"))
+			finally:
+				ticker.cancel()
+		output, type = asyncio.run(run())
+		self.assertEqual(output, self.web.processPAML(text, os.path.join(self.root, "long.paml"))[0])
+		self.assertGreater(len(ticks), 10)
+
+	def testIncremental( self ):
+		path = os.path.join(self.root, "index.paml")
+		self.web.INCREMENTAL = True
+		try:
+			async def run():
+				return await asyncio.gather(*(self.aio.processPAML("<p:Hello {0}\n".format(i), path) for i in range(5)))
+			self.assertEqual([_[0] for _ in asyncio.run(run())], ["<p>Hello {0}</p>".format(i) for i in range(5)])
+		finally:
+			self.web.INCREMENTAL = False
+			self.web.DOCUMENTS.clear()
+
+	def testRunSteps( self ):
+		def steps():
+			data, error, returncode = yield (["echo", "$HOME"], None)
+			try:
+				yield (["paml-missing-command"], None)
+			except Exception:
+				pass
+			return engine.ensure_unicode(data).strip(), returncode
+		result = asyncio.run(self.aio.runSteps(steps()))
+		self.assertEqual(result, (os.path.expanduser("~"), 0))
+
+# -----------------------------------------------------------------------------
+#
+# DEEP NESTING
+#
+# -----------------------------------------------------------------------------
+
+class DeepNesting( unittest.TestCase ):
+	"""Documents nested deeper than the recursion limit must be formatted
+	and serialized, see `benchmark.depthScaling`."""
+
+	def testFormat( self ):
+		self.assertGreater(DEEP_NESTING, sys.getrecursionlimit())
+		for format in benchmark.SCALING_FORMATS:
+			output = engine.formatter(format).format(benchmark.nested(DEEP_NESTING))
+			self.assertEqual(output.count("<div"),   DEEP_NESTING, format)
+			self.assertEqual(output.count("</div>"), DEEP_NESTING, format)
+			self.assertIn("Lorem ipsum", output)
+
+	def testSameAsParsed( self ):
+		# NOTE: The source is quadratic in size, so we compare at a depth
+		# that is still deeper than the recursion limit.
+		depth  = sys.getrecursionlimit() + 100
+		source = nestedSource(depth)
+		for format in benchmark.SCALING_FORMATS:
+			document = benchmark.nested(depth)
+			# NOTE: The parser turns the end of line of the text into a space
+			element  = document
+			while isinstance(element.content[0], engine.Element):
+				element = element.content[0]
+			element.content[0].content += " "
+			self.assertEqual(engine.formatter(format).format(document), engine.parse(source, format=format), format)
+
+	def testSerialize( self ):
+		document = benchmark.nested(DEEP_NESTING)
+		expected = engine.formatter("html").format(document.clone())
+		self.assertEqual(engine.formatter("html").format(engine.loads(engine.dumps(document))), expected)
+
+# -----------------------------------------------------------------------------
+#
+# MAIN
+#
+# -----------------------------------------------------------------------------
+
+if __name__ == "__main__":
+	unittest.main()
+
+# EOF - vim: tw=80 ts=4 sw=4 noet